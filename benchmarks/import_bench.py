@@ -0,0 +1,43 @@
+""" Benchmark package import times with python -X importtime """
+#pylint: disable=C0326
+from __future__ import print_function
+import argparse
+import json
+import subprocess
+import sys
+
+MODULES = ['virtusb', 'virtusb.cli', 'virtusb.spec', 'virtusb.controller',
+           'virtusb.client', 'virtusb.server']
+
+def import_time(module):
+    """ Cumulative import time of a module in a fresh interpreter, in microseconds """
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = process.communicate()
+    for line in err.decode('utf-8').splitlines():
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1])
+    raise RuntimeError('No import time reported for {}'.format(module))
+
+def main():
+    """ MAIN """
+    parser = argparse.ArgumentParser(description='Package import time benchmark')
+    parser.add_argument('--runs', type=int, default=7, help='Runs per module, the median is kept')
+    parser.add_argument('--json', help='Also write the results to this file, for tracking')
+    parser.add_argument('modules', nargs='*', default=MODULES, help='Modules to import')
+    options = parser.parse_args()
+
+    results = {}
+    print('{:<24} {:>10}'.format('module', 'ms'))
+    for module in options.modules:
+        times = sorted(import_time(module) for _ in range(options.runs))
+        results[module] = times[len(times) // 2] / 1000.0
+        print('{:<24} {:>10.1f}'.format(module, results[module]))
+
+    if options.json:
+        with open(options.json, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
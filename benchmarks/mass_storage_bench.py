@@ -0,0 +1,74 @@
+""" Benchmark mass storage bulk throughput through the USBIP server """
+#pylint: disable=C0326,protected-access
+from __future__ import print_function
+import argparse
+import os
+import struct
+import tempfile
+import time
+from virtusb.controller import VirtualController
+from virtusb.devices import mass_storage
+from virtusb.devices.mass_storage import MassStorageDevice, CBW, CSW
+from virtusb.testing import loopback
+
+BLOCK_SIZE = 512
+
+def transfer(client, opcode, lba, blocks, data=None):
+    """ Run a READ(10) or WRITE(10) through every Bulk-Only phase """
+    length = blocks * BLOCK_SIZE
+    block  = struct.pack('>BBIBHB', opcode, 0, lba, 0, blocks, 0)
+    flags  = mass_storage.CBW_DATA_IN if data is None else 0x00
+    cbw = CBW.pack(mass_storage.CBW_SIGNATURE, lba, length, flags, 0, len(block), block)
+    client._submit_handler(0, endpoint=2, direction=0, buffer_len=len(cbw), data=cbw)
+
+    if data is None:
+        _, data = client._submit_handler(0, endpoint=1, direction=1, buffer_len=length)
+    else:
+        client._submit_handler(0, endpoint=2, direction=0, buffer_len=length, data=data)
+    _, status = client._submit_handler(0, endpoint=1, direction=1, buffer_len=CSW.size)
+    assert CSW.unpack(status)[3] == mass_storage.CSW_PASSED
+    return data
+
+def run(client, opcode, total, chunk):
+    """ Transfer total bytes in chunk sized commands, returning MB/s """
+    blocks  = chunk // BLOCK_SIZE
+    payload = None if opcode == mass_storage.SCSI_READ_10 else b'\xa5' * chunk
+    lbas    = total // BLOCK_SIZE
+    start   = time.time()
+    for lba in range(0, lbas, blocks):
+        transfer(client, opcode, lba, blocks, payload)
+    elapsed = time.time() - start
+    return total / elapsed / 1e6
+
+def main():
+    """ MAIN """
+    parser = argparse.ArgumentParser(description='Mass storage throughput benchmark')
+    parser.add_argument('--socketpair', action='store_true',
+                        help='Connect over a socket pair instead of TCP')
+    parser.add_argument('--size', type=int, default=64, help='Disk image size in MiB')
+    parser.add_argument('--chunks', type=int, nargs='+', default=[4096, 65536, 1048576],
+                        help='Transfer sizes in bytes')
+    options = parser.parse_args()
+
+    total = options.size * 1024 * 1024
+    image = tempfile.NamedTemporaryFile(suffix='.img', delete=False)
+    image.truncate(total)
+    image.close()
+
+    controller = VirtualController()
+    device     = MassStorageDevice(image.name)
+    controller.devices = [device]
+    try:
+        with loopback(controller, tcp=not options.socketpair) as (_, client):
+            client.attach('1-1')
+            print('{:>10} {:>12} {:>12}'.format('chunk', 'read MB/s', 'write MB/s'))
+            for chunk in options.chunks:
+                write = run(client, mass_storage.SCSI_WRITE_10, total, chunk)
+                read  = run(client, mass_storage.SCSI_READ_10, total, chunk)
+                print('{:>10} {:>12.1f} {:>12.1f}'.format(chunk, read, write))
+    finally:
+        device.close()
+        os.unlink(image.name)
+
+if __name__ == '__main__':
+    main()
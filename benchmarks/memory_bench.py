@@ -0,0 +1,66 @@
+""" Benchmark the memory used per virtual device instance """
+#pylint: disable=C0326
+from __future__ import print_function
+import argparse
+import copy
+import gc
+import tracemalloc
+from virtusb import descriptors
+from virtusb.controller import VirtualDevice
+
+COUNTS = (1, 100, 10000)
+
+def build_template():
+    """ A typical vendor device, with an alternate setting and a few endpoints """
+    endpoints = [
+        descriptors.Endpoint(bEndpointAddress=0x81, bmAttributes=0x02),
+        descriptors.Endpoint(bEndpointAddress=0x02, bmAttributes=0x02),
+        descriptors.Endpoint(bEndpointAddress=0x83, bmAttributes=0x03, bInterval=4),
+    ]
+    return descriptors.Device(
+        idVendor       = 0xdead,
+        idProduct      = 0xbeef,
+        configurations = [descriptors.Configuration(
+            bConfigurationValue = 1,
+            interfaces = [
+                descriptors.Interface(bInterfaceNumber=0, bAlternateSetting=0,
+                                      endpoints=endpoints[:1]),
+                descriptors.Interface(bInterfaceNumber=0, bAlternateSetting=1,
+                                      endpoints=endpoints),
+            ])])
+
+def measure(count, factory):
+    """ Measure the bytes allocated per device when creating count devices """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    devices = [factory(idx) for idx in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    allocated = sum(stat.size_diff for stat in stats)
+    del devices
+    return allocated / float(count)
+
+def main():
+    """ MAIN """
+    parser = argparse.ArgumentParser(description='Virtual device memory benchmark')
+    parser.add_argument('--counts', type=int, nargs='+', default=COUNTS,
+                        help='Device counts to measure')
+    options = parser.parse_args()
+
+    template = build_template().freeze()
+    modes = [
+        ('shared template', lambda idx: VirtualDevice(template, serial_number=str(idx))),
+        ('copied template', lambda idx: VirtualDevice(copy.deepcopy(template),
+                                                      serial_number=str(idx))),
+    ]
+
+    print('{:>8} {:>20} {:>20}'.format('devices', *[name for name, _ in modes]))
+    for count in options.counts:
+        results = [measure(count, factory) for _, factory in modes]
+        print('{:>8} {:>14.0f} B/dev {:>14.0f} B/dev'.format(count, *results))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+""" Benchmark CDC-NCM frame throughput and per URB overhead through the USBIP server """
+#pylint: disable=C0326,protected-access
+from __future__ import print_function
+import argparse
+import time
+from virtusb.controller import VirtualController
+from virtusb.devices.cdc_ncm import NcmDevice, unpack_ntb
+from virtusb.testing import loopback
+
+def run(client, device, frame, count, ntb_size, batch):
+    """ Push count frames to the host, returning frames/s, MB/s and URBs used """
+    urbs     = 0
+    received = 0
+    start    = time.time()
+    while received < count:
+        for _ in range(min(batch, count - received)):
+            device.send(frame)
+        while device.queued():
+            _, block = client._submit_handler(0, endpoint=1, direction=1, buffer_len=ntb_size)
+            received += sum(1 for _ in unpack_ntb(block))
+            urbs     += 1
+    elapsed = time.time() - start
+    return count / elapsed, count * len(frame) / elapsed / 1e6, urbs
+
+def main():
+    """ MAIN """
+    parser = argparse.ArgumentParser(description='CDC-NCM throughput benchmark')
+    parser.add_argument('--frames', type=int, default=100000, help='Frames per run')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 512, 1514],
+                        help='Frame sizes in bytes')
+    parser.add_argument('--socketpair', action='store_true',
+                        help='Connect over a socket pair instead of TCP')
+    parser.add_argument('--ntb-size', type=int, default=16384, help='NTB size in bytes')
+    options = parser.parse_args()
+
+    controller = VirtualController()
+    device     = NcmDevice(ntb_size=options.ntb_size, max_queue=options.frames)
+    controller.devices = [device]
+    with loopback(controller, tcp=not options.socketpair) as (_, client):
+        client.attach('1-1')
+        print('{:>6} {:>6} {:>12} {:>10} {:>14}'.format(
+            'size', 'batch', 'frames/s', 'MB/s', 'frames/URB'))
+        for size in options.sizes:
+            frame = b'\xa5' * size
+            # A batch of one is the unaggregated, one frame per URB worst case
+            for batch in (1, options.frames):
+                rate, throughput, urbs = run(client, device, frame, options.frames,
+                                             options.ntb_size, batch)
+                print('{:>6} {:>6} {:>12.0f} {:>10.1f} {:>14.1f}'.format(
+                    size, min(batch, 99999), rate, throughput, options.frames / float(urbs)))
+
+if __name__ == '__main__':
+    main()
@@ -20,8 +20,9 @@ AUTHOR          = 'lungdart'
 REQUIRES_PYTHON = '>=2.7.0'
 VERSION         = '0.1'
 LICENSE         = 'MIT'
-REQUIRED        = ['future', 'six', 'packeteer']
-EXTRAS          = {}
+REQUIRED        = ['future', 'six', 'packeteer', 'futures; python_version < "3"',
+                   'selectors2; python_version < "3"']
+EXTRAS          = {'numpy': ['numpy']}
 CLASSIFIERS     = [
     'License :: OSI Approved :: MIT License',
     'Natural Language :: English',
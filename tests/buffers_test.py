@@ -0,0 +1,26 @@
+""" Test the URB buffer pool """
+import pytest #pylint: disable=unused-import
+from virtusb.buffers import BufferPool
+from tests.mocking.logging import configure #pylint:disable=unused-import
+
+def test_reuse():
+    """ Test released buffers are handed out again for the same size class """
+    pool = BufferPool(max_size=4096, max_free=1)
+    first = pool.acquire(100)
+    assert len(first) == 128
+    pool.release(first)
+    assert pool.acquire(128) is first
+    assert pool.acquire(128) is not first
+
+def test_limits():
+    """ Test oversized and excess buffers aren't kept """
+    pool = BufferPool(max_size=4096, max_free=1)
+    large = pool.acquire(8192)
+    pool.release(large)
+    assert pool.acquire(8192) is not large
+
+    first, second = pool.acquire(64), pool.acquire(64)
+    pool.release(first)
+    pool.release(second)
+    assert pool.acquire(64) is first
+    assert pool.acquire(64) is not second
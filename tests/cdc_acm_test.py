@@ -0,0 +1,122 @@
+""" Test the CDC-ACM serial device model """
+#pylint: disable=C0326,redefined-outer-name
+import os
+import select
+import struct
+import pytest #pylint: disable=unused-import
+from virtusb import packets
+from virtusb.controller import VirtualController, URB_PENDING
+from virtusb.devices import cdc_acm
+from virtusb.devices.cdc_acm import CdcAcmDevice
+from tests.mocking.logging import configure #pylint:disable=unused-import
+
+@pytest.fixture
+def serial():
+    """ Serial device with small rings """
+    device = CdcAcmDevice(ring_size=64)
+    yield device
+    device.close()
+
+def bulk(device, direction, size, data=None):
+    """ Submit a bulk URB to the device """
+    endpoint = 1 if direction == 1 else 2
+    packet = packets.UsbIpCmdSubmit(direction=direction, endpoint=endpoint, buffer_len=size)
+    return device.handle(packet, data)
+
+def listen(device):
+    """ Collect completed URBs """
+    completions = []
+    device.set_urb_listener(lambda dev, ep: completions.append((ep, dev.pop_completion(ep))))
+    return completions
+
+def test_descriptors(serial):
+    """ Test the functional descriptors are in the configuration """
+    serial.set_configuration()
+    config = VirtualController.pack_config_descriptor(serial)
+    assert len(config) == struct.unpack_from('<H', config, 2)[0]
+    assert b'\x05\x24\x06\x00\x01' in config
+
+def test_write_read(serial):
+    """ Test data moves both ways, and IN URBs take it all at once """
+    serial.write(b'hello ')
+    serial.write(b'world')
+    assert bytes(bulk(serial, 1, 512)) == b'hello world'
+
+    assert bulk(serial, 0, 5, b'howdy') is None
+    assert serial.read() == b'howdy'
+
+def test_parked(serial):
+    """ Test URBs wait for data, and for ring space """
+    completions = listen(serial)
+    assert bulk(serial, 1, 512) is URB_PENDING
+    serial.write(b'late')
+    assert completions == [(cdc_acm.EP_BULK_IN, b'late')]
+
+    assert bulk(serial, 0, 60, b'x' * 60) is None
+    assert bulk(serial, 0, 10, b'y' * 10) is URB_PENDING
+    assert serial.read(30) == b'x' * 30
+    assert completions[1] == (cdc_acm.EP_BULK_OUT, None)
+    assert serial.read() == b'x' * 30 + b'y' * 10
+
+def test_cancel(serial):
+    """ Test unlinked URBs are forgotten, and their OUT data dropped """
+    completions = listen(serial)
+    urb = packets.UsbIpCmdSubmit(seq_num=1, direction=1, endpoint=1, buffer_len=512)
+    assert serial.handle(urb) is URB_PENDING
+    assert serial.cancel(cdc_acm.EP_BULK_IN, urb)
+    serial.write(b'kept')
+    assert not completions
+
+    assert bulk(serial, 0, 64, b'x' * 64) is None
+    urb = packets.UsbIpCmdSubmit(seq_num=2, direction=0, endpoint=2, buffer_len=4)
+    assert serial.handle(urb, b'drop') is URB_PENDING
+    assert serial.cancel(cdc_acm.EP_BULK_OUT, urb)
+    assert serial.read() == b'x' * 64
+    assert not completions and serial.read() == b''
+
+    # Already completed URBs can't be cancelled
+    assert not serial.cancel(cdc_acm.EP_BULK_OUT, urb)
+
+def test_queued_limit(serial):
+    """ Test completions of parked URBs aren't refused past the queued limit, unlike pushed data """
+    serial.max_queued = 4
+    for seq_num in range(3):
+        urb = packets.UsbIpCmdSubmit(seq_num=seq_num, direction=1, endpoint=1, buffer_len=8)
+        assert serial.dispatch(urb) is URB_PENDING
+    serial.write(b'abcdefgh' * 3)
+    assert not serial.complete(cdc_acm.EP_BULK_IN, b'pushed')
+    assert [serial.pop_completion(cdc_acm.EP_BULK_IN) for _ in range(3)] == [b'abcdefgh'] * 3
+
+def test_line_coding():
+    """ Test line coding requests through the controller """
+    controller = VirtualController()
+    controller.devices = [CdcAcmDevice()]
+    coding = struct.pack('<IBBB', 9600, 0, 0, 8)
+    setup  = packets.UrbSetup(bmRequestType=0x21, bRequest=cdc_acm.CDC_SET_LINE_CODING, wLength=7)
+    packet = packets.UsbIpCmdSubmit(dev_id=0x10001, endpoint=0, direction=0, setup=setup)
+    controller.handle(packet, coding)
+
+    setup = packets.UrbSetup(bmRequestType=0xa1, bRequest=cdc_acm.CDC_GET_LINE_CODING, wLength=7)
+    packet = packets.UsbIpCmdSubmit(dev_id=0x10001, endpoint=0, direction=1, setup=setup)
+    assert controller.handle(packet) == coding
+
+def test_pty_bridge():
+    """ Test data crosses the pty in both directions """
+    device = CdcAcmDevice(bridge='pty')
+    port = os.open(device.pty_name, os.O_RDWR | os.O_NOCTTY)
+    try:
+        os.write(port, b'ping')
+        data = b''
+        for _ in range(100):
+            data += bytes(bulk(device, 1, 512) if len(device._tx) else b'') #pylint: disable=protected-access
+            if data == b'ping':
+                break
+            select.select([], [], [], 0.01)
+        assert data == b'ping'
+
+        bulk(device, 0, 4, b'pong')
+        readable, _, _ = select.select([port], [], [], 2)
+        assert readable and os.read(port, 4) == b'pong'
+    finally:
+        os.close(port)
+        device.close()
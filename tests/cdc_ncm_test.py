@@ -0,0 +1,82 @@
+""" Test the CDC-NCM network adapter model """
+#pylint: disable=C0326,redefined-outer-name
+import struct
+from collections import deque
+import pytest #pylint: disable=unused-import
+from virtusb import packets
+from virtusb.controller import VirtualController, URB_PENDING
+from virtusb.devices import cdc_ncm
+from virtusb.devices.cdc_ncm import NcmDevice, pack_ntb, unpack_ntb
+from tests.mocking.logging import configure #pylint:disable=unused-import
+
+FRAMES = [bytes(bytearray([idx]) * (60 + idx)) for idx in range(10)]
+
+def bulk(device, endpoint, direction, size, data=None):
+    """ Submit a bulk URB to the device """
+    packet = packets.UsbIpCmdSubmit(direction=direction, endpoint=endpoint, buffer_len=size)
+    return device.handle(packet, data)
+
+def test_ntb_round_trip():
+    """ Test frames survive aggregation, and only what fits is taken """
+    queue = deque(FRAMES)
+    block = pack_ntb(queue, 16384)
+    assert not queue
+    assert [bytes(frame) for frame in unpack_ntb(block)] == FRAMES
+
+    queue = deque(FRAMES)
+    block = pack_ntb(queue, 200)
+    assert len(block) <= 200
+    assert [bytes(frame) for frame in unpack_ntb(block)] == FRAMES[:2]
+    assert list(queue) == FRAMES[2:]
+
+def test_malformed_ntb():
+    """ Test malformed blocks from the host raise, rather than looping or reading past the end """
+    block = pack_ntb(deque(FRAMES[:1]), 16384)
+    ndp_index = struct.unpack_from('<H', block, 10)[0]
+
+    cyclic = bytearray(block)
+    struct.pack_into('<H', cyclic, ndp_index + 6, ndp_index)
+    truncated = bytearray(block)
+    struct.pack_into('<H', truncated, 10, 0xfff0)
+    for malformed in (cyclic, truncated, block[:-4], block[:8]):
+        with pytest.raises(RuntimeError):
+            list(unpack_ntb(malformed))
+
+def test_aggregation():
+    """ Test queued frames go out in one URB, and late frames complete parked URBs """
+    device = NcmDevice()
+    for frame in FRAMES:
+        device.send(frame)
+    block = bulk(device, 1, 1, 16384)
+    assert len(list(unpack_ntb(block))) == len(FRAMES)
+
+    completions = []
+    device.set_urb_listener(lambda dev, ep: completions.append(dev.pop_completion(ep)))
+    assert bulk(device, 1, 1, 16384) is URB_PENDING
+    device.send(FRAMES[0])
+    assert [bytes(frame) for frame in unpack_ntb(completions[0])] == FRAMES[:1]
+
+def test_receive():
+    """ Test frames from the host reach the sink """
+    frames = []
+    device = NcmDevice(sink=frames.append)
+    assert bulk(device, 2, 0, 0, pack_ntb(deque(FRAMES), 16384)) is None
+    assert frames == FRAMES
+
+def test_link_up():
+    """ Test the host is told the link is up """
+    device = NcmDevice()
+    notification = bulk(device, 3, 1, 16)
+    assert struct.unpack('<BBHHH', notification) == (0xa1, cdc_ncm.NCM_NETWORK_CONNECTION, 1, 0, 0)
+    assert struct.unpack('<BBHHH', bulk(device, 3, 1, 16)[:8])[1] == cdc_ncm.NCM_SPEED_CHANGE
+    assert bulk(device, 3, 1, 16) is URB_PENDING
+
+def test_mac_string():
+    """ Test the MAC address is served as a string descriptor """
+    controller = VirtualController()
+    controller.devices = [NcmDevice(mac='02:11:22:33:44:55')]
+    assert controller.devices[0].active_config.bNumInterfaces == 2
+
+    setup  = packets.UrbSetup(bmRequestType=0x80, bRequest=0x06, wValue=0x0304, wLength=255)
+    packet = packets.UsbIpCmdSubmit(dev_id=0x10001, endpoint=0, direction=1, setup=setup)
+    assert controller.handle(packet)[2:].decode('utf-16-le') == '021122334455'
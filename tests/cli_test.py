@@ -2,7 +2,8 @@
 #pylint: disable=C0326,R0205
 from __future__ import unicode_literals, print_function
 import pytest #pylint: disable=unused-import
-from virtusb import  cli
+import logging
+from virtusb import  cli, log
 from tests.mocking.logging import configure #pylint:disable=unused-import
 from tests.mocking.dummy_device import DummyDevice
 
@@ -35,6 +36,15 @@ def test_extended_parser():
     assert dummy.count == 99
     assert dummy.test
 
+#@pytest.mark.skip()
+def test_lazy_logging():
+    """ Tests loggers are configured when the level is set, not when they're fetched """
+    assert not log.get_logger('lazy').handlers
+    log.set_level(log.INFO)
+    log.set_level(log.DEBUG)
+    assert len(logging.getLogger('virtusb').handlers) == 1
+    assert not log.get_logger('lazy').handlers
+
 #@pytest.mark.skip()
 def test_server_factory():
     """ Tests the CLI server factory"""
@@ -47,6 +57,15 @@ def test_server_factory():
     for device in single_server.controller.devices:
         assert isinstance(device, DummyDevice)
 
+#@pytest.mark.skip()
+def test_server_factory_workers():
+    """ Tests offloaded devices' workers are stopped with the server """
+    server = cli.server_factory(DummyDevice, 2, workers=1)
+    process = server.controller.devices[0]._worker.process #pylint: disable=protected-access
+    assert process.is_alive()
+    for callback in server.on_stop:
+        callback()
+    assert not process.is_alive()
 
 @pytest.mark.skip(reason='Not implemented (Requires a device script)')
 def test_virtusb_main():
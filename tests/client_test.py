@@ -0,0 +1,97 @@
+""" Test the client side driver API """
+#pylint: disable=C0326,redefined-outer-name
+from collections import deque
+from concurrent.futures import Future
+from functools import partial
+import pytest #pylint: disable=unused-import
+from virtusb import descriptors
+from virtusb.client import VirtualDriver
+from virtusb.devices.cdc_acm import CdcAcmDevice, EP_BULK_IN, EP_BULK_OUT
+from virtusb.devices.sources import SourceDevice, CounterSource
+from tests.mocking.logging import configure #pylint:disable=unused-import
+
+class SmallDriver(VirtualDriver):
+    """ Driver splitting transfers into tiny URBs """
+    max_transfer = 16
+    queue_depth  = 3
+
+@pytest.fixture
+def serial(controller, client):
+    """ Attached serial device, and it's driver """
+    device = CdcAcmDevice(ring_size=1024)
+    controller.devices = [device]
+    yield device, SmallDriver(client, client.attach('1-1')['port'])
+    device.close()
+
+def test_write(serial):
+    """ Test writes are split into URBs, and all arrive in order """
+    device, driver = serial
+    data = bytes(bytearray(range(200)))
+    assert driver.write(EP_BULK_OUT, data) == 200
+    assert device.read() == data
+
+def test_read(serial):
+    """ Test reads stop at a short transfer, keeping everything that arrived """
+    device, driver = serial
+    device.write(b'x' * 40)
+    assert driver.read(EP_BULK_IN, 100) == b'x' * 40
+
+    # URBs unlinked after the short transfer don't hold on to data
+    device.write(b'y' * 8)
+    buf = bytearray(64)
+    assert driver.readinto(EP_BULK_IN, buf) == 8
+    assert bytes(buf[:8]) == b'y' * 8
+
+class ScriptedClient(object):
+    """ Client completing URBs right away with scripted data """
+    def __init__(self, transfers):
+        self.transfers = deque(transfers)
+
+    def submit(self, port, **kwargs): #pylint: disable=unused-argument
+        """ Complete the URB with the next scripted transfer """
+        future = Future()
+        future.set_result(({'status': 0}, self.transfers.popleft()))
+        return future
+
+    def unlink(self, port, future): #pylint: disable=unused-argument,no-self-use
+        """ Unlink an URB which already completed """
+        unlink = Future()
+        unlink.set_result(({'status': 0}, None))
+        return unlink
+
+def test_read_keeps_unlinked():
+    """ Test data of URBs completing past a short transfer is kept for the next read """
+    client = ScriptedClient([b'a' * 16, b'b' * 4, b'c' * 16, b'd' * 10])
+    driver = SmallDriver(client, 0)
+    assert driver.read(EP_BULK_IN, 48) == b'a' * 16 + b'b' * 4
+    assert driver.read(EP_BULK_IN, 10) == b'c' * 10
+    assert driver.read(EP_BULK_IN, 16) == b'c' * 6 + b'd' * 10
+    assert not client.transfers
+
+def test_control(serial):
+    """ Test control transfers in both directions """
+    device, driver = serial
+    coding = b'\x00\xc2\x01\x00\x00\x00\x08'
+    driver.control(0x21, 0x20, data=coding)
+    assert device.line_coding == coding
+    assert driver.control(0xa1, 0x21, length=7) == coding
+
+class CounterDevice(SourceDevice):
+    """ Device counting on a bulk IN endpoint """
+    template = descriptors.Device(configurations=[descriptors.Configuration(
+        interfaces=[descriptors.Interface(
+            endpoints=[descriptors.Endpoint(bEndpointAddress=0x81, bmAttributes=0x02)])])])
+    sources  = {0x81: partial(CounterSource, width=1)}
+
+def test_stream(controller, client):
+    """ Test streams yield every URB in order, and stop when closed """
+    controller.devices = [CounterDevice()]
+    driver = VirtualDriver(client, client.attach('1-1')['port'])
+
+    chunks = list(driver.stream(0x81, total=100, transfer=32))
+    assert [len(chunk) for chunk in chunks] == [32, 32, 32, 4]
+    assert b''.join(chunks) == bytes(bytearray(range(100)))
+
+    stream = driver.stream(0x81, transfer=8)
+    assert next(stream) == bytes(bytearray(range(100, 108)))
+    stream.close()
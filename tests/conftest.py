@@ -0,0 +1,26 @@
+""" Shared fixtures, serving a controller in-process over socket pairs """
+#pylint: disable=redefined-outer-name
+import pytest
+from virtusb.controller import VirtualController
+from virtusb.testing import loopback
+
+@pytest.fixture
+def controller():
+    """ Empty controller. Add devices before using the client """
+    return VirtualController()
+
+@pytest.fixture
+def usbip(controller):
+    """ Loopback server for the controller and a client connected to it """
+    with loopback(controller) as (server, client):
+        yield server, client
+
+@pytest.fixture
+def server(usbip):
+    """ Loopback server for the controller """
+    return usbip[0]
+
+@pytest.fixture
+def client(usbip):
+    """ Client connected to the loopback server """
+    return usbip[1]
@@ -0,0 +1,112 @@
+""" Test the virtual controller's request handling and URB routing """
+#pylint: disable=C0326
+from functools import partial
+import pytest #pylint: disable=unused-import
+from virtusb import descriptors, packets
+from virtusb.controller import VirtualController, VirtualDevice, DeviceFactory
+from tests.mocking.logging import configure #pylint:disable=unused-import
+from tests.mocking.dummy_device import DummyDevice
+
+class RoutedDevice(VirtualDevice):
+    """ Device with an alternate setting swapping a bulk endpoint for an interrupt one """
+    template = descriptors.Device(configurations=[descriptors.Configuration(interfaces=[
+        descriptors.Interface(bInterfaceNumber=0, endpoints=[
+            descriptors.Endpoint(bEndpointAddress=0x02, bmAttributes=0x02)]),
+        descriptors.Interface(bInterfaceNumber=1, bAlternateSetting=0),
+        descriptors.Interface(bInterfaceNumber=1, bAlternateSetting=1, endpoints=[
+            descriptors.Endpoint(bEndpointAddress=0x81, bmAttributes=0x02),
+            descriptors.Endpoint(bEndpointAddress=0x83, bmAttributes=0x03,
+                                 wMaxPacketSize=8)])])])
+
+    def bulk_in(self, packet, data=None): #pylint: disable=unused-argument,no-self-use
+        """ Bulk IN handler """
+        return b'bulk in'
+
+    def bulk_out(self, packet, data=None): #pylint: disable=unused-argument,no-self-use
+        """ Bulk OUT handler """
+        return b'bulk out'
+
+    def handle(self, packet, data=None):
+        return b'fallback'
+
+def submit(controller, endpoint, direction=1):
+    """ Submit a non control URB """
+    packet = packets.UsbIpCmdSubmit(
+        dev_id=0x10001, endpoint=endpoint, direction=direction, buffer_len=64)
+    return controller.handle(packet)
+
+def set_interface(controller, number, alt_setting):
+    """ Submit a SET_INTERFACE request """
+    packet = packets.UsbIpCmdSubmit(
+        dev_id=0x10001, endpoint=0, direction=0,
+        setup=packets.UrbSetup(bmRequestType=0x01, bRequest=0x0b,
+                               wValue=alt_setting, wIndex=number))
+    return controller.handle(packet)
+
+def test_routes():
+    """ Test URBs go to their transfer type's handler, and alternate settings swap routes """
+    controller = VirtualController()
+    device = RoutedDevice()
+    controller.devices = [device]
+
+    assert sorted(device.routes) == [0x02]
+    assert submit(controller, 2, direction=0) == b'bulk out'
+
+    set_interface(controller, 1, 1)
+    assert device.alt_settings == {1: 1}
+    assert sorted(device.routes) == [0x02, 0x81, 0x83]
+    assert submit(controller, 1) == b'bulk in'
+    assert device.routes[0x83][0].wMaxPacketSize == 8
+
+    # No interrupt handler, and endpoints outside the routes fall back to handle()
+    assert submit(controller, 3) == b'fallback'
+    assert submit(controller, 4) == b'fallback'
+
+    device.set_configuration(1)
+    assert sorted(device.routes) == [0x02]
+
+def test_set_interface_index():
+    """ Test only wIndex's low byte selects the interface """
+    controller = VirtualController()
+    device = RoutedDevice()
+    controller.devices = [device]
+    set_interface(controller, 0x0201, 1)
+    assert device.alt_settings == {1: 1}
+
+def test_invalid_interface():
+    """ Test selecting a missing alternate setting fails """
+    device = RoutedDevice()
+    with pytest.raises(RuntimeError):
+        device.set_interface(1, 2)
+    assert device.descriptor.configurations[0].find_interface(1, 1).bAlternateSetting == 1
+    assert device.descriptor.find_configuration(2) is None
+
+def test_queued_limit():
+    """ Test completions are refused once too many bytes are queued ahead of URBs """
+    device = RoutedDevice()
+    device.max_queued = 4
+    assert device.complete(0x81, b'abc')
+    assert not device.complete(0x81, b'de')
+    assert device.complete(0x82, b'de')
+    assert device.pop_completion(0x81) == b'abc'
+
+    # Anything fits in an empty queue
+    assert device.complete(0x81, b'too big')
+    assert device.pop_completion(0x81) == b'too big'
+
+def test_serial_number():
+    """ Test serial numbers are served as a string descriptor, without touching the template """
+    device = DummyDevice(serial_number='0042')
+    assert bytearray(VirtualController.pack_device_descriptor(device))[16] == 3
+    assert VirtualController.pack_serial_string(device, 0) == b'\x04\x03\x09\x04'
+    assert VirtualController.pack_serial_string(device, 3) == b'\x0a\x030\x000\x004\x002\x00'
+    assert VirtualController.pack_serial_string(device, 4) is None
+    assert bytearray(VirtualController.pack_device_descriptor(DummyDevice()))[16] == 0
+
+def test_describe_partials():
+    """ Test positional descriptors are described, and other positional arguments aren't guessed at """
+    descriptor = descriptors.Device(idVendor=0x1234, configurations=[descriptors.Configuration()])
+    assert DeviceFactory.describe(RoutedDevice).descriptor is RoutedDevice.template
+    assert DeviceFactory.describe(partial(RoutedDevice, descriptor)).descriptor.idVendor == 0x1234
+    assert DeviceFactory.describe(partial(RoutedDevice, device_descriptor=descriptor)) is not None
+    assert DeviceFactory.describe(partial(RoutedDevice, None, '0042')) is None
@@ -0,0 +1,51 @@
+""" Test USB descriptor templates """
+import pytest #pylint: disable=unused-import
+from virtusb import descriptors
+from virtusb.controller import VirtualDevice
+from tests.mocking.logging import configure #pylint:disable=unused-import
+from tests.mocking.dummy_device import DummyDevice
+
+def test_unfrozen_copies():
+    """ Test sub descriptors are copied until the descriptor is frozen """
+    config = descriptors.Configuration(interfaces=[descriptors.Interface()])
+    assert config.interfaces[0] is not config.interfaces[0]
+
+    config.freeze()
+    assert config.interfaces[0] is config.interfaces[0]
+    assert config.interfaces[0].frozen
+
+def test_lookup_without_children():
+    """ Test descriptors without sub descriptors to look up find nothing """
+    assert descriptors.Endpoint()._lookup(1) is None #pylint: disable=protected-access
+    assert descriptors.Interface()._lookup(1) is None #pylint: disable=protected-access
+
+def test_frozen_read_only():
+    """ Test frozen descriptors can't be modified """
+    device = descriptors.Device(configurations=[descriptors.Configuration()]).freeze()
+    with pytest.raises(AttributeError):
+        device.idVendor = 0x1234
+    with pytest.raises(AttributeError):
+        device.configurations[0].bConfigurationValue = 2
+    with pytest.raises(AttributeError):
+        device.clear_configurations()
+
+def test_devices_share_template():
+    """ Test devices share descriptors, but keep their own state """
+    first  = DummyDevice()
+    second = DummyDevice()
+    second.serial_number = '0002'
+    second.set_interface(0)
+
+    assert first.descriptor is second.descriptor
+    assert first.active_config is second.active_config
+    assert first.serial_number is None
+    assert second.alt_settings == {0: 0}
+
+def test_given_descriptor_copied():
+    """ Test a descriptor passed to a device isn't frozen in place """
+    descriptor = descriptors.Device(configurations=[descriptors.Configuration()])
+    device     = VirtualDevice(descriptor)
+    assert not descriptor.frozen
+    assert device.descriptor.frozen and device.descriptor is not descriptor
+    descriptor.idVendor = 0x1234
+    assert device.descriptor.idVendor != 0x1234
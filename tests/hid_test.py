@@ -0,0 +1,76 @@
+""" Test the HID device models """
+#pylint: disable=C0326
+import threading
+import pytest #pylint: disable=unused-import
+from virtusb import packets
+from virtusb.controller import VirtualController, URB_PENDING
+from virtusb.devices import hid
+from virtusb.devices.hid import HidDevice, KeyboardDevice, MouseDevice
+from virtusb.scheduler import Scheduler
+from tests.mocking.logging import configure #pylint:disable=unused-import
+
+def interrupt(device):
+    """ Submit an interrupt IN URB to the device """
+    packet = packets.UsbIpCmdSubmit(direction=1, endpoint=1, buffer_len=device.report_size)
+    return device.handle(packet)
+
+def control(controller, request_type, request, value, data=None):
+    """ Submit a control URB through the controller """
+    setup  = packets.UrbSetup(bmRequestType=request_type, bRequest=request, wValue=value, wLength=255)
+    packet = packets.UsbIpCmdSubmit(dev_id=0x10001, endpoint=0, direction=request_type >> 7,
+                                    setup=setup)
+    return controller.handle(packet, data)
+
+def test_descriptors():
+    """ Test the class and report descriptors are shared blobs """
+    controller = VirtualController()
+    controller.devices = [KeyboardDevice()]
+    report = control(controller, 0x81, 0x06, hid.HID_REPORT_DESCRIPTOR)
+    assert report is hid.KEYBOARD_REPORT_DESCRIPTOR
+    assert control(controller, 0x81, 0x06, hid.HID_DESCRIPTOR)[7] == len(report)
+    assert KeyboardDevice().descriptor is controller.devices[0].descriptor
+
+def test_keyboard_leds():
+    """ Test output reports reach the keyboard """
+    controller = VirtualController()
+    keyboard   = KeyboardDevice()
+    controller.devices = [keyboard]
+    control(controller, 0x21, hid.HID_SET_REPORT, 0x0200, b'\x02')
+    assert keyboard.leds == 0x02
+
+def test_report_interval():
+    """ Test reports are paced at bInterval, waking parked URBs on time """
+    scheduler = Scheduler()
+    scheduler.start()
+    try:
+        mouse = MouseDevice()
+        mouse.scheduler = scheduler
+        delivered = threading.Event()
+        completions = []
+        def listener(device, endpoint):
+            completions.append(device.pop_completion(endpoint))
+            delivered.set()
+        mouse.set_urb_listener(listener)
+
+        # Idle, the URB just waits without any timer
+        assert interrupt(mouse) is URB_PENDING
+        assert mouse._timer is None #pylint: disable=protected-access
+
+        mouse.move(x=500, y=-3)
+        assert completions == [b'\x00\x7f\xfd\x00']
+
+        # The next report has to wait out the interval
+        assert interrupt(mouse) is URB_PENDING
+        delivered.clear()
+        mouse.move(buttons=1)
+        assert not completions[1:]
+        assert delivered.wait(1)
+        assert completions[1] == b'\x01\x00\x00\x00'
+    finally:
+        scheduler.stop()
+
+def test_generic_report():
+    """ Test generic reports are handed out as queued """
+    device = HidDevice()
+    device.send_report(b'\x01' * 64)
+    assert interrupt(device) == b'\x01' * 64
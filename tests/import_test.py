@@ -0,0 +1,17 @@
+""" Test importing the package stays lightweight """
+#pylint: disable=C0326
+import subprocess
+import sys
+import pytest #pylint: disable=unused-import
+
+def loaded_after(statement, modules):
+    """ Run the statement in a fresh interpreter, and return which modules it loaded """
+    check = '{}; import sys; print(",".join(m for m in {!r} if m in sys.modules))'.format(
+        statement, modules)
+    out = subprocess.check_output([sys.executable, '-c', check])
+    return [module for module in out.decode('utf-8').strip().split(',') if module]
+
+def test_lazy_imports():
+    """ Test the CLI and spec loader don't load the packet codec or server engine """
+    heavy = ['packeteer', 'virtusb.packets', 'virtusb.server', 'subprocess', 'logging.config']
+    assert loaded_after('import virtusb.cli, virtusb.spec, virtusb.controller', heavy) == []
@@ -0,0 +1,106 @@
+""" Test the mass storage device model """
+#pylint: disable=C0326,redefined-outer-name
+import struct
+import pytest #pylint: disable=unused-import
+from virtusb import packets
+from virtusb.client import VirtualDriver
+from virtusb.controller import URB_PENDING, FileRegion
+from virtusb.devices import mass_storage
+from virtusb.devices.mass_storage import MassStorageDevice, CBW, CSW
+from tests.mocking.logging import configure #pylint:disable=unused-import
+
+BLOCKS = 64
+
+@pytest.fixture
+def disk(tmpdir):
+    """ Mass storage device on a small zeroed disk image """
+    image = tmpdir.join('disk.img')
+    image.write_binary(b'\x00' * 512 * BLOCKS)
+    device = MassStorageDevice(str(image))
+    yield device
+    device.close()
+
+def bulk(device, direction, size, data=None):
+    """ Submit a bulk URB to the device """
+    endpoint = 1 if direction == 1 else 2
+    packet = packets.UsbIpCmdSubmit(direction=direction, endpoint=endpoint, buffer_len=size)
+    return device.handle(packet, data)
+
+def command(device, block, length=0, data_in=True, data=None):
+    """ Run a command through all Bulk-Only phases, returning the data-in and status """
+    flags = mass_storage.CBW_DATA_IN if data_in else 0x00
+    cbw = CBW.pack(mass_storage.CBW_SIGNATURE, 7, length, flags, 0, len(block), block)
+    bulk(device, 0, len(cbw), cbw)
+
+    result = None
+    if length and data_in:
+        result = bytes(bulk(device, 1, length))
+    elif length:
+        bulk(device, 0, len(data), data)
+
+    _, tag, residue, status = CSW.unpack(bulk(device, 1, CSW.size))
+    assert tag == 7
+    return result, residue, status
+
+def test_inquiry(disk):
+    """ Test the device identifies itself """
+    data, residue, status = command(disk, b'\x12\x00\x00\x00\x24\x00', 36)
+    assert status == mass_storage.CSW_PASSED
+    assert residue == 0
+    assert data[8:16] == b'virtusb '
+
+def test_read_capacity(disk):
+    """ Test the capacity matches the image """
+    data, _, _ = command(disk, b'\x25' + b'\x00' * 9, 8)
+    assert struct.unpack('>II', data) == (BLOCKS - 1, 512)
+
+def test_write_read(disk):
+    """ Test written blocks read back """
+    payload = bytes(bytearray(range(256))) * 4
+    write = struct.pack('>BBIBHB', 0x2a, 0, 3, 0, 2, 0)
+    _, _, status = command(disk, write, len(payload), data_in=False, data=payload)
+    assert status == mass_storage.CSW_PASSED
+
+    read = struct.pack('>BBIBHB', 0x28, 0, 3, 0, 2, 0)
+    data, _, status = command(disk, read, len(payload))
+    assert status == mass_storage.CSW_PASSED
+    assert data == payload
+
+def test_out_of_range(disk):
+    """ Test bad commands fail, and report why """
+    read = struct.pack('>BBIBHB', 0x28, 0, BLOCKS, 0, 1, 0)
+    data, residue, status = command(disk, read, 512)
+    assert status == mass_storage.CSW_FAILED
+    assert data == b''
+    assert residue == 512
+
+    sense, _, _ = command(disk, b'\x03\x00\x00\x00\x12\x00', 18)
+    assert (sense[2], sense[12]) == (0x05, 0x21)
+
+def test_status_parked(disk):
+    """ Test status reads that arrive early are completed later """
+    completions = []
+    disk.set_urb_listener(lambda dev, ep: completions.append(dev.pop_completion(ep)))
+    assert bulk(disk, 1, CSW.size) is URB_PENDING
+
+    cbw = CBW.pack(mass_storage.CBW_SIGNATURE, 9, 0, 0, 0, 6, b'\x00' * 6)
+    bulk(disk, 0, len(cbw), cbw)
+    assert CSW.unpack(completions[0])[1] == 9
+
+def test_sendfile(disk, controller, client):
+    """ Test reads are sent straight from the image file through the server """
+    payload = bytes(bytearray(range(256))) * 2
+    disk._file.seek(512 * 5) #pylint: disable=protected-access
+    disk._file.write(payload) #pylint: disable=protected-access
+    disk._file.flush() #pylint: disable=protected-access
+
+    read = struct.pack('>BBIBHB', 0x28, 0, 5, 0, 1, 0)
+    cbw = CBW.pack(mass_storage.CBW_SIGNATURE, 9, 512, mass_storage.CBW_DATA_IN, 0, 10, read)
+    assert isinstance(disk.scsi(bytearray(read), 512), FileRegion)
+
+    controller.devices = [disk]
+    driver = VirtualDriver(client, client.attach('1-1')['port'])
+    driver.write(mass_storage.EP_BULK_OUT, cbw)
+    assert driver.read(mass_storage.EP_BULK_IN, 512) == payload
+    _, tag, residue, status = CSW.unpack(driver.read(mass_storage.EP_BULK_IN, CSW.size))
+    assert (tag, residue, status) == (9, 0, mass_storage.CSW_PASSED)
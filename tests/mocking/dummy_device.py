@@ -1,7 +1,7 @@
 """ Mock USB device for testing """
 #pylint: disable=C0326,R0205
 from virtusb import descriptors
-from virtusb.controller import VirtualDevice
+from virtusb.controller import VirtualDevice, URB_PENDING
 
 class DummyDevice(VirtualDevice):
     """ Mock device for testing purposes """
@@ -40,6 +40,23 @@ class DummyDevice(VirtualDevice):
                 )]
             )]
         )]
-    )
+    ).freeze()
+    def __init__(self, serial_number=None):
+        super(DummyDevice, self).__init__(self._dummy_descriptor, serial_number)
+
+class ParkingDevice(DummyDevice):
+    """ Mock device that parks every non-control URB until completed """
+    def handle(self, packet, data=None):
+        return URB_PENDING
+
+class EchoDevice(DummyDevice):
+    """ Mock device that echoes OUT data back on the next IN URB """
     def __init__(self):
-        super(DummyDevice, self).__init__(self._dummy_descriptor)
+        super(EchoDevice, self).__init__()
+        self.last = b''
+
+    def handle(self, packet, data=None):
+        if packet['direction'] == 0:
+            self.last = data
+            return None
+        return self.last
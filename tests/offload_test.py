@@ -0,0 +1,121 @@
+""" Test offloading devices to worker processes """
+#pylint: disable=C0326
+import errno
+import threading
+import pytest #pylint: disable=unused-import
+from virtusb import packets
+from virtusb.controller import URB_PENDING
+from virtusb.ring import ByteRing
+from virtusb.offload import DevicePool, shared_memory
+from virtusb.server import error_status
+from virtusb.testing import loopback
+from virtusb.devices import hid
+from virtusb.devices.hid import KeyboardDevice
+from tests.mocking.logging import configure #pylint:disable=unused-import
+from tests.mocking.dummy_device import EchoDevice, ParkingDevice
+
+class FailingDevice(ParkingDevice):
+    """ Device failing OUT URBs, and parking IN ones """
+    def handle(self, packet, data=None):
+        if packet['direction'] == 0:
+            raise ValueError('Broken device')
+        return URB_PENDING
+
+def test_ring_wraps():
+    """ Test data survives wrapping around the end of the ring """
+    ring = ByteRing.allocate(8)
+    assert ring.write(b'abcdef') == 6
+    assert ring.read(4) == b'abcd'
+    assert ring.write(b'ghijklmn') == 6
+    assert len(ring) == 8
+    assert ring.free() == 0
+    assert ring.read() == b'efghijkl'
+
+def test_ring_records():
+    """ Test records are written all or nothing """
+    ring = ByteRing.allocate(16)
+    assert ring.write_record(b'12345678')
+    assert not ring.write_record(b'12345678')
+    assert ring.read_record() == b'12345678'
+    assert ring.write_record(b'')
+    assert ring.read_record() == b''
+
+@pytest.mark.skipif(shared_memory is None, reason='Requires multiprocessing.shared_memory')
+def test_offloaded_device():
+    """ Test URBs round trip through a worker process """
+    pool = DevicePool(workers=1, ring_size=1024)
+    try:
+        device = pool.add(EchoDevice)
+        assert device.descriptor.idVendor == 0xdead
+
+        completions = []
+        done = threading.Event()
+        def listener(dev, endpoint):
+            completions.append((endpoint, dev.pop_completion(endpoint)))
+            if len(completions) == 4:
+                done.set()
+        device.set_urb_listener(listener)
+
+        # Payloads that never fit in the ring still make it through
+        small = bytes(bytearray(range(256))) * 2
+        large = small * 4
+        for payload in (small, large):
+            out_urb = packets.UsbIpCmdSubmit(direction=0, endpoint=1, buffer_len=len(payload))
+            in_urb  = packets.UsbIpCmdSubmit(direction=1, endpoint=1, buffer_len=len(payload))
+            assert device.handle(out_urb, payload) is URB_PENDING
+            assert device.handle(in_urb) is URB_PENDING
+        assert done.wait(5)
+    finally:
+        pool.close()
+
+    assert completions == [(0x01, None), (0x81, small), (0x01, None), (0x81, large)]
+
+@pytest.mark.skipif(shared_memory is None, reason='Requires multiprocessing.shared_memory')
+def test_offloaded_errors(controller):
+    """ Test failing URBs get an error status, and parked ones can be unlinked """
+    pool = DevicePool(workers=1, ring_size=1024)
+    controller.devices = [pool.add(FailingDevice)]
+    try:
+        with loopback(controller) as (_, client):
+            client.attach('1-1')
+            failed = client.submit(0, endpoint=1, direction=0, buffer_len=4, data=b'data')
+            assert failed.result(5)[0]['status'] == 1
+
+            parked = client.submit(0, endpoint=1, direction=1, buffer_len=64)
+            response = client.unlink(0, parked).result(5)
+            assert response['status'] == error_status(errno.ECONNRESET)
+            assert parked.cancelled()
+    finally:
+        pool.close()
+
+class FillingEchoDevice(EchoDevice):
+    """ Echo device filling IN URBs into the worker's buffers """
+    def handle_into(self, packet, out_view):
+        out_view[:4] = b'fill'
+        return 4
+
+@pytest.mark.skipif(shared_memory is None, reason='Requires multiprocessing.shared_memory')
+def test_offloaded_control(controller):
+    """ Test class requests and filled IN URBs are handled by the worker's device """
+    pool = DevicePool(workers=1, ring_size=1024)
+    controller.devices = [pool.add(KeyboardDevice), pool.add(FillingEchoDevice)]
+    try:
+        with loopback(controller) as (_, client):
+            client.attach('1-1')
+            response, data = client.submit(
+                0, endpoint=0, direction=1, buffer_len=255, request_type=0x81, request=0x06,
+                value=hid.HID_REPORT_DESCRIPTOR).result(5)
+            assert response['status'] == 0
+            assert data == hid.KEYBOARD_REPORT_DESCRIPTOR
+
+            # Output reports reach the keyboard in the worker, and errors fail the URB
+            response, _ = client.submit(
+                0, endpoint=0, direction=0, buffer_len=1, request_type=0x21,
+                request=hid.HID_SET_REPORT, value=0x0200, data=b'\x02').result(5)
+            assert response['status'] == 0
+
+            client.attach('1-2')
+            _, data = client.submit(1, endpoint=1, direction=1, buffer_len=64).result(5)
+            assert data == b'fill'
+    finally:
+        pool.close()
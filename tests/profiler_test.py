@@ -0,0 +1,41 @@
+""" Test the sampling profiler """
+#pylint: disable=C0326
+import os
+import signal
+import time
+import pytest #pylint: disable=unused-import
+from virtusb.client import VirtualDriver
+from virtusb.testing import loopback
+from tests.client_test import CounterDevice
+from tests.mocking.logging import configure #pylint:disable=unused-import
+
+def test_profiler(controller, server, client):
+    """ Test the connection threads stacks are sampled while they're busy """
+    controller.devices = [CounterDevice()]
+    driver = VirtualDriver(client, client.attach('1-1')['port'])
+    profiler = server.start_profiler(interval=0.001)
+    while profiler.samples < 20:
+        driver.read(0x81, 4096)
+    assert server.stop_profiler() is profiler
+
+    assert not profiler.running
+    lines = profiler.collapsed().splitlines()
+    assert all(line.startswith('virtusb-') for line in lines)
+    assert any(line.startswith('virtusb-connection;') and 'handle_packets' in line
+               for line in lines)
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) >= 20
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason='No SIGUSR1')
+def test_profiler_signal(controller, tmpdir):
+    """ Test SIGUSR1 toggles the profiler, writing the stacks when it stops """
+    with loopback(controller, tcp=True) as (server, _):
+        server.profile_path = str(tmpdir.join('server.folded'))
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert server.profiler.running
+        while server.profiler.samples < 2:
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert not server.profiler.running
+
+    with open(server.profile_path) as handle:
+        assert 'virtusb-server;' in handle.read()
@@ -0,0 +1,83 @@
+""" Test the shared device scheduler """
+#pylint: disable=C0326
+import threading
+import pytest #pylint: disable=unused-import
+from virtusb import descriptors
+from virtusb.scheduler import Scheduler, endpoint_period, USB_SPEED_FULL, USB_SPEED_HIGH
+from tests.mocking.logging import configure #pylint:disable=unused-import
+from tests.mocking.dummy_device import DummyDevice
+
+def test_call_later():
+    """ Test one-shot callbacks run once """
+    scheduler = Scheduler()
+    fired = threading.Event()
+    scheduler.start()
+    try:
+        scheduler.call_later(0.01, fired.set)
+        assert fired.wait(1)
+    finally:
+        scheduler.stop()
+
+def test_call_every():
+    """ Test periodic callbacks run until cancelled """
+    scheduler = Scheduler()
+    ticks = []
+    done = threading.Event()
+    def tick():
+        ticks.append(1)
+        if len(ticks) == 5:
+            done.set()
+
+    scheduler.start()
+    try:
+        timer = scheduler.call_every(0.005, tick)
+        assert done.wait(1)
+        timer.cancel()
+        count = len(ticks)
+        cancelled = threading.Event()
+        scheduler.call_later(0.02, cancelled.set)
+        assert cancelled.wait(1)
+    finally:
+        scheduler.stop()
+
+    assert len(ticks) in (count, count + 1)
+
+def test_stop_from_callback():
+    """ Test a callback can stop the scheduler, without periodic timers being re-armed """
+    scheduler = Scheduler()
+    stopped = threading.Event()
+    def stop():
+        scheduler.stop()
+        stopped.set()
+
+    scheduler.start()
+    thread = scheduler._thread #pylint: disable=protected-access
+    scheduler.call_every(0.005, stop)
+    assert stopped.wait(1)
+    thread.join(1)
+    assert not thread.is_alive()
+    assert not scheduler._heap #pylint: disable=protected-access
+
+def test_endpoint_period():
+    """ Test bInterval is converted based on the transfer type and speed """
+    interrupt = descriptors.Endpoint(bEndpointAddress=0x81, bmAttributes=0x03, bInterval=4)
+    iso       = descriptors.Endpoint(bEndpointAddress=0x82, bmAttributes=0x01, bInterval=4)
+
+    assert endpoint_period(interrupt, USB_SPEED_FULL) == pytest.approx(0.004)
+    assert endpoint_period(iso,       USB_SPEED_FULL) == pytest.approx(0.008)
+    assert endpoint_period(interrupt, USB_SPEED_HIGH) == pytest.approx(0.001)
+
+def test_device_every_interval():
+    """ Test devices register with the scheduler they're given """
+    device = DummyDevice()
+    with pytest.raises(RuntimeError):
+        device.every_interval(0x01, lambda: None)
+
+    device.scheduler = Scheduler()
+    fired = threading.Event()
+    device.scheduler.start()
+    try:
+        device.every_interval(0x01, fired.set)
+        assert fired.wait(1)
+    finally:
+        device.scheduler.stop()
@@ -1,72 +1,360 @@
 """ Test base USBIP server components """
+import errno
+import socket
+import threading
+import time
 import pytest #pylint: disable=unused-import
-from virtusb.server import UsbIpServer
+from virtusb import server as server_module
+from virtusb.server import UsbIpServer, Limits, error_status
+from virtusb.shard import ShardedServer
 from virtusb.client import UsbIpClient
 from virtusb.controller import VirtualController
+from virtusb.devices.hid import KeyboardDevice
+from virtusb.testing import loopback
 from tests.mocking.logging import configure #pylint:disable=unused-import
-from tests.mocking.dummy_device import DummyDevice
+from tests.mocking.dummy_device import DummyDevice, ParkingDevice, EchoDevice
 
 #@pytest.mark.skip(reason="debugging...")
-def test_list_empty():
+def test_list_empty(client):
     """ Test listing all devices on an empty controller """
-    controller = VirtualController()
-    server = UsbIpServer(controller)
-    server.start()
-    client = UsbIpClient()
-
-    try:
-        devices = client.list()
-        assert len(devices) == 0 #pylint: disable=len-as-condition
-    finally:
-        server.stop()
+    devices = client.list()
+    assert len(devices) == 0 #pylint: disable=len-as-condition
 
 #@pytest.mark.skip(reason="debugging...")
-def test_list_single():
+def test_list_single(controller, client):
     """ Test listing all devices on a controller with a single device """
-    controller = VirtualController()
     controller.devices = [DummyDevice()]
-    server = UsbIpServer(controller)
-    server.start()
-    client = UsbIpClient()
-
-    try:
-        devices = client.list()
-        assert len(devices) == 1
-    finally:
-        server.stop()
-
+    devices = client.list()
     assert len(devices) == 1
 
-
 #@pytest.mark.skip(reason="debugging...")
-def test_list_multi():
+def test_list_multi(controller, client):
     """ Test listing all devices on a controller with multiple devices """
-    controller = VirtualController()
     controller.devices = [DummyDevice(), DummyDevice(), DummyDevice()]
-    server = UsbIpServer(controller)
-    server.start()
-    client = UsbIpClient()
+    devices = client.list()
+    assert len(devices) == 3
 
-    try:
+#@pytest.mark.skip(reason="debugging...")
+def test_list_tcp():
+    """ Test listing devices through a real TCP server on a free port """
+    controller = VirtualController()
+    controller.devices = [DummyDevice()]
+    with loopback(controller, tcp=True) as (server, client):
         devices = client.list()
-        assert len(devices) == len(controller.devices)
-    finally:
-        server.stop()
 
-    assert len(devices) == 3
+    assert server.address[1] != 3240
+    assert len(devices) == 1
 
 #@pytest.mark.skip(reason="debugging...")
-def test_attach_single():
+def test_attach_single(controller, client):
     """ Test attaching a single device """
+    controller.devices = [DummyDevice()]
+    device = client.attach('1-1')
+    assert device['port'] == 0
+
+#@pytest.mark.skip(reason="debugging...")
+def test_connections(controller, server, client):
+    """ Test listing reuses a pooled connection, and every port has it's own """
+    controller.devices = [DummyDevice(), DummyDevice()]
+    client.list()
+    client.list()
+    assert len(server.threads) == 1
+
+    client.attach('1-1')
+    client.attach('1-2')
+    client.list()
+    assert len(server.threads) == 3
+    assert [port['port'] for port in client.port()] == [0, 1]
+
+    client.detach(0)
+    assert client.attach('1-1')['port'] == 0
+
+#@pytest.mark.skip(reason="debugging...")
+def test_reconnect(controller, server, client):
+    """ Test a port whose connection dropped imports it's device again """
+    controller.devices = [EchoDevice()]
+    client.attach('1-1')
+    client._submit_handler(0, endpoint=2, buffer_len=4, data=b'ping') #pylint: disable=protected-access
+
+    # Drop the port's connection under the client
+    client._connections[0].socket.shutdown(socket.SHUT_RDWR) #pylint: disable=protected-access
+    _, data = client._submit_handler( #pylint: disable=protected-access
+        0, endpoint=1, direction=1, buffer_len=64)
+    assert data == b'ping'
+    assert len(server.threads) == 2
+
+#@pytest.mark.skip(reason="debugging...")
+def test_parked_urb(controller, client):
+    """ Test an IN URB waits for the device to complete it """
+    device = ParkingDevice()
+    controller.devices = [device]
+
+    client.attach('1-1')
+    timer = threading.Timer(0.1, device.complete, (0x81, b'\x01\x02'))
+    timer.start()
+    response, data = client._submit_handler( #pylint: disable=protected-access
+        port=0, endpoint=1, direction=1, buffer_len=64)
+    timer.join()
+
+    # Data queued before the URB arrives completes it right away
+    device.complete(0x81, b'\x03')
+    _, queued = client._submit_handler( #pylint: disable=protected-access
+        port=0, endpoint=1, direction=1, buffer_len=64)
+
+    assert response['actual_len'] == 2
+    assert data == b'\x01\x02'
+    assert queued == b'\x03'
+
+#@pytest.mark.skip(reason="debugging...")
+def test_pipelined_urbs(controller, client):
+    """ Test many URBs can be in flight, and complete out of order """
+    device = ParkingDevice()
+    controller.devices = [device]
+    client.attach('1-1')
+
+    first  = [client.submit(0, endpoint=1, direction=1, buffer_len=64) for _ in range(8)]
+    second = client.submit(0, endpoint=2, direction=1, buffer_len=64)
+    device.complete(0x82, b'second')
+    assert second.result(1)[1] == b'second'
+    assert not any(future.done() for future in first)
+
+    for idx in range(8):
+        device.complete(0x81, bytes(bytearray([idx])))
+    assert [future.result(1)[1] for future in first] == [bytes(bytearray([idx])) for idx in range(8)]
+
+#@pytest.mark.skip(reason="debugging...")
+def test_unlink(controller, client):
+    """ Test unlinking a parked URB cancels it, and unlinking a completed one doesn't """
+    device = ParkingDevice()
+    controller.devices = [device]
+    client.attach('1-1')
+
+    parked = client.submit(0, endpoint=1, direction=1, buffer_len=64)
+    response = client.unlink(0, parked).result(1)
+    assert response['status'] == error_status(errno.ECONNRESET)
+    assert parked.cancelled()
+
+    done = client.submit(0, endpoint=1, direction=1, buffer_len=64)
+    device.complete(0x81, b'data')
+    done.result(1)
+    assert client.unlink(0, done.seq_num).result(1)['status'] == 0
+
+class CompletingDevice(ParkingDevice):
+    """ Device already completing any URB that's unlinked """
+    def cancel(self, endpoint, packet):
+        threading.Timer(0.05, self.complete, (endpoint, b'late')).start()
+        return False
+
+#@pytest.mark.skip(reason="debugging...")
+def test_unlink_completing(controller, client):
+    """ Test unlinking an URB the device is completing answers once it's completed """
+    controller.devices = [CompletingDevice()]
+    client.attach('1-1')
+    parked = client.submit(0, endpoint=1, direction=1, buffer_len=64)
+    assert client.unlink(0, parked).result(1)['status'] == 0
+    assert parked.done()
+    assert parked.result()[1] == b'late'
+
+#@pytest.mark.skip(reason="debugging...")
+def test_unlink_tells_device(controller, client):
+    """ Test the device forgets unlinked URBs, so the next one gets it's data """
+    keyboard = KeyboardDevice()
+    controller.devices = [keyboard]
+    client.attach('1-1')
+    parked = client.submit(0, endpoint=1, direction=1, buffer_len=8)
+    assert client.unlink(0, parked).result(1)['status'] == error_status(errno.ECONNRESET)
+    assert keyboard._parked == 0 #pylint: disable=protected-access
+
+    keyboard.press([0x04])
+    _, report = client.submit(0, endpoint=1, direction=1, buffer_len=8).result(1)
+    assert report == b'\x00\x00\x04' + b'\x00' * 5
+
+#@pytest.mark.skip(reason="debugging...")
+def test_import_busy(controller, server, client, monkeypatch):
+    """ Test a device can only be imported by one connection at a time """
+    monkeypatch.setattr(server_module, 'CLAIM_TIMEOUT_SEC', 0.05)
+    controller.devices = [DummyDevice()]
+    client.attach('1-1')
+    with UsbIpClient(connect=server.connect) as other:
+        with pytest.raises(AssertionError):
+            other.attach('1-1')
+        client.detach(0)
+        assert other.attach('1-1')['port'] == 0
+
+#@pytest.mark.skip(reason="debugging...")
+def test_buffer_len_limit(controller):
+    """ Test oversized URBs are refused, with their data dropped to keep the stream in sync """
+    controller.devices = [EchoDevice()]
+    with loopback(controller, limits=Limits(max_buffer_len=256)) as (server, client):
+        client.attach('1-1')
+        big = client.submit(0, endpoint=1, direction=0, buffer_len=1000, data=b'x' * 1000)
+        assert big.result(1)[0]['status'] == error_status(errno.EMSGSIZE)
+
+        client.submit(0, endpoint=1, direction=0, buffer_len=4, data=b'echo').result(1)
+        _, data = client.submit(0, endpoint=1, direction=1, buffer_len=4).result(1)
+        assert data == b'echo'
+        assert server.metrics.get('limits.buffer_len') == 1
+
+#@pytest.mark.skip(reason="debugging...")
+def test_in_flight_limit(controller):
+    """ Test a connection stops reading URBs while too many are parked """
+    device = ParkingDevice()
+    controller.devices = [device]
+    with loopback(controller, limits=Limits(max_in_flight=2)) as (server, client):
+        client.attach('1-1')
+        futures = [client.submit(0, endpoint=1, direction=1, buffer_len=64) for _ in range(4)]
+        deadline = time.time() + 5
+        while not server.metrics.get('limits.in_flight') and time.time() < deadline:
+            time.sleep(0.001)
+        assert server.metrics.get('limits.in_flight') == 1
+
+        for idx in range(4):
+            device.complete(0x81, bytes(bytearray([idx])))
+        assert [future.result(1)[1] for future in futures] == [b'\x00', b'\x01', b'\x02', b'\x03']
+
+#@pytest.mark.skip(reason="debugging...")
+def test_unlink_throttled(controller):
+    """ Test unlinks are still read while URBs are held back, for parked and held URBs alike """
+    device = ParkingDevice()
+    controller.devices = [device]
+    with loopback(controller, limits=Limits(max_in_flight=2)) as (_, client):
+        client.attach('1-1')
+        parked = [client.submit(0, endpoint=1, direction=1, buffer_len=64) for _ in range(2)]
+        held   = [client.submit(0, endpoint=1, direction=1, buffer_len=64) for _ in range(2)]
+        response = client.unlink(0, held[1]).result(1)
+        assert response['status'] == error_status(errno.ECONNRESET)
+        response = client.unlink(0, parked[0]).result(1)
+        assert response['status'] == error_status(errno.ECONNRESET)
+
+        device.complete(0x81, b'parked')
+        device.complete(0x81, b'held')
+        assert parked[1].result(1)[1] == b'parked'
+        assert held[0].result(1)[1] == b'held'
+        assert parked[0].cancelled() and held[1].cancelled()
+
+#@pytest.mark.skip(reason="debugging...")
+def test_device_in_flight_limit(controller):
+    """ Test a device with too many URBs parked only holds back it's own URBs """
+    busy, idle = ParkingDevice(), ParkingDevice()
+    controller.devices = [busy, idle]
+    with loopback(controller, limits=Limits(max_device_in_flight=1)) as (_, client):
+        client.attach('1-1')
+        client.attach('1-2')
+        first, second = [client.submit(0, endpoint=1, direction=1, buffer_len=64) for _ in range(2)]
+        other = client.submit(1, endpoint=1, direction=1, buffer_len=64)
+        idle.complete(0x81, b'idle')
+        assert other.result(1)[1] == b'idle'
+        assert not second.done()
+
+        busy.complete(0x81, b'first')
+        busy.complete(0x81, b'second')
+        assert first.result(1)[1] == b'first'
+        assert second.result(1)[1] == b'second'
+
+class FillingDevice(DummyDevice):
+    """ Dummy device filling IN URBs into the server's buffers """
+    def __init__(self):
+        super(FillingDevice, self).__init__()
+        self.views = []
+
+    def handle_into(self, packet, out_view):
+        if packet['endpoint'] == 2:
+            return NotImplemented
+        self.views.append(out_view.obj)
+        out_view[:4] = b'fill'
+        return 4
+
+    def handle(self, packet, data=None):
+        return b'handled'
+
+#@pytest.mark.skip(reason="debugging...")
+def test_handle_into(controller, client):
+    """ Test IN URBs are filled into pooled buffers, or fall back to handle() """
+    device = FillingDevice()
+    controller.devices = [device]
+    client.attach('1-1')
+
+    for _ in range(2):
+        _, data = client._submit_handler( #pylint: disable=protected-access
+            0, endpoint=1, direction=1, buffer_len=512)
+        assert data == b'fill'
+    assert device.views[0] is device.views[1]
+
+    _, data = client._submit_handler( #pylint: disable=protected-access
+        0, endpoint=2, direction=1, buffer_len=512)
+    assert data == b'handled'
+
+#@pytest.mark.skip(reason="debugging...")
+def test_stop_idle_connection():
+    """ Test stopping doesn't wait on connected clients that are quiet """
     controller = VirtualController()
     controller.devices = [DummyDevice()]
     server = UsbIpServer(controller)
-    server.start()
-    client = UsbIpClient()
+    server.start('127.0.0.1', 0)
+    client = UsbIpClient(*server.address)
+    client.attach('1-1')
+
+    start = time.time()
+    server.stop()
+    assert time.time() - start < 0.5
+
+#@pytest.mark.skip(reason="debugging...")
+def test_stop_drains_parked_urbs():
+    """ Test URBs still parked after the drain deadline are failed on stopping """
+    controller = VirtualController()
+    controller.devices = [ParkingDevice()]
+    server = UsbIpServer(controller, drain_timeout=0.1)
+    server.start('127.0.0.1', 0)
+    client = UsbIpClient(*server.address)
+    client.attach('1-1')
+
+    future = client.submit(0, endpoint=1, direction=1, buffer_len=64)
+    time.sleep(0.05)
+
+    start = time.time()
+    server.stop()
+    elapsed = time.time() - start
+    response, _ = future.result(1)
+
+    assert 0.1 <= elapsed < 0.5
+    assert response['status'] == error_status(errno.ESHUTDOWN)
+
+#@pytest.mark.skip(reason="debugging...")
+def test_sharded_server():
+    """ Test devices are listed together and imported from their worker """
+    controller = VirtualController()
+    controller.devices = [DummyDevice(), DummyDevice(), DummyDevice()]
+    server = ShardedServer(controller, workers=2)
+    server.start('127.0.0.1', 0)
 
     try:
-        device = client.attach('1-1')
+        devices = UsbIpClient(*server.address).list()
+        device = UsbIpClient(*server.address).attach('1-2')
     finally:
         server.stop()
 
-    assert device['port'] == 0
+    assert len(devices) == 3
+    assert server.owner('1-2') == 1
+    assert device['device_id'] == (1 << 16) + 2
+
+class CountingDevice(DummyDevice):
+    """ Dummy device with a template, counting how many are built """
+    template = DummyDevice._dummy_descriptor #pylint: disable=protected-access
+    built    = 0
+
+    def __init__(self):
+        CountingDevice.built += 1
+        super(CountingDevice, self).__init__()
+
+#@pytest.mark.skip(reason="debugging...")
+def test_lazy_devices(controller, client):
+    """ Test devices are listed from their template, and only built when imported """
+    controller.add_devices(CountingDevice, 100)
+    devices = client.list()
+    listed  = CountingDevice.built
+    client.attach('1-5')
+
+    assert len(devices) == 100
+    assert listed == 0
+    assert CountingDevice.built == 1
+    assert isinstance(controller.devices[4], CountingDevice)
@@ -0,0 +1,76 @@
+""" Test the synthetic endpoint data sources """
+#pylint: disable=C0326
+import math
+import struct
+from functools import partial
+import pytest #pylint: disable=unused-import
+from virtusb import descriptors, packets
+from virtusb.devices import sources
+from virtusb.devices.sources import (PatternSource, CounterSource, WaveformSource, PrbsSource,
+                                     SourceDevice)
+from tests.mocking.logging import configure #pylint:disable=unused-import
+
+@pytest.fixture(params=['numpy', 'array'])
+def backend(request, monkeypatch):
+    """ Run with NumPy when it's installed, and always with the array fallback """
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(sources, 'numpy', None)
+        monkeypatch.setattr(sources, '_PERIODS', {})
+    return request.param
+
+def test_pattern():
+    """ Test patterns continue across reads of any size """
+    source = PatternSource(b'abc')
+    data = b''.join(bytes(source.read(size)) for size in (1, 5, 100000, 2))
+    assert data == (b'abc' * 40000)[:100008]
+
+def test_counter(backend): #pylint: disable=unused-argument,redefined-outer-name
+    """ Test counters count on and wrap """
+    source = CounterSource(width=2, start=0xfffe)
+    assert struct.unpack('<4H', source.read(9)) == (0xfffe, 0xffff, 0, 1)
+    assert struct.unpack('<H', source.read(2)) == (2,)
+
+    # Counting down, and the widest counters, wrap the same way
+    source = CounterSource(width=1, start=1, step=-1)
+    assert struct.unpack('<3B', source.read(3)) == (1, 0, 0xff)
+    source = CounterSource(width=8, start=(1 << 64) - 1)
+    assert struct.unpack('<2Q', source.read(16)) == ((1 << 64) - 1, 0)
+
+def test_pattern_list():
+    """ Test patterns can be given as lists of byte values """
+    assert bytes(PatternSource([1, 2, 3]).read(4)) == b'\x01\x02\x03\x01'
+
+def test_waveform(backend): #pylint: disable=unused-argument,redefined-outer-name
+    """ Test sampled waves repeat each cycle """
+    source = WaveformSource('sine', frequency=1000, sample_rate=8000, amplitude=1000, channels=2)
+    samples = struct.unpack('<32h', source.read(64))
+    expected = [int(round(1000 * math.sin(2 * math.pi * idx / 8))) for idx in range(8)]
+    assert list(samples[0:16:2]) == expected
+    assert samples[1::2] == samples[0::2]
+    assert samples[16:] == samples[:16]
+    assert len(source.read(7)) == 4
+
+def test_prbs(backend): #pylint: disable=unused-argument,redefined-outer-name
+    """ Test PRBS patterns have their maximal length period """
+    source = PrbsSource(7)
+    period = bytes(source.read(127))
+    assert bytes(source.read(127)) == period
+    bits = ''.join('{:08b}'.format(byte) for byte in bytearray(period))
+    assert all(bits[:127].find(bits[idx:idx + 7]) == idx for idx in range(120))
+
+class SensorDevice(SourceDevice):
+    """ Dummy device streaming a counter """
+    template = descriptors.Device(configurations=[descriptors.Configuration(
+        interfaces=[descriptors.Interface(
+            endpoints=[descriptors.Endpoint(bEndpointAddress=0x81, bmAttributes=0x02)])])])
+    sources  = {0x81: partial(CounterSource, width=1)}
+
+def test_source_device():
+    """ Test sources attach to endpoints declaratively """
+    device = SensorDevice()
+    packet = packets.UsbIpCmdSubmit(direction=1, endpoint=1, buffer_len=4)
+    assert bytes(device.dispatch(packet)) == b'\x00\x01\x02\x03'
+    assert bytes(device.dispatch(packet)) == b'\x04\x05\x06\x07'
+    assert SensorDevice().endpoint_sources[0x81] is not device.endpoint_sources[0x81]
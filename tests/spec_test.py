@@ -0,0 +1,77 @@
+""" Test declarative device specs """
+#pylint: disable=C0326,redefined-outer-name
+import json
+import pytest #pylint: disable=unused-import
+from virtusb import spec
+from virtusb.__main__ import get_device_main
+from virtusb.controller import VirtualController
+from tests.mocking.logging import configure #pylint:disable=unused-import
+
+SPEC = {
+    'name':     'serial',
+    'count':    3,
+    'idVendor': '0x0525',
+    'idProduct': 42151,
+    'configurations': [{
+        'bConfigurationValue': 1,
+        'interfaces': [
+            {'bInterfaceClass': 2, 'class_descriptors': ['05 24 00 10 01'],
+             'endpoints': [{'bEndpointAddress': '0x83', 'bmAttributes': 3}]},
+            {'bInterfaceNumber': 1, 'bInterfaceClass': '0x0a',
+             'endpoints': [{'bEndpointAddress': '0x81'}, {'bEndpointAddress': '0x02'}]},
+        ],
+    }],
+}
+
+@pytest.fixture
+def spec_path(tmpdir):
+    """ Spec written to a JSON file """
+    path = tmpdir.join('serial.json')
+    path.write(json.dumps(SPEC))
+    return str(path)
+
+def test_compile(spec_path, tmpdir):
+    """ Test specs compile to templates with every blob packed """
+    compiled = spec.load_spec(spec_path, str(tmpdir.join('cache')))
+    assert compiled.count == 3
+    config = compiled.descriptor.configurations[0]
+    assert config.bNumInterfaces == 2
+    assert config.wTotalLength == 9 + 9 + 5 + 7 + 9 + 7 + 7
+    assert len(config.packed) == config.wTotalLength
+
+    device = compiled(serial_number='A1')
+    assert device.descriptor is compiled.descriptor
+    assert VirtualController.pack_config_descriptor(device) is config.packed
+
+def test_cache(spec_path, tmpdir, monkeypatch):
+    """ Test unchanged specs load from the cache """
+    cache = str(tmpdir.join('cache'))
+    first = spec.load_spec(spec_path, cache)
+    def fail(*args):
+        raise AssertionError('Spec was compiled again')
+    monkeypatch.setattr(spec, 'compile_spec', fail)
+    cached = spec.load_spec(spec_path, cache)
+    assert cached.digest == first.digest
+    assert cached.descriptor.configurations[0].packed == first.descriptor.configurations[0].packed
+    assert cached().descriptor.frozen
+
+@pytest.mark.parametrize('change, error', [
+    ({'bogus': 1}, 'unknown fields bogus'),
+    ({'idVendor': '0x10000'}, 'spec.idVendor'),
+    ({'configurations': []}, 'at least one configuration'),
+    ({'configurations': [{'interfaces': [{'class_descriptors': ['05 24 00']}]}]},
+     'spec.configurations[0].interfaces[0].class_descriptors[0]'),
+])
+def test_invalid(change, error):
+    """ Test invalid specs say what's wrong, and where """
+    data = dict(SPEC, **change)
+    with pytest.raises(RuntimeError) as info:
+        spec.compile_spec(data)
+    assert error in str(info.value)
+
+def test_main_from_path(tmpdir):
+    """ Test device scripts are loaded by path, and specs by the spec loader """
+    script = tmpdir.join('device_script.py')
+    script.write('def main(*args):\n    return args\n')
+    assert get_device_main(str(script))('-n', '2') == ('-n', '2')
+    assert get_device_main('devices.json').func is spec.main
@@ -0,0 +1,71 @@
+""" Test per URB stage tracing """
+#pylint: disable=C0326
+import json
+import threading
+import time
+import pytest #pylint: disable=unused-import
+from virtusb.client import VirtualDriver
+from virtusb.trace import Tracer, Histogram
+from tests.client_test import CounterDevice
+from tests.mocking.dummy_device import ParkingDevice
+from tests.mocking.logging import configure #pylint:disable=unused-import
+
+def wait_events(tracer, count):
+    """ Wait for URBs to be recorded, which happens just after they're responded to """
+    deadline = time.time() + 5
+    while len(tracer.events) < count and time.time() < deadline:
+        time.sleep(0.001)
+
+def test_stages(controller, server, client, tmpdir):
+    """ Test every stage of an URB is timed, and dumped as trace events """
+    controller.devices = [CounterDevice()]
+    driver = VirtualDriver(client, client.attach('1-1')['port'])
+    tracer = Tracer()
+    server.set_tracer(tracer)
+    assert len(driver.read(0x81, 16)) == 16
+    wait_events(tracer, 1)
+
+    stages = [stage for (_, endpoint, stage) in tracer.histograms if endpoint == 0x81]
+    assert stages == ['recv', 'parse', 'controller', 'device', 'pack', 'send']
+    assert '0x81' in tracer.summary()
+
+    path = str(tmpdir.join('trace.json'))
+    tracer.dump(path, fmt='chrome')
+    with open(path) as handle:
+        events = json.load(handle)['traceEvents']
+    assert [event['name'] for event in events] == ['urb'] + stages
+
+    server.set_tracer(None)
+    driver.read(0x81, 16)
+    assert len(tracer.events) == 1
+
+def test_parked(controller, server, client):
+    """ Test parked URBs are timed until their device completes them """
+    device = ParkingDevice()
+    controller.devices = [device]
+    client.attach('1-1')
+    tracer = Tracer(sample_every=2)
+    server.set_tracer(tracer)
+
+    futures = [client.submit(0, endpoint=1, direction=1, buffer_len=64) for _ in range(4)]
+    timer = threading.Timer(0.05, lambda: [device.complete(0x81, b'x') for _ in futures])
+    timer.start()
+    for future in futures:
+        future.result(timeout=5)
+    timer.join()
+    wait_events(tracer, 2)
+
+    assert len(tracer.events) == 2
+    assert tracer.histograms[(0x10001, 0x81, 'parked')].minimum >= 40000000
+    assert [stage for stage, _ in tracer.json_events()[0]['stages']] == [
+        'recv', 'parse', 'controller', 'device', 'parked', 'pack', 'send']
+
+def test_histogram():
+    """ Test percentiles are bounded by their bucket and the maximum """
+    histogram = Histogram()
+    for value in [100] * 98 + [5000, 9000]:
+        histogram.add(value)
+    assert histogram.percentile(0.5) == 128
+    assert histogram.percentile(0.99) == 8192
+    assert histogram.percentile(1.0) == 9000
+    assert histogram.mean() == 238
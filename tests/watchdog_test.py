@@ -0,0 +1,106 @@
+""" Test the slow device call watchdog """
+#pylint: disable=C0326
+import errno
+import threading
+import time
+import pytest #pylint: disable=unused-import
+from virtusb.controller import URB_PENDING
+from virtusb.server import error_status
+from virtusb.watchdog import Watchdog
+from tests.mocking.dummy_device import DummyDevice
+from tests.mocking.logging import configure #pylint:disable=unused-import
+
+class SlowDevice(DummyDevice):
+    """ Device stuck handling URBs until released, and slow to start """
+    def __init__(self, start_delay=0):
+        super(SlowDevice, self).__init__()
+        self.start_delay = start_delay
+        self.release     = threading.Event()
+
+    def start(self):
+        time.sleep(self.start_delay)
+
+    def handle(self, packet, data=None):
+        self.release.wait(5)
+        return b'late'
+
+def test_fail_slow_urb(controller, server, client):
+    """ Test a slow handler's URB is failed, and it's late result dropped """
+    device = SlowDevice()
+    controller.devices = [device]
+    client.attach('1-1')
+    server.set_watchdog(Watchdog(threshold=0.05, fail_urbs=True))
+
+    response, _ = client.submit(0, endpoint=1, direction=1, buffer_len=64).result(timeout=5)
+    assert response['status'] == error_status(errno.ETIMEDOUT)
+
+    # The connection carries on once the handler returns
+    device.release.set()
+    response, data = client.submit(0, endpoint=1, direction=1, buffer_len=64).result(timeout=5)
+    assert response['status'] == 0
+    assert data == b'late'
+
+    assert server.metrics.snapshot() == {'watchdog.slow_calls': 1, 'watchdog.failed_urbs': 1}
+    event = server.watchdog.events[0]
+    assert (event.label, event.device) == ('handle', '1-1')
+    assert 'self.release.wait(5)' in event.stack
+
+class SlowParkingDevice(DummyDevice):
+    """ Device completing it's first URB while too slow to park it, and parking the rest """
+    def __init__(self):
+        super(SlowParkingDevice, self).__init__()
+        self.release = threading.Event()
+        self.handled = 0
+
+    def handle(self, packet, data=None):
+        self.handled += 1
+        if self.handled == 1:
+            self.release.wait(5)
+            self.complete(0x81, b'stale')
+        return URB_PENDING
+
+    def cancel(self, endpoint, packet):
+        return False
+
+class BrokenDevice(DummyDevice):
+    """ Device failing with something other than a RuntimeError """
+    def handle(self, packet, data=None):
+        raise ValueError('Broken device')
+
+def test_slow_parked_urb(controller, server, client):
+    """ Test a slow handler's parked URB doesn't take the next URB's completion """
+    device = SlowParkingDevice()
+    controller.devices = [device]
+    client.attach('1-1')
+    server.set_watchdog(Watchdog(threshold=0.05, fail_urbs=True))
+
+    response, _ = client.submit(0, endpoint=1, direction=1, buffer_len=64).result(timeout=5)
+    assert response['status'] == error_status(errno.ETIMEDOUT)
+    device.release.set()
+
+    future = client.submit(0, endpoint=1, direction=1, buffer_len=64)
+    while device.handled < 2:
+        time.sleep(0.001)
+    device.complete(0x81, b'fresh')
+    assert future.result(timeout=5)[1] == b'fresh'
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_unwatch_on_error(controller, server, client):
+    """ Test calls stop being watched whatever their handler raises """
+    controller.devices = [BrokenDevice()]
+    client.attach('1-1')
+    server.set_watchdog(Watchdog(threshold=5, fail_urbs=True))
+
+    with pytest.raises(RuntimeError):
+        client.submit(0, endpoint=1, direction=1, buffer_len=64).result(timeout=5)
+    assert not server.watchdog._calls #pylint: disable=protected-access
+
+def test_report_slow_start(controller, server, client):
+    """ Test slow calls are only reported when URBs aren't failed """
+    controller.devices = [SlowDevice(start_delay=0.1)]
+    server.set_watchdog(Watchdog(threshold=0.02))
+    client.attach('1-1')
+
+    assert server.metrics.get('watchdog.slow_calls') == 1
+    assert server.metrics.get('watchdog.failed_urbs') == 0
+    assert server.watchdog.events[0].label == 'start'
@@ -3,7 +3,9 @@ from __future__ import unicode_literals
 import sys
 import os
 import argparse
-import importlib
+from functools import partial
+
+SPEC_EXTENSIONS = ('.json', '.yaml', '.yml')
 # from virtusb.server import UsbIpServer
 # from virtusb.controller import VirtualController
 
@@ -21,8 +23,22 @@ def get_device_path(args):
     return options.device
 
 def get_device_main(file):
-    """ Loads the given driver """
-    module = importlib.import_module(file)
+    """ Loads the given driver script, or a device spec """
+    # Specs are served by the spec loader
+    if file.endswith(SPEC_EXTENSIONS):
+        from virtusb import spec #pylint: disable=import-outside-toplevel
+        return partial(spec.main, file)
+
+    # Scripts are loaded by path, as they don't have to be on the import path
+    name = os.path.splitext(os.path.basename(file))[0]
+    if sys.version_info[0] >= 3:
+        import importlib.util #pylint: disable=import-outside-toplevel
+        module_spec = importlib.util.spec_from_file_location(name, file)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        import imp #pylint: disable=import-outside-toplevel
+        module = imp.load_source(name, file)
     callback = module.main
 
     return callback
@@ -33,10 +49,7 @@ def main():
     device_path = get_device_path(args)
     device_main = get_device_main(device_path)
 
-    if len(sys.argv) > 2:
-        args = sys.argv[3:]
-    else:
-        args = None
+    args = sys.argv[2:]
     device_main(*args)
 
 if __name__ == '__main__':
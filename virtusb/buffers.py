@@ -0,0 +1,47 @@
+""" Pool of reusable buffers for URB payloads """
+#pylint: disable=C0326,R0205
+from collections import deque
+
+MIN_SIZE  = 64
+MAX_SIZE  = 1 << 20 # Larger buffers are allocated as needed, never pooled
+MAX_FREE  = 16      # Free buffers kept per size
+
+class BufferPool(object):
+    """ Buffers in power of two sizes, handed out and given back per URB
+
+    Any thread may acquire and release buffers. Buffers larger than max_size
+    aren't kept, and at most max_free of each size are held on to.
+    """
+    def __init__(self, max_size=MAX_SIZE, max_free=MAX_FREE):
+        self.max_size = max_size
+        self.max_free = max_free
+        self._free    = {}
+
+    @staticmethod
+    def _capacity(size):
+        """ Round a size up to it's pool size """
+        if size <= MIN_SIZE:
+            return MIN_SIZE
+        return 1 << (size - 1).bit_length()
+
+    def acquire(self, size):
+        """ Fetch a buffer of at least size bytes """
+        capacity = self._capacity(size)
+        free = self._free.get(capacity)
+        if free:
+            try:
+                return free.pop()
+            except IndexError:
+                pass
+        return bytearray(capacity)
+
+    def release(self, buf):
+        """ Give a buffer back to the pool once nothing uses it anymore """
+        capacity = len(buf)
+        if capacity > self.max_size or capacity != self._capacity(capacity):
+            return
+        free = self._free.get(capacity)
+        if free is None:
+            free = self._free.setdefault(capacity, deque())
+        if len(free) < self.max_free:
+            free.append(buf)
@@ -2,10 +2,9 @@
 #pylint: disable=C0326,R0205
 from __future__ import unicode_literals
 import os
+import sys
 import argparse
 from virtusb import log
-from virtusb.server import UsbIpServer
-from virtusb.controller import VirtualController
 
 LOGGER = log.get_logger()
 
@@ -17,6 +16,9 @@ class Parser(object): #pylint: disable=too-few-public-methods
         self.parser.add_argument(
             '-n', '--count', type=int, default=1,
             help='Number of virtual devices to simulator')
+        self.parser.add_argument(
+            '-w', '--workers', type=int, default=0,
+            help='Run the devices in this many worker processes')
         self.parser.add_argument(
             '-v', '--verbose', action='count', default=0,
             help='Add more logging verbosity')
@@ -26,6 +28,8 @@ class Parser(object): #pylint: disable=too-few-public-methods
         if args is None:
             args = []
         options = self.parser.parse_args(args)
+        if options.workers and sys.version_info[0] < 3:
+            self.parser.error('--workers requires Python 3')
 
         # Set logging level based on verbosity
         if options.verbose == 0:
@@ -37,11 +41,24 @@ class Parser(object): #pylint: disable=too-few-public-methods
 
         return options
 
-def server_factory(device, count):
-    """ Generate a virtusb server """
+def server_factory(device, count, workers=0):
+    """ Generate a virtusb server, optionally offloading devices to worker processes """
+    # The server engine is only loaded once it's needed, so tools that just
+    #  parse arguments start quickly
+    #pylint: disable=import-outside-toplevel
+    from virtusb.server import UsbIpServer
+    from virtusb.controller import VirtualController
+    from virtusb.offload import DevicePool
+
     controller = VirtualController()
-    controller.devices = [device() for _ in range(count)]
     server = UsbIpServer(controller)
+    if workers:
+        pool = DevicePool(workers)
+        controller.devices = [pool.add(device) for _ in range(count)]
+        server.on_stop.append(pool.close)
+    else:
+        # Devices with a template are only built once they're imported
+        controller.add_devices(device, count)
 
     if os.getuid() == 0:
         #pylint: disable=line-too-long
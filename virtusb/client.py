@@ -1,71 +1,402 @@
 """ Client to test the USBIP server code base against """
 #pylint: disable=C0326,R0205
-import copy
+import errno
 import socket
+import struct
+import threading
+from collections import deque
+from concurrent.futures import Future
+from itertools import islice, repeat
 from virtusb import packets
 
-class VirtualDriver(object): #pylint: disable=too-few-public-methods
-    """ Driver base class """
+class VirtualDriver(object):
+    """ Driver base class, moving data through it's port's endpoints
+
+    Endpoints are given by address, with bit 7 set for IN endpoints. Large
+    transfers are split into URBs of up to max_transfer bytes, with up to
+    queue_depth of them in flight at once.
+    """
+    max_transfer = 16384
+    queue_depth  = 4
+
     def __init__(self, client, port):
         self.client = client
         self.port = port
+        self._kept = {} # Data of URBs completed past a short transfer, by endpoint
+
+    def submit(self, endpoint, size, data=None):
+        """ Submit a single URB to an endpoint, returning a future of it's response and data """
+        return self.client.submit(
+            self.port, endpoint=endpoint & 0x0f, direction=(endpoint >> 7) & 0x01,
+            buffer_len=size, data=data)
+
+    @staticmethod
+    def _wait(future):
+        """ Wait for an URB to complete, failing if it didn't succeed """
+        response, data = future.result()
+        if response['status'] != 0:
+            raise RuntimeError('URB {} failed with status {:#x}'.format(
+                future.seq_num, response['status']))
+        return response, data or b''
+
+    def control(self, request_type, request, value=0, index=0, data=None, length=0):
+        """ Make a control transfer, returning the data read by IN requests """
+        #pylint: disable=too-many-arguments
+        if data is not None:
+            length = len(data)
+        future = self.client.submit(
+            self.port, endpoint=0, direction=(request_type >> 7) & 0x01, buffer_len=length,
+            request_type=request_type, request=request, value=value, index=index, data=data)
+        return self._wait(future)[1]
+
+    def write(self, endpoint, data):
+        """ Write data to an OUT endpoint, returning how much was written """
+        view    = memoryview(data)
+        offsets = iter(range(0, len(view), self.max_transfer))
+        queue   = deque()
+        written = 0
+        while True:
+            for offset in islice(offsets, self.queue_depth - len(queue)):
+                chunk = view[offset:offset + self.max_transfer]
+                queue.append(self.submit(endpoint, len(chunk), chunk))
+            if not queue:
+                return written
+            response, _ = self._wait(queue.popleft())
+            written += response['actual_len']
+
+    def read(self, endpoint, size):
+        """ Read up to size bytes from an IN endpoint """
+        buf = bytearray(size)
+        return bytes(buf[:self.readinto(endpoint, buf)])
+
+    def readinto(self, endpoint, buf):
+        """ Read from an IN endpoint into buf, returning how many bytes were read
+
+        Reading stops at the first short transfer, like a host driver would.
+        URBs queued past it are unlinked, and any data they already got is
+        kept for the next read from the endpoint.
+        """
+        view      = memoryview(buf)
+        got, done = self._take_kept(endpoint, view)
+        if done:
+            return got
+
+        sizes = iter(self._sizes(len(view) - got, self.max_transfer))
+        queue = deque()
+        while True:
+            for size in islice(sizes, self.queue_depth - len(queue)):
+                queue.append((size, self.submit(endpoint, size)))
+            if not queue:
+                return got
+            size, future = queue.popleft()
+            _, data = self._wait(future)
+            view[got:got + len(data)] = data
+            got += len(data)
+            if len(data) < size:
+                break
+
+        unlinks = [self.client.unlink(self.port, future) for _, future in queue]
+        for (size, future), unlink in zip(queue, unlinks):
+            unlink.result()
+            if not future.cancelled():
+                _, data = self._wait(future)
+                self._kept.setdefault(endpoint, deque()).append((data, size))
+        return got
+
+    def _take_kept(self, endpoint, view):
+        """ Read kept data into view, returning how much, and if that ends the read
+
+        Kept transfers are read like newly completed ones, so a short one ends
+        the read, and whatever doesn't fit is kept for the next one.
+        """
+        kept = self._kept.get(endpoint) or ()
+        got  = 0
+        while kept:
+            if got == len(view):
+                return got, True
+            data, size = kept.popleft()
+            count = min(len(data), len(view) - got)
+            view[got:got + count] = data[:count]
+            got += count
+            if count < len(data):
+                kept.appendleft((data[count:], size - count))
+                return got, True
+            if len(data) < size:
+                return got, True
+        return got, got == len(view)
+
+    def stream(self, endpoint, total=None, transfer=None):
+        """ Stream data from an IN endpoint, yielding it as each URB completes
+
+        URBs of transfer bytes (max_transfer by default) adding up to total
+        bytes, or forever when it's None, are kept queue_depth deep. URBs still
+        queued when the generator is closed are unlinked.
+        """
+        transfer = transfer or self.max_transfer
+        sizes = repeat(transfer) if total is None else iter(self._sizes(total, transfer))
+        queue = deque()
+        try:
+            while True:
+                for size in islice(sizes, self.queue_depth - len(queue)):
+                    queue.append(self.submit(endpoint, size))
+                if not queue:
+                    return
+                yield self._wait(queue.popleft())[1]
+        finally:
+            for future in queue:
+                self.client.unlink(self.port, future)
+
+    @staticmethod
+    def _sizes(total, transfer):
+        """ Split a transfer into URB sizes """
+        return [min(transfer, total - offset) for offset in range(0, total, transfer)]
+
+class UsbIpConnection(object):
+    """ Connection to a USBIP server
+
+    OP_REQ requests are made synchronously with sendall() and recv(). Once a
+    device is imported, a reader thread takes over receiving, and URBs are
+    submitted with submit(), which returns a future of the response and it's
+    data. Any number of URBs can be in flight, completing in any order.
+    """
+    def __init__(self, sock):
+        self.socket        = sock
+        self.seq_num       = 1
+        self._send_lock    = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending      = {}
+        self._reader       = None
+        self._error        = None
+
+    def sendall(self, data):
+        """ Send data """
+        with self._send_lock:
+            self.socket.sendall(data)
+
+    def recv(self, size):
+        """ Receive size bytes of data, or less only if the server disconnects """
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = self.socket.recv(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def alive(self):
+        """ Check the server hasn't closed the connection """
+        if self._reader is not None:
+            return self._error is None
+        try:
+            return self.socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b''
+        except socket.error as error:
+            return error.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+    def start_reader(self):
+        """ Hand receiving over to a reader thread, to submit URBs asynchronously """
+        if self._reader is None:
+            self._reader = threading.Thread(target=self._read_loop)
+            self._reader.daemon = True
+            self._reader.start()
+
+    def submit(self, dev_id, endpoint=0, direction=0, transfer_flags=0, buffer_len=0,
+               setup=None, data=None):
+        """ Submit an URB, returning a future of it's USBIP_RET_SUBMIT response and data
+
+        The future's seq_num identifies the URB to unlink().
+        """
+        #pylint: disable=too-many-arguments
+        request = packets.UsbIpCmdSubmit(
+            dev_id         = dev_id,
+            direction      = direction,
+            endpoint       = endpoint,
+            transfer_flags = transfer_flags,
+            buffer_len     = buffer_len,
+            setup          = setup if setup is not None else packets.UrbSetup())
+        return self._request(request, data)
+
+    def unlink(self, dev_id, seq_num):
+        """ Unlink an in-flight URB, returning a future of the USBIP_RET_UNLINK response
+
+        The URB's own future is cancelled when it's unlinked before completing.
+        """
+        request = packets.UsbIpCmdUnlink(dev_id=dev_id, unlink_seq_num=seq_num)
+        return self._request(request)
+
+    def _request(self, request, data=None):
+        """ Send a request, tracking it until it's response arrives """
+        future = Future()
+        with self._send_lock:
+            future.seq_num = self.seq_num
+            self.seq_num += 1
+            request['seq_num'] = future.seq_num
+            with self._pending_lock:
+                if self._error is not None:
+                    raise RuntimeError('Connection is closed ({})'.format(self._error))
+                self._pending[future.seq_num] = (future, request)
+
+            raw = request.pack()
+            if data is not None:
+                raw += data
+            try:
+                self.socket.sendall(raw)
+            except socket.error:
+                self._pop(future.seq_num)
+                raise
+        return future
+
+    def _pop(self, seq_num):
+        """ Stop tracking a request, returning it's future and packet """
+        with self._pending_lock:
+            return self._pending.pop(seq_num, (None, None))
+
+    def _read_loop(self):
+        """ Complete futures as their responses arrive, until the connection closes """
+        error = RuntimeError('Connection closed by the server')
+        try:
+            while True:
+                raw = self.recv(48)
+                if len(raw) < 48:
+                    break
+                command = struct.unpack_from('>I', raw)[0]
+                if command == packets.USBIP_RET_SUBMIT:
+                    response = packets.UsbIpRetSubmit.from_raw(raw)
+                    future, request = self._pop(response['seq_num'])
+                    if future is None:
+                        raise RuntimeError('Response to unknown URB {}'.format(
+                            response['seq_num']))
+                    data = None
+                    if request['direction'] == 1 and response['actual_len'] > 0:
+                        data = self.recv(response['actual_len'])
+                    if not future.cancelled():
+                        future.set_result((response, data))
+                elif command == packets.USBIP_RET_UNLINK:
+                    response = packets.UsbIpRetUnlink.from_raw(raw)
+                    future, request = self._pop(response['seq_num'])
+                    if future is None:
+                        raise RuntimeError('Response to unknown unlink {}'.format(
+                            response['seq_num']))
+                    # A non-zero status means the URB was unlinked before completing
+                    if response['status'] != 0:
+                        unlinked, _ = self._pop(request['unlink_seq_num'])
+                        if unlinked is not None:
+                            unlinked.cancel()
+                    future.set_result(response)
+                else:
+                    raise RuntimeError('Unexpected USBIP command {:#06x}'.format(command))
+        except (RuntimeError, socket.error) as exc:
+            error = exc
+        self._fail(error)
+
+    def _fail(self, error):
+        """ Fail every request still in flight """
+        with self._pending_lock:
+            self._error = error
+            pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def close(self):
+        """ Close the connection, failing any requests still in flight """
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        if self._reader is not None and self._reader is not threading.current_thread():
+            self._reader.join()
+        self.socket.close()
+        self._fail(RuntimeError('Connection closed'))
 
 class UsbIpClient(object):
-    """ Fake USBIP client that has the same command set as the Linux usbip command """
-    def __init__(self):
-        self._server  = None
-        self._socket  = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._ports   = []
-        self._seq_num = 1
-        self._drivers = {}
+    """ Fake USBIP client that has the same command set as the Linux usbip command
+
+    Connects to the server at host:port, or through connect() when given,
+    which returns an already connected socket (See virtusb.testing).
+
+    Every attached port has a connection of it's own, which is reconnected
+    and the device imported again if it drops. Connections for listing are
+    kept in a pool of up to max_idle, and are reused by the next list() or
+    attach().
+    """
+    def __init__(self, host='127.0.0.1', port=3240, connect=None, max_idle=4):
+        self._address = (host, port)
+        self._connect_socket = connect
+        self._max_idle    = max_idle
+        self._lock        = threading.RLock()
+        self._idle        = []
+        self._ports       = {}
+        self._connections = {}
+        self._drivers     = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def add_driver(self, vendor_id, product_id, cls):
         """ Add a device driver the client can use to handle known devices """
         key = (vendor_id << 16) + product_id
         self._drivers[key] = cls
 
-    def _connected(self):
-        """ Test if the client socket is connected to the server """
-        return self._server is not None
-
-    def _connect(self, ip='127.0.0.1', port=3240): #pylint: disable=invalid-name
-        """ Connect the socket to the server """
-        if self._connected():
-            raise RuntimeError('Client socket already connected')
-        self._server = (ip, port)
-        self._socket.connect(self._server)
-
-    def _close(self):
-        """ Close the socket """
-        if not self._connected():
-            raise RuntimeError('Client socket has no connection to close')
-        self._socket.close()
-        self._server = None
-
-    def _sendall(self, data):
-        """ Send data. Keeps track of the sequence number """
-        if not self._connected():
-            raise RuntimeError('Client socket has no connection to send to')
-        self._socket.sendall(data)
-        self._seq_num += 1
-
-    def _recv(self, size):
-        """ Receive data """
-        if not self._connected():
-            raise RuntimeError('Client socket has no connection to read from')
-        return self._socket.recv(size)
-
-    def _list_handler(self):
+    def _open(self):
+        """ Open a new connection to the server """
+        if self._connect_socket is not None:
+            sock = self._connect_socket()
+        else:
+            sock = socket.create_connection(self._address)
+        return UsbIpConnection(sock)
+
+    def _acquire(self):
+        """ Fetch an idle connection from the pool, or open a new one """
+        with self._lock:
+            while self._idle:
+                connection = self._idle.pop()
+                if connection.alive():
+                    return connection
+                connection.close()
+        return self._open()
+
+    def _release(self, connection):
+        """ Return a connection that has nothing imported to the pool """
+        with self._lock:
+            if connection.alive() and len(self._idle) < self._max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def _port_connection(self, port, reconnect=False):
+        """ Fetch the connection of an attached port, importing it's device again if it dropped """
+        with self._lock:
+            connection = self._connections[port]
+            if not reconnect and connection.alive():
+                return connection
+            connection.close()
+            connection = self._open()
+            try:
+                self._import_handler(connection, self._ports[port]['bus_id'])
+            except Exception:
+                connection.close()
+                raise
+            connection.start_reader()
+            self._connections[port] = connection
+            return connection
+
+    @staticmethod
+    def _list_handler(connection):
         """ Handle getting the list of remote devices """
         # Request has no parameters, so a blank request will do
         request = packets.OpReqDevlist()
         data = request.pack()
-        self._sendall(data)
+        connection.sendall(data)
 
         # The response is dynamically sized, with no upper bound, so we need to
         #  get the data in chunks to figure out how much total data to fetch
         #  before building the corresponding packet
-        raw = self._recv(12)
+        raw = connection.recv(12)
         assert raw is not None
         response = packets.OpRepDevlist.from_raw(raw, partial=True)
         assert response['version'] == request['version']
@@ -74,12 +405,12 @@ class UsbIpClient(object):
 
         devices = []
         for _ in range(response['device_count']):
-            raw = self._recv(312)
+            raw = connection.recv(312)
             assert raw is not None
             device = packets.OpRepDevlist.Device.from_raw(raw, partial=True)
             ifaces = []
             for _ in range(device['iface_count']):
-                raw = self._recv(4)
+                raw = connection.recv(4)
                 iface = packets.OpRepDevlist.Device.Iface.from_raw(raw)
                 ifaces.append(iface)
             device['ifaces'] = ifaces
@@ -88,78 +419,108 @@ class UsbIpClient(object):
 
         return response
 
-    def _import_handler(self, bus_id):
+    @staticmethod
+    def _import_handler(connection, bus_id):
         """ Handle importing USB devices """
         request = packets.OpReqImport(bus_id=bus_id)
         data = request.pack()
-        self._sendall(data)
+        connection.sendall(data)
 
-        raw = self._recv(320)
+        raw = connection.recv(320)
         response = packets.OpRepImport.from_raw(raw)
         assert response['status'] == 0
 
         return response
 
-    def _submit_handler( #pylint: disable=too-many-arguments
+    def submit( #pylint: disable=too-many-arguments
             self, port,
             endpoint=0, direction=0, transfer_flags=0x00000000,
             buffer_len=0, request_type=0x00, request=0x00,
-            value=0x0000, data=None):
-        """ Handle submitting commands to an imported USB device """
-        # send the request based off the input arguments
-        request = packets.UsbIpCmdSubmit(
-            seq_num        = self._seq_num,
-            dev_id         = self._ports[port]['device_id'],
-            direction      = direction,
-            endpoint       = endpoint,
-            transfer_flags = transfer_flags,
-            buffer_len     = buffer_len,
-            setup = packets.UrbSetup(
-                bmRequestType = request_type,
-                bRequest      = request,
-                wValue        = value,
-                wIndex        = 0x0000,
-                wLength       = buffer_len
-                ))
-        raw = request.pack()
-        if data is not None:
-            raw += data
-        self._sendall(raw)
+            value=0x0000, index=0x0000, data=None):
+        """ Submit an URB to an imported USB device without waiting for it
+
+        Returns a future of the USBIP_RET_SUBMIT response and it's data.
+        """
+        setup = packets.UrbSetup(
+            bmRequestType = request_type,
+            bRequest      = request,
+            wValue        = value,
+            wIndex        = index,
+            wLength       = buffer_len if endpoint == 0 else 0)
+        args = (self._ports[port]['device_id'], endpoint, direction, transfer_flags,
+                buffer_len, setup, data)
+        try:
+            return self._port_connection(port).submit(*args)
+        # The connection dropped since it was last used
+        except (RuntimeError, socket.error):
+            return self._port_connection(port, reconnect=True).submit(*args)
+
+    def unlink(self, port, urb):
+        """ Unlink an URB submitted to a port, by it's future or sequence number
 
-        # Fetch the response packet
-        raw = self._recv(48)
-        response = packets.UsbIpRetSubmit.from_raw(raw)
+        Returns a future of the USBIP_RET_UNLINK response.
+        """
+        seq_num = getattr(urb, 'seq_num', urb)
+        return self._port_connection(port).unlink(self._ports[port]['device_id'], seq_num)
+
+    def _submit_handler(self, port, **kwargs):
+        """ Handle submitting commands to an imported USB device """
+        response, response_data = self.submit(port, **kwargs).result()
         assert response['status']      == 0
         assert response['error_count'] == 0
+        if response_data is not None:
+            assert len(response_data) <= kwargs.get('buffer_len', 0)
+        return response, response_data
 
-        # Fetch optional response data
-        response_data = None
-        if direction == 1:
-            size = response['actual_len']
-            if size > 0:
-                response_data = self._recv(size)
-                assert len(response_data) <= buffer_len
+    @staticmethod
+    def _parse_config_descriptor(raw):
+        """ Parse a full configuration descriptor, skipping class specific descriptors """
+        config = packets.ConfigurationDescriptor.from_raw(raw[:9], partial=True)
+        ifaces = []
+        start = config['bLength']
+        while start + 2 <= len(raw):
+            length, desc_type = struct.unpack_from('<BB', raw, start)
+            if length == 0:
+                break
+            part = raw[start:start + length]
+            if desc_type == 0x04:
+                iface = packets.InterfaceDescriptor.from_raw(part, partial=True)
+                iface['endpoints'] = []
+                ifaces.append([iface, []])
+            elif desc_type == 0x05 and ifaces:
+                ifaces[-1][1].append(packets.EndpointDescriptor.from_raw(part))
+            start += length
 
-        return response, response_data
+        for iface, endpoints in ifaces:
+            iface['endpoints'] = endpoints
+        config['interfaces'] = [iface for iface, _ in ifaces]
+        return config
 
     def list(self):
         """ List all available remote devices """
-        self._connect()
+        connection = self._acquire()
         try:
-            response = self._list_handler()
-        finally:
-            self._close()
+            response = self._list_handler(connection)
+        except Exception:
+            connection.close()
+            raise
+        self._release(connection)
         return response['devices']
 
     def attach(self, bus_id):
         """ Attach a device to a new port on the client """
-        self._connect()
+        connection = self._acquire()
+        new_port = None
         try:
             # Make import response
-            response = self._import_handler(bus_id)
-            new_port = len(self._ports)
+            response = self._import_handler(connection, bus_id)
+            connection.start_reader()
             device_id = (response['bus_no'] << 16) + response['device_no']
-            self._ports.append({'port': new_port, 'device_id': device_id})
+            with self._lock:
+                new_port = min(set(range(len(self._ports) + 1)) - set(self._ports))
+                self._ports[new_port] = {
+                    'port': new_port, 'bus_id': bus_id, 'device_id': device_id}
+                self._connections[new_port] = connection
 
             # The real USBIP requests descriptors after attaching. The requests
             #  are made twice, with different buffer lengths. The first request
@@ -186,7 +547,7 @@ class UsbIpClient(object):
             conf_desc = packets.ConfigurationDescriptor.from_raw(data, partial=True)
             kwargs['buffer_len'] = conf_desc['wTotalLength']
             response, data       = self._submit_handler(**kwargs)
-            conf_desc_full       = packets.ConfigurationDescriptor.from_raw(data)
+            conf_desc_full       = self._parse_config_descriptor(data)
             self._ports[new_port]['config_descriptor'] = conf_desc_full
 
             # Create a driver instance for this device on it's attached port
@@ -209,21 +570,33 @@ class UsbIpClient(object):
                 value          = conf_desc_full['bConfigurationValue'])
             return self._ports[new_port]
 
-        # Socket is kept alive after attaching, so only close it if something
-        #  goes wrong
+        # The port's connection is kept open after attaching, so only close it
+        #  if something goes wrong
         except Exception: #pylint: disable=broad-except
-            self._close()
+            with self._lock:
+                if new_port is not None:
+                    del self._ports[new_port]
+                    connection = self._connections.pop(new_port)
+            connection.close()
             raise
 
     def detach(self, port):
-        """ Detach a port from the client """
-        assert len(self._ports) >= port
-        del self._ports[port]
-
-        # Port closes if no attached devices remain
-        if not self._ports:
-            self._close()
+        """ Detach a port from the client, closing it's connection """
+        with self._lock:
+            del self._ports[port]
+            connection = self._connections.pop(port)
+        connection.close()
 
     def port(self):
         """ Fetch a list of ports with attached devices """
-        return copy.deepcopy(self._ports)
+        with self._lock:
+            return [dict(self._ports[port]) for port in sorted(self._ports)]
+
+    def close(self):
+        """ Detach every port and close all connections """
+        for port in list(self._ports):
+            self.detach(port)
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
@@ -1,10 +1,51 @@
 """ USB Virtual Controller """
 #pylint: disable=R0205,C0326
 from __future__ import unicode_literals
+import os
 import struct
-from virtusb import log, packets
+import threading
+from collections import deque
+from virtusb import descriptors, log
+from virtusb.scheduler import endpoint_period
 LOGGER = log.get_logger()
 
+# Returned by VirtualDevice.handle to park the URB until the device completes it
+URB_PENDING = object()
+
+class FileRegion(object):
+    """ Part of a file to answer an IN URB with, which the server sends with sendfile
+
+    Devices may return or complete URBs with one in place of bytes, and it
+    slices like the bytes it stands for.
+    """
+    __slots__ = ('file', 'offset', 'length')
+
+    def __init__(self, file_obj, offset, length):
+        self.file   = file_obj
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError('File regions can only be sliced')
+        start, stop, step = key.indices(self.length)
+        if step != 1:
+            raise ValueError('File regions can not be sliced with a step')
+        return FileRegion(self.file, self.offset + start, max(0, stop - start))
+
+    def __bytes__(self):
+        return self.read()
+
+    def read(self):
+        """ Read the region into memory, for when it can't be sent from the file """
+        if hasattr(os, 'pread'):
+            return os.pread(self.file.fileno(), self.length, self.offset)
+        self.file.seek(self.offset)
+        return self.file.read(self.length)
+
 # USB Request codes
 USB_REQ_GET_STATUS        = 0x00
 USB_REQ_GET_DESCRIPTOR    = 0x06
@@ -16,6 +57,12 @@ USB_REQ_SET_INTERFACE     = 0x0b
 # USB Descriptor values
 USB_DEVICE_DESCRIPTOR   = 0x0100
 USB_CONFIG_DESCRIPTOR   = 0x0200
+USB_STRING_DESCRIPTOR   = 0x03 # Type only, the string index is in the low byte
+SERIAL_STRING           = 3    # Index serial numbers are served at, unless the descriptor names one
+LANGUAGE_IDS            = b'\x04\x03\x09\x04' # String zero, English (US)
+
+# Endpoint transfer types, by the low bits of bmAttributes
+TRANSFER_TYPES = ('control', 'isochronous', 'bulk', 'interrupt')
 
 # USB Direction checks
 def host_to_device(request_type):
@@ -26,6 +73,28 @@ def device_to_host(request_type):
     """ Check if the direction is device to host """
     return (request_type & 0x80) == 0x80
 
+def standard_request(request_type):
+    """ Check if the request is a standard one, rather than class or vendor specific """
+    return (request_type & 0x60) == 0x00
+
+def endpoint_address(packet):
+    """ Build the endpoint address (0x81 for EP1 IN) of a submitted URB """
+    if packet['direction'] == 1:
+        return packet['endpoint'] | 0x80
+    return packet['endpoint']
+
+def cancel_parked(queue, packet):
+    """ Remove an URB's (seq_num, ...) entry from a device's queue of parked URBs
+
+    Returns False when it's gone already, as the device is completing it.
+    """
+    seq_num = packet['seq_num']
+    for entry in queue:
+        if entry[0] == seq_num:
+            queue.remove(entry)
+            return True
+    return False
+
 # USB Virtual Components
 class VirtualController(object):
     """ Virtual USB Controller """
@@ -33,9 +102,24 @@ class VirtualController(object):
         self.bus_no   = bus_no
         self.path     = path
         self.devices  = []
+        self.tracer   = None # Set by servers tracing URBs
+        self._lock    = threading.Lock()
+
+    def add_devices(self, factory, count=1):
+        """ Add count devices from a factory, only building them once they're used
+
+        Factories that can't describe their devices up front (No template)
+        are built right away.
+        """
+        placeholder = DeviceFactory.describe(factory)
+        if placeholder is None:
+            self.devices.extend(factory() for _ in range(count))
+        else:
+            # Placeholders hold no per device state, so every slot shares one
+            self.devices.extend([placeholder] * count)
 
     def get_device(self, device_id):
-        """ Fetch the device by it's id """
+        """ Fetch the device by it's id, building it if it's only a placeholder """
         bus_no     = device_id >> 16
         device_no  = device_id & 0x0000ffff
         device_idx = device_no - 1
@@ -43,7 +127,14 @@ class VirtualController(object):
         assert device_idx >= 0
         assert device_idx < len(self.devices)
 
-        return self.devices[device_idx]
+        device = self.devices[device_idx]
+        if isinstance(device, DeviceFactory):
+            with self._lock:
+                device = self.devices[device_idx]
+                if isinstance(device, DeviceFactory):
+                    LOGGER.debug('Building device %i-%i', bus_no, device_no)
+                    device = self.devices[device_idx] = device.build()
+        return device
 
     def handle(self, packet, data=None):
         """ Handle submitted URBs """
@@ -52,13 +143,20 @@ class VirtualController(object):
         device_id = packet['dev_id']
         device    = self.get_device(device_id)
         if packet['endpoint'] != 0:
-            return device.handle(packet, data)
+            if self.tracer is not None:
+                self.tracer.mark('controller')
+            return device.dispatch(packet, data)
 
         # Handle get descriptors
         setup    = packet['setup']
         req_type = setup['bmRequestType']
         request  = setup['bRequest']
         value    = setup['wValue']
+
+        # Class and vendor requests reuse the standard request codes
+        if not standard_request(req_type):
+            return self.device_request(device, packet, data)
+
         if device_to_host(req_type) and request == USB_REQ_GET_DESCRIPTOR:
             if value == USB_DEVICE_DESCRIPTOR:
                 LOGGER.debug('Descriptor request: DEVICE')
@@ -66,6 +164,10 @@ class VirtualController(object):
             if value == USB_CONFIG_DESCRIPTOR:
                 LOGGER.debug('Descriptor request: CONFIGURATION')
                 return self.pack_config_descriptor(device)
+            if value >> 8 == USB_STRING_DESCRIPTOR:
+                string = self.pack_serial_string(device, value & 0xff)
+                if string is not None:
+                    return string
 
         # Handle get status
         if device_to_host(req_type) and request == USB_REQ_GET_STATUS:
@@ -78,20 +180,61 @@ class VirtualController(object):
             device.set_configuration(value)
             return None
 
+        # The interface number is in wIndex's low byte, and it's alternate setting in wValue
         if host_to_device(req_type) and request == USB_REQ_SET_INTERFACE:
-            interface = value >> 1
-            LOGGER.debug('Set interface request: %i', interface)
-            device.set_interface(interface)
+            interface = setup['wIndex'] & 0xff
+            LOGGER.debug('Set interface request: %i alt %i', interface, value)
+            device.set_interface(interface, value)
             return None
 
+        return self.device_request(device, packet, data)
+
+    def handle_into(self, packet, out_view):
+        """ Let the device fill a non control IN URB into a server provided buffer
+
+        Returns the byte count, URB_PENDING, or NotImplemented when the device
+        doesn't, and handle() should take the URB.
+        """
+        return self.get_device(packet['dev_id']).dispatch_into(packet, out_view)
+
+    def device_request(self, device, packet, data=None):
+        """ Let the device handle class, vendor and any other requests it knows """
+        result = device.handle_control(packet, data)
+        if result is not NotImplemented:
+            return result
+
         # Report unhandled requests
         LOGGER.error('Unhandled request')
-        return self.unhandled_request(setup)
+        return self.unhandled_request(packet['setup'])
 
     @staticmethod
     def pack_device_descriptor(device):
-        """ Pack the devices descriptor into a packet """
+        """ Pack the devices descriptor into a packet, pointing at it's serial number if it has one """
         descriptor = device.descriptor
+        raw        = descriptor.packed
+        if raw is None:
+            raw = VirtualController._pack_device_template(descriptor)
+        if device.serial_number is not None and not descriptor.iSerialNumber:
+            # The template is shared, so the serial number's index is patched into a copy
+            raw = raw[:16] + struct.pack('<B', SERIAL_STRING) + raw[17:]
+        return raw
+
+    @staticmethod
+    def pack_serial_string(device, index):
+        """ Pack the language IDs or the serial number string, or None if it's not either """
+        if device.serial_number is None:
+            return None
+        if index == 0:
+            return LANGUAGE_IDS
+        if index != (device.descriptor.iSerialNumber or SERIAL_STRING):
+            return None
+        encoded = '{}'.format(device.serial_number).encode('utf-16-le')
+        return struct.pack('<BB', 2 + len(encoded), 0x03) + encoded
+
+    @staticmethod
+    def _pack_device_template(descriptor):
+        """ Pack a device descriptor, caching it if it's frozen """
+        from virtusb import packets #pylint: disable=import-outside-toplevel
         packet = packets.DeviceDescriptor(
             bLength            = descriptor.bLength,
             bDescriptorType    = descriptor.bDescriptorType,
@@ -108,28 +251,31 @@ class VirtualController(object):
             iSerialNumber      = descriptor.iSerialNumber,
             bNumConfigurations = descriptor.bNumConfigurations
         )
-        return packet.pack()
+        return descriptor.cache_packed(packet.pack())
 
     @staticmethod
     def pack_config_descriptor(device):
         """ Pack the devices configuration descriptor with interfaces and endpoints """
         LOGGER.debug('Descriptor request: CONFIGURATION')
 
-        # Build each interface, including their endpoints
+        # Build each interface, including their class specific descriptors and
+        #  endpoints. Class specific descriptors aren't packets, so each
+        #  descriptor is packed on it's own and the results joined.
         config = device.active_config
-        iface_packets = []
+        if config.packed is not None:
+            return config.packed
+        from virtusb import packets #pylint: disable=import-outside-toplevel
+        raw = packets.ConfigurationDescriptor(
+            bLength             = config.bLength,
+            bDescriptorType     = config.bDescriptorType,
+            wTotalLength        = config.wTotalLength,
+            bNumInterfaces      = config.bNumInterfaces,
+            bConfigurationValue = config.bConfigurationValue,
+            iConfiguration      = config.iConfiguration,
+            bmAttributes        = config.bmAttributes,
+            bMaxPower           = config.bMaxPower).pack()
         for iface in config.interfaces:
-            # Build each interfaces endpoints
-            ep_packets = []
-            for endpoint in iface.endpoints:
-                ep_packets.append(packets.EndpointDescriptor(
-                    bLength = endpoint.bLength,
-                    bDescriptorType = endpoint.bDescriptorType,
-                    bEndpointAddress = endpoint.bEndpointAddress,
-                    bmAttributes = endpoint.bmAttributes,
-                    wMaxPacketSize = endpoint.wMaxPacketSize,
-                    bInterval = endpoint.bInterval))
-            iface_packets.append(packets.InterfaceDescriptor(
+            raw += packets.InterfaceDescriptor(
                 bLength = iface.bLength,
                 bDescriptorType = iface.bDescriptorType,
                 bInterfaceNumber = iface.bInterfaceNumber,
@@ -138,21 +284,19 @@ class VirtualController(object):
                 bInterfaceClass = iface.bInterfaceClass,
                 bInterfaceSubClass = iface.bInterfaceSubClass,
                 bInterfaceProtocol = iface.bInterfaceProtocol,
-                iInterface = iface.iInterface,
-                endpoints = ep_packets))
-        # Build the config including all interfaces
-        packet = packets.ConfigurationDescriptor(
-            bLength             = config.bLength,
-            bDescriptorType     = config.bDescriptorType,
-            wTotalLength        = config.wTotalLength,
-            bNumInterfaces      = config.bNumInterfaces,
-            bConfigurationValue = config.bConfigurationValue,
-            iConfiguration      = config.iConfiguration,
-            bmAttributes        = config.bmAttributes,
-            bMaxPower           = config.bMaxPower,
-            interfaces          = iface_packets)
+                iInterface = iface.iInterface).pack()
+            for extra in iface.class_descriptors:
+                raw += extra
+            for endpoint in iface.endpoints:
+                raw += packets.EndpointDescriptor(
+                    bLength = endpoint.bLength,
+                    bDescriptorType = endpoint.bDescriptorType,
+                    bEndpointAddress = endpoint.bEndpointAddress,
+                    bmAttributes = endpoint.bmAttributes,
+                    wMaxPacketSize = endpoint.wMaxPacketSize,
+                    bInterval = endpoint.bInterval).pack()
 
-        return packet.pack()
+        return config.cache_packed(raw)
 
     @staticmethod
     def pack_status(device):
@@ -167,64 +311,304 @@ class VirtualController(object):
         LOGGER.debug('%s', repr(setup))
 
 class VirtualDevice(object):
-    """ Virtual USB Device """
-    def __init__(self, device_descriptor):
-        self.descriptor    = device_descriptor
+    """ Virtual USB Device
+
+    Descriptors are frozen into a template shared by every instance, so each
+    device only keeps it's active configuration, alternate settings and serial
+    number. Subclasses may declare the template as a class attribute rather
+    than passing a descriptor in. A descriptor that is passed in and isn't
+    frozen yet is left alone, and a frozen copy of it is used instead.
+
+    Devices given a serial number serve it as a string descriptor, at the
+    descriptor's iSerialNumber or at SERIAL_STRING when that isn't set.
+
+    URBs are routed to a handler named after their endpoint's transfer type
+    and direction (bulk_in, bulk_out, interrupt_in, isochronous_out, ...)
+    when the device has one, and to handle() otherwise.
+    """
+    template = None
+    speed    = 2 # Hardcoded full speed device
+
+    def __init__(self, device_descriptor=None, serial_number=None):
+        if device_descriptor is None:
+            device_descriptor = self.template
+            if device_descriptor is None:
+                raise RuntimeError('Device has no descriptor')
+            self.descriptor = device_descriptor.freeze()
+        else:
+            self.descriptor = device_descriptor.frozen_copy()
+        self.serial_number = serial_number
         self.active_config = None
         self.active_iface  = None
-        self.speed         = 2 # Hardcoded high speed device
+        self.alt_settings  = {}
         self.max_payload   = 64 # TODO: Dynamically set payload
+        self._completions  = {}
+        self._queued_bytes = {}
+        self._owed         = {} # Parked URBs per endpoint the device is yet to complete
+        self._urb_listener = None
+        self._urb_lock     = threading.Lock()
+        self._routes       = None # Built on the first URB after a configuration change
+        self.scheduler     = None # Provided by the server before starting
+        self.metrics       = None # Provided by the server before starting
+        self.max_queued    = None # Completion bytes queued per endpoint, set by the server
         self.set_configuration()
 
-    def _find_config_from_value(self, config_value):
-        """ Find a configuration descriptor instance from it's value """
-        for config in self.descriptor.configurations:
-            if config.bConfigurationValue == config_value:
-                return config
-        return None
-
-    def _find_iface_from_value(self, iface_value):
-        """ Find an interface descriptor instance from it's value """
-        if self.active_config is None:
-            raise RuntimeError('Attempted to look for interface before configuration was set')
-
-        for iface in self.active_config.interfaces:
-            if iface.bInterfaceNumber == iface_value:
-                return iface
-        return None
-
     def set_configuration(self, config_value=None):
         """ Set the active configuration to the given value """
         # If no value is given, use the first available configuration
         if config_value is None:
-            self.active_config = self.descriptor.configurations[0]
-            return
-
-        config = self._find_config_from_value(config_value)
+            config = self.descriptor.configurations[0]
+        else:
+            config = self.descriptor.find_configuration(config_value)
         if config is None:
             raise RuntimeError('Invalid config value')
         self.active_config = config
+        self.alt_settings  = {}
+        self._routes       = None
 
-    def set_interface(self, iface_value=None):
-        """ Set the active interface to the given value """
+    def set_interface(self, iface_value=None, alt_setting=0):
+        """ Select the alternate setting of an interface """
         if self.active_config is None:
             LOGGER.warning('Request to set interface before setting configuration. Using first configuration instance.')
             self.set_configuration()
 
         if iface_value is None:
-            self.active_iface = self.active_config.interfaces[0]
-            return
-
-        interface = self._find_iface_from_value(iface_value)
+            interface = self.active_config.interfaces[0]
+        else:
+            interface = self.active_config.find_interface(iface_value, alt_setting)
         if interface is None:
             raise RuntimeError('Invalid interface value')
         self.active_iface = interface
+        self.alt_settings[interface.bInterfaceNumber] = interface.bAlternateSetting
+        self._routes = None
+
+    @property
+    def routes(self):
+        """ Endpoint address to (endpoint descriptor, handler) for the active alternate settings """
+        routes = self._routes
+        if routes is None:
+            routes = self._routes = self._build_routes()
+        return routes
+
+    def _build_routes(self):
+        """ Build the routing table of the active configuration and alternate settings """
+        # Interfaces without a selected alternate setting use their first one
+        selected = {}
+        for iface in self.active_config.interfaces:
+            number = iface.bInterfaceNumber
+            alt    = self.alt_settings.get(number)
+            if alt == iface.bAlternateSetting or (alt is None and number not in selected):
+                selected[number] = iface
+
+        routes = {}
+        for iface in selected.values():
+            for endpoint in iface.endpoints:
+                address = endpoint.bEndpointAddress
+                name = '{}_{}'.format(TRANSFER_TYPES[endpoint.bmAttributes & 0x03],
+                                      'in' if address & 0x80 else 'out')
+                routes[address] = (endpoint, getattr(self, name, None) or self.handle)
+        return routes
+
+    def dispatch(self, packet, data=None):
+        """ Route a non control URB to it's endpoint's handler """
+        endpoint = endpoint_address(packet)
+        route    = self.routes.get(endpoint)
+        handler  = self.handle if route is None else route[1]
+        return self._owe(endpoint, handler, packet, data)
+
+    def dispatch_into(self, packet, out_view):
+        """ Let the device fill a non control IN URB into out_view, see handle_into() """
+        return self._owe(endpoint_address(packet), self.handle_into, packet, out_view)
+
+    def _owe(self, endpoint, handler, packet, data):
+        """ Call a handler, counting the URB as owed a completion if it's parked
+
+        The URB is counted while the handler runs, as the device may complete
+        it from another thread before the handler returns.
+        """
+        with self._urb_lock:
+            self._owed[endpoint] = self._owed.get(endpoint, 0) + 1
+        parked = False
+        try:
+            result = handler(packet, data)
+            parked = result is URB_PENDING
+            return result
+        finally:
+            if not parked:
+                self._settle(endpoint)
+
+    def _settle(self, endpoint):
+        """ Stop counting an URB on the endpoint as owed a completion """
+        with self._urb_lock:
+            owed = self._owed.get(endpoint, 0)
+            if owed:
+                self._owed[endpoint] = owed - 1
 
     def handle(self, packet, data=None):
-        """ Override this method to control how a USB device handles submit requests """
+        """ Override this method to control how a USB device handles submit requests
+
+        It gets every URB that doesn't have a transfer type handler.
+
+        Return URB_PENDING to park the URB on the server, and later finish it
+        with complete() once the device has data for it.
+        """
+
+    def handle_into(self, packet, out_view): #pylint: disable=unused-argument,no-self-use
+        """ Override this method to fill IN URBs into a buffer the server provides
+
+        out_view is a writable view of buffer_len bytes, which is only valid
+        until returning. Return the number of bytes written, URB_PENDING to
+        park the URB, or NotImplemented to have handle() take it instead.
+        """
+        return NotImplemented
+
+    def handle_control(self, packet, data=None): #pylint: disable=unused-argument,no-self-use
+        """ Override this method to handle control requests the controller doesn't
+
+        Return NotImplemented for requests the device doesn't handle either.
+        """
+        return NotImplemented
+
+    def complete(self, endpoint, data=None):
+        """ Complete the oldest parked URB on an endpoint address (0x81 for EP1 IN)
+
+        The data is queued until an URB arrives if none are parked, so devices
+        can push data at any time and from any thread. Completing with a
+        RuntimeError fails the URB instead.
+
+        Completions of URBs the device parked are always taken. Data pushed
+        ahead of any URB is refused once max_queued bytes are waiting on the
+        endpoint, returning False for the device to hold on to it or drop it.
+        """
+        size = 0
+        if data is not None and not isinstance(data, (FileRegion, RuntimeError)):
+            size = len(data)
+        with self._urb_lock:
+            queue = self._completions.get(endpoint)
+            if queue is None:
+                queue = self._completions[endpoint] = deque()
+            queued = self._queued_bytes.get(endpoint, 0)
+            owed   = self._owed.get(endpoint, 0)
+            if owed:
+                self._owed[endpoint] = owed - 1
+                refused = False
+            else:
+                refused = bool(queue) and self.max_queued is not None and \
+                    queued + size > self.max_queued
+            if not refused:
+                queue.append((data, size))
+                self._queued_bytes[endpoint] = queued + size
+            listener = self._urb_listener
+
+        if refused:
+            LOGGER.debug('Refused completion on endpoint %#04x, %i bytes queued', endpoint, queued)
+            if self.metrics is not None:
+                self.metrics.increment('limits.queued_bytes')
+            return False
+
+        # Let the server match the data up with a parked URB
+        if listener is not None:
+            listener(self, endpoint)
+        return True
+
+    def pop_completion(self, endpoint):
+        """ Fetch the oldest queued completion data. Raises IndexError when empty """
+        with self._urb_lock:
+            queue = self._completions.get(endpoint)
+            if not queue:
+                raise IndexError('No completions queued for endpoint {:#04x}'.format(endpoint))
+            data, size = queue.popleft()
+            self._queued_bytes[endpoint] -= size
+            return data
+
+    def find_endpoint(self, address):
+        """ Find an endpoint descriptor in the active configuration by it's address
+
+        Endpoints of the active alternate settings come first.
+        """
+        route = self.routes.get(address)
+        if route is not None:
+            return route[0]
+        for iface in self.active_config.interfaces:
+            for endpoint in iface.endpoints:
+                if endpoint.bEndpointAddress == address:
+                    return endpoint
+        return None
+
+    def every_interval(self, address, callback, *args):
+        """ Run the callback on the shared scheduler at the endpoints bInterval """
+        if self.scheduler is None:
+            raise RuntimeError('Device has no scheduler until it is imported')
+        endpoint = self.find_endpoint(address)
+        if endpoint is None:
+            raise RuntimeError('Invalid endpoint address {:#04x}'.format(address))
+        period = endpoint_period(endpoint, self.speed)
+        return self.scheduler.call_every(period, callback, *args)
+
+    def cancel(self, endpoint, packet): #pylint: disable=unused-argument,no-self-use
+        """ Override this method to forget a parked URB the host unlinked
+
+        Return True once the device won't complete it, or False when it's
+        completion is already on it's way, which the server then waits for.
+        """
+        return True
+
+    def unlink(self, endpoint, packet):
+        """ Have the device cancel a parked URB, returning what cancel() did """
+        cancelled = self.cancel(endpoint, packet)
+        if cancelled:
+            self._settle(endpoint)
+        return cancelled
+
+    def set_urb_listener(self, listener):
+        """ Set the callback notified with (device, endpoint) on every completion """
+        with self._urb_lock:
+            self._urb_listener = listener
 
     def start(self):
         """ Override this method for starting an optional device simulator """
 
     def stop(self):
         """ Override this method for stopping an optional device simulator """
+
+class DeviceFactory(object):
+    """ Stand in for a device that hasn't been built yet
+
+    It describes the device from the factory's frozen template, which is all
+    a device list needs. The controller builds the real device the first
+    time it's fetched, which is when it's imported.
+    """
+    __slots__ = ('factory', 'descriptor', 'active_config', 'speed')
+
+    def __init__(self, factory, descriptor):
+        self.factory       = factory
+        self.descriptor    = descriptor.freeze()
+        self.active_config = self.descriptor.configurations[0]
+        self.speed         = getattr(factory, 'speed', VirtualDevice.speed)
+
+    @classmethod
+    def describe(cls, factory):
+        """ Wrap a factory, or return None if it's devices can't be described before they're built """
+        # Device classes, compiled specs and partials of either
+        target     = getattr(factory, 'func', factory)
+        keywords   = getattr(factory, 'keywords', None) or {}
+        args       = getattr(factory, 'args', None) or ()
+        descriptor = keywords.get('device_descriptor')
+        if args:
+            # A positional descriptor comes first, and any other argument may change it
+            if not isinstance(args[0], descriptors.Device):
+                return None
+            descriptor = args[0]
+        if descriptor is not None:
+            # Like the devices it builds, leave the caller's descriptor editable
+            return cls(factory, descriptor.frozen_copy())
+        descriptor = getattr(target, 'descriptor', None)
+        if not isinstance(descriptor, descriptors.Device):
+            descriptor = getattr(target, 'template', None)
+        if descriptor is None:
+            return None
+        return cls(factory, descriptor)
+
+    def build(self):
+        """ Build the device """
+        return self.factory()
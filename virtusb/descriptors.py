@@ -2,8 +2,75 @@
 #pylint: disable=C0326,R0205,R0902,R0903
 import copy
 
-class Device(object):
+class Descriptor(object):
+    """ Base descriptor, which can be frozen into a template shared between devices """
+    _frozen   = False
+    _children = None # Name of the sub descriptor list attribute
+    _index    = None # Sub descriptors by key, cached once frozen
+    packed    = None # Serialized blob, cached once frozen
+
+    def __setattr__(self, name, value):
+        if self._frozen:
+            raise AttributeError('Frozen descriptors are read only')
+        super(Descriptor, self).__setattr__(name, value)
+
+    @property
+    def frozen(self):
+        """ Check if the descriptor is a read only template """
+        return self._frozen
+
+    def freeze(self):
+        """ Make this and all sub descriptors read only, so they can be shared without copies """
+        if self._frozen:
+            return self
+        if self._children is not None:
+            children = tuple(getattr(self, self._children))
+            for child in children:
+                child.freeze()
+            object.__setattr__(self, self._children, children)
+        object.__setattr__(self, '_frozen', True)
+        return self
+
+    def frozen_copy(self):
+        """ This descriptor if it's frozen, or a frozen copy leaving it editable """
+        if self._frozen:
+            return self
+        return copy.deepcopy(self).freeze()
+
+    def cache_packed(self, raw):
+        """ Keep the serialized blob of a frozen descriptor, so it's only packed once """
+        if self._frozen:
+            object.__setattr__(self, 'packed', raw)
+        return raw
+
+    def _lookup(self, key):
+        """ Find a sub descriptor by key, or None. The first one wins on duplicates
+
+        Descriptors with sub descriptors to look up define a _key method,
+        giving the key of each one. Those without never find any.
+        """
+        key_of = getattr(self, '_key', None)
+        if self._children is None or key_of is None:
+            return None
+        index = self._index
+        if index is None:
+            index = {}
+            for child in getattr(self, self._children):
+                index.setdefault(key_of(child), child)
+            if self._frozen:
+                object.__setattr__(self, '_index', index)
+        return index.get(key)
+
+    def _read_only(self, children):
+        """ Sub descriptors are shared once frozen, and copied before then """
+        if self._frozen:
+            return children
+        return copy.deepcopy(children)
+
+class Device(Descriptor):
     """ USB Device Descriptor """
+    _children = '_configurations'
+
     def __init__(self, **kwargs):
         #pylint: disable=invalid-name
         # Immutable values
@@ -35,7 +102,15 @@ class Device(object):
     @property
     def configurations(self):
         """ Property to force configurations to be read only """
-        return copy.deepcopy(self._configurations)
+        return self._read_only(self._configurations)
+
+    @staticmethod
+    def _key(child):
+        return child.bConfigurationValue
+
+    def find_configuration(self, value):
+        """ Find a configuration by it's bConfigurationValue, or None """
+        return self._lookup(value)
 
     def set_configurations(self, configurations):
         """ Set the list of configurations and dependent values """
@@ -48,8 +123,10 @@ class Device(object):
         self._configurations    = []
         self.bNumConfigurations = 0
 
-class Configuration(object):
+class Configuration(Descriptor):
     """ USB Configuration Descriptor """
+    _children = '_interfaces'
+
     def __init__(self, **kwargs):
         #pylint: disable=invalid-name
         # Immutable values
@@ -75,16 +152,27 @@ class Configuration(object):
     @property
     def interfaces(self):
         """ Property to force interfaces to be read only """
-        return copy.deepcopy(self._interfaces)
+        return self._read_only(self._interfaces)
+
+    @staticmethod
+    def _key(child):
+        return (child.bInterfaceNumber, child.bAlternateSetting)
+
+    def find_interface(self, number, alt_setting=0):
+        """ Find an interface by it's number and alternate setting, or None """
+        return self._lookup((number, alt_setting))
 
     def set_interfaces(self, interfaces):
         """ Set the list of interface descriptors and dependent values """
         assert isinstance(interfaces, (list, tuple))
         self._interfaces = interfaces
-        self.bNumInterfaces = len(interfaces)
+        # Alternate settings share their interface's number
+        self.bNumInterfaces = len(set(iface.bInterfaceNumber for iface in interfaces))
         self.wTotalLength = self.bLength
         for iface in self._interfaces:
             self.wTotalLength += iface.bLength
+            for extra in iface.class_descriptors:
+                self.wTotalLength += len(extra)
             for endpoint in iface.endpoints:
                 self.wTotalLength += endpoint.bLength
 
@@ -94,8 +182,10 @@ class Configuration(object):
         self.bNumInterfaces = 0
         self.wTotalLength   = self.bLength
 
-class Interface(object):
+class Interface(Descriptor):
     """ USB Interface Descriptor """
+    _children = '_endpoints'
+
     def __init__(self, **kwargs):
         #pylint: disable=invalid-name
         # Immutable values
@@ -103,7 +193,7 @@ class Interface(object):
         self.bDescriptorType = 0x04
 
         # TODO: Unsupported values
-        self.iInterface = kwargs.get("iInterface")
+        self.iInterface = kwargs.get("iInterface", 0)
 
         # Mutable values
         self.bInterfaceNumber   = kwargs.get("bInterfaceNumber",   0)
@@ -112,6 +202,10 @@ class Interface(object):
         self.bInterfaceSubClass = kwargs.get("bInterfaceSubClass", 0xff)
         self.bInterfaceProtocol = kwargs.get("bInterfaceProtocol", 0xff)
 
+        # Raw class specific descriptors (CDC functional, HID, ...), sent
+        #  between the interface and it's endpoints
+        self.class_descriptors = tuple(kwargs.get("class_descriptors", ()))
+
         # Sub descriptors
         self._endpoints    = None
         self.bNumEndpoints = None
@@ -122,7 +216,7 @@ class Interface(object):
     @property
     def endpoints(self):
         """ Property to force endpoints to be read only """
-        return copy.deepcopy(self._endpoints)
+        return self._read_only(self._endpoints)
 
     def set_endpoints(self, endpoints):
         """ Set the list of endpoint descriptors and dependent values """
@@ -135,7 +229,7 @@ class Interface(object):
         self._endpoints    = []
         self.bNumEndpoints = 0
 
-class Endpoint(object):
+class Endpoint(Descriptor):
     """ USB Endpoint Descriptor """
     def __init__(self, **kwargs):
         #pylint: disable=invalid-name
@@ -143,11 +237,9 @@ class Endpoint(object):
         self.bLength         = 7
         self.bDescriptorType = 0x05
 
-        # TODO: Unsupported values
-        self.wMaxPacketSize = 64
-        self.bInterval      = 0
-
         # Mutable values
+        self.wMaxPacketSize      = kwargs.get("wMaxPacketSize",   64)
         self.bEndpointAddress    = kwargs.get("bEndpointAddress", 0x01)
         self.bmAttributes        = kwargs.get("bmAttributes",     0x02)
+        self.bInterval           = kwargs.get("bInterval",        0)
         #pylint: enable=invalid-name
@@ -0,0 +1,307 @@
+""" USB CDC-ACM virtual serial port """
+#pylint: disable=C0326,R0902,W1202
+import errno
+import os
+import select
+import socket
+import struct
+import threading
+import tty
+from collections import deque
+from virtusb import descriptors, log
+from virtusb.controller import VirtualDevice, URB_PENDING, endpoint_address, cancel_parked
+from virtusb.ring import ByteRing
+
+LOGGER = log.get_logger('cdc_acm')
+DEFAULT_RING_SIZE = 256 * 1024
+
+# Class requests
+CDC_SET_LINE_CODING        = 0x20
+CDC_GET_LINE_CODING        = 0x21
+CDC_SET_CONTROL_LINE_STATE = 0x22
+CDC_SEND_BREAK             = 0x23
+LINE_CODING = struct.Struct('<IBBB')
+
+EP_NOTIFY   = 0x83
+EP_BULK_IN  = 0x81
+EP_BULK_OUT = 0x02
+
+class CdcAcmDevice(VirtualDevice):
+    """ Virtual serial port
+
+    Each direction is a preallocated ring. Bulk IN URBs take whatever is in
+    the ring up to their buffer length in one go, and are parked while it's
+    empty. Bulk OUT URBs are parked while the ring is too full to take them.
+    The port is used in process with read() and write(), or bridged to a pty
+    or a unix socket for other programs to use.
+    """
+    template = descriptors.Device(
+        bDeviceClass    = 0x02, # Communications
+        bDeviceSubClass = 0x00,
+        bDeviceProtocol = 0x00,
+        idVendor        = 0x0525, # Linux-USB Serial Gadget (CDC ACM mode)
+        idProduct       = 0xa4a7,
+        bcdDevice       = 0x0100,
+        configurations  = [descriptors.Configuration(
+            bConfigurationValue = 1,
+            bmAttributes        = 0x80,
+            interfaces          = [
+                descriptors.Interface(
+                    bInterfaceNumber   = 0,
+                    bInterfaceClass    = 0x02, # Communications
+                    bInterfaceSubClass = 0x02, # Abstract Control Model
+                    bInterfaceProtocol = 0x01, # AT commands (V.250)
+                    class_descriptors  = [
+                        b'\x05\x24\x00\x10\x01', # Header, CDC 1.10
+                        b'\x05\x24\x01\x00\x01', # Call management, data on interface 1
+                        b'\x04\x24\x02\x02',     # ACM, line coding and serial state
+                        b'\x05\x24\x06\x00\x01', # Union, control 0 and data 1
+                    ],
+                    endpoints          = [descriptors.Endpoint(
+                        bEndpointAddress = EP_NOTIFY,
+                        bmAttributes     = 0x03,
+                        wMaxPacketSize   = 16,
+                        bInterval        = 10)]),
+                descriptors.Interface(
+                    bInterfaceNumber   = 1,
+                    bInterfaceClass    = 0x0a, # CDC Data
+                    bInterfaceSubClass = 0x00,
+                    bInterfaceProtocol = 0x00,
+                    endpoints          = [
+                        descriptors.Endpoint(bEndpointAddress=EP_BULK_IN,  bmAttributes=0x02),
+                        descriptors.Endpoint(bEndpointAddress=EP_BULK_OUT, bmAttributes=0x02),
+                    ]),
+            ])])
+
+    def __init__(self, bridge=None, ring_size=DEFAULT_RING_SIZE, serial_number=None):
+        super(CdcAcmDevice, self).__init__(serial_number=serial_number)
+        self.line_coding = LINE_CODING.pack(115200, 0, 0, 8)
+        self.dtr = False
+        self.rts = False
+
+        # Device to host (tx) and host to device (rx) data
+        self._tx          = ByteRing.allocate(ring_size)
+        self._rx          = ByteRing.allocate(ring_size)
+        self._lock        = threading.Lock()
+        self._parked_in   = deque()
+        self._pending_out = deque()
+
+        # Optional bridge to a pty or unix socket
+        self.pty_name = None
+        self._bridge  = None
+        if bridge is not None:
+            self._bridge = _Bridge(self, bridge)
+            self.pty_name = self._bridge.pty_name
+
+    def close(self):
+        """ Stop bridging the port """
+        if self._bridge is not None:
+            self._bridge.stop()
+            self._bridge = None
+
+    def write(self, data):
+        """ Send data to the host. Returns how much fit in the ring """
+        count = self._tx.write(data)
+        self._complete_in()
+        if self._bridge is None and count < len(data):
+            LOGGER.warning('Serial transmit ring full, dropped {} bytes'.format(len(data) - count))
+        return count
+
+    def read(self, size=-1):
+        """ Receive data sent by the host, up to size bytes """
+        data = self._rx.read(size)
+        self._complete_out()
+        return data
+
+    def readinto(self, buf):
+        """ Receive data sent by the host into the buffer, returning the byte count """
+        count = self._rx.readinto(buf)
+        self._complete_out()
+        return count
+
+    def pending(self):
+        """ Number of received bytes waiting to be read """
+        return len(self._rx)
+
+    def handle_control(self, packet, data=None):
+        """ Handle the ACM class requests """
+        setup   = packet['setup']
+        request = setup['bRequest']
+        if request == CDC_SET_LINE_CODING:
+            if data is not None and len(data) >= LINE_CODING.size:
+                self.line_coding = bytes(data[:LINE_CODING.size])
+                LOGGER.debug('Line coding: {}'.format(LINE_CODING.unpack(self.line_coding)))
+            return None
+        if request == CDC_GET_LINE_CODING:
+            return self.line_coding
+        if request == CDC_SET_CONTROL_LINE_STATE:
+            self.dtr = bool(setup['wValue'] & 0x01)
+            self.rts = bool(setup['wValue'] & 0x02)
+            return None
+        if request == CDC_SEND_BREAK:
+            return None
+        return NotImplemented
+
+    def handle_into(self, packet, out_view):
+        """ Copy queued data for bulk IN URBs straight from the ring into the server's buffer """
+        if endpoint_address(packet) == EP_BULK_IN:
+            with self._lock:
+                if not self._parked_in and len(self._tx):
+                    return self._tx.readinto(out_view)
+        # Nothing to send right away, so let handle() park it
+        return NotImplemented
+
+    def handle(self, packet, data=None):
+        """ Handle the bulk data and notification endpoints """
+        endpoint = endpoint_address(packet)
+        if endpoint == EP_BULK_IN:
+            with self._lock:
+                if not self._parked_in and len(self._tx):
+                    return self._tx.read(packet['buffer_len'])
+                self._parked_in.append((packet['seq_num'], packet['buffer_len']))
+            self._complete_in()
+            return URB_PENDING
+
+        if endpoint == EP_BULK_OUT:
+            data = data or b''
+            with self._lock:
+                if not self._pending_out and self._rx.free() >= len(data):
+                    self._rx.write(data)
+                    written = True
+                else:
+                    self._pending_out.append((packet['seq_num'], data))
+                    written = False
+            if written and self._bridge is not None:
+                self._bridge.wake()
+            return None if written else URB_PENDING
+
+        # Serial state notifications are never sent, so idle on them forever
+        if endpoint == EP_NOTIFY:
+            return URB_PENDING
+        raise RuntimeError('Invalid endpoint {:#04x}'.format(endpoint))
+
+    def cancel(self, endpoint, packet):
+        """ Forget an unlinked URB, dropping it's data if it's an OUT one """
+        if endpoint == EP_NOTIFY:
+            return True
+        with self._lock:
+            queue = self._parked_in if endpoint == EP_BULK_IN else self._pending_out
+            return cancel_parked(queue, packet)
+
+    def _complete_in(self):
+        """ Complete parked IN URBs for as long as there is data to send """
+        while True:
+            with self._lock:
+                if not self._parked_in or not len(self._tx):
+                    return
+                chunk = self._tx.read(self._parked_in.popleft()[1])
+            self.complete(EP_BULK_IN, chunk)
+
+    def _complete_out(self):
+        """ Complete parked OUT URBs once their data fits in the ring """
+        while True:
+            with self._lock:
+                if not self._pending_out or self._rx.free() < len(self._pending_out[0][1]):
+                    return
+                self._rx.write(self._pending_out.popleft()[1])
+            self.complete(EP_BULK_OUT, None)
+            if self._bridge is not None:
+                self._bridge.wake()
+
+class _Bridge(object):
+    """ Moves serial data between the rings and a pty or unix socket """
+    def __init__(self, device, target):
+        self.device   = device
+        self.pty_name = None
+        self.listener = None
+        self.peer     = None
+        self.slave    = None
+        self.stopping = False
+        self.backlog  = b''
+        self._wake_r, self._wake_w = os.pipe()
+
+        if target == 'pty':
+            self.peer, self.slave = os.openpty()
+            tty.setraw(self.slave)
+            self.pty_name = os.ttyname(self.slave)
+            LOGGER.info('Serial port bridged to {}'.format(self.pty_name))
+        else:
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(target)
+            self.listener.listen(1)
+            LOGGER.info('Serial port bridged to unix socket {}'.format(target))
+
+        self.thread = threading.Thread(target=self._run, name='virtusb-acm-bridge')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wake(self):
+        """ Wake the bridge thread to send newly received data """
+        os.write(self._wake_w, b'\x00')
+
+    def stop(self):
+        """ Stop the bridge thread and close everything """
+        self.stopping = True
+        self.wake()
+        self.thread.join()
+        for fd in (self._wake_r, self._wake_w, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self._close_peer()
+        if self.listener is not None:
+            self.listener.close()
+
+    def _fileno(self):
+        return self.peer if isinstance(self.peer, int) else self.peer.fileno()
+
+    def _close_peer(self):
+        if isinstance(self.peer, int):
+            os.close(self.peer)
+        elif self.peer is not None:
+            self.peer.close()
+        self.peer = None
+
+    def _run(self):
+        """ Bridge thread """
+        device = self.device
+        while not self.stopping:
+            readers = [self._wake_r]
+            writers = []
+            if self.listener is not None and self.peer is None:
+                readers.append(self.listener)
+            if self.peer is not None:
+                if device._tx.free(): #pylint: disable=protected-access
+                    readers.append(self._fileno())
+                if self.backlog or device.pending():
+                    writers.append(self._fileno())
+            readable, writable, _ = select.select(readers, writers, [])
+
+            if self._wake_r in readable:
+                os.read(self._wake_r, 4096)
+            if self.listener is not None and self.listener in readable:
+                self.peer, _ = self.listener.accept()
+                continue
+
+            # Serial data from the peer is sent to the host in whole chunks
+            if self.peer is not None and self._fileno() in readable:
+                try:
+                    data = os.read(self._fileno(), device._tx.free()) #pylint: disable=protected-access
+                except OSError as error:
+                    if error.errno != errno.EIO:
+                        raise
+                    data = b''
+                if data:
+                    device.write(data)
+                elif self.listener is not None:
+                    self._close_peer()
+                    continue
+
+            # Host data goes out to the peer as fast as it takes it
+            if self.peer is not None and self._fileno() in writable:
+                if not self.backlog:
+                    self.backlog = device.read(65536)
+                try:
+                    sent = os.write(self._fileno(), self.backlog)
+                except OSError:
+                    sent = len(self.backlog)
+                self.backlog = self.backlog[sent:]
@@ -0,0 +1,377 @@
+""" USB CDC-NCM virtual network adapter """
+#pylint: disable=C0326,R0902,W1202
+import errno
+import fcntl
+import os
+import select
+import struct
+import threading
+from collections import deque
+from virtusb import descriptors, log
+from virtusb.controller import VirtualDevice, URB_PENDING, endpoint_address, device_to_host
+from virtusb.controller import USB_REQ_GET_DESCRIPTOR, cancel_parked
+
+LOGGER = log.get_logger('cdc_ncm')
+
+# Class requests
+NCM_SET_ETHERNET_PACKET_FILTER = 0x43
+NCM_GET_NTB_PARAMETERS         = 0x80
+NCM_GET_NTB_FORMAT             = 0x83
+NCM_SET_NTB_FORMAT             = 0x84
+NCM_GET_NTB_INPUT_SIZE         = 0x85
+NCM_SET_NTB_INPUT_SIZE         = 0x86
+NCM_GET_MAX_DATAGRAM_SIZE      = 0x87
+NCM_SET_MAX_DATAGRAM_SIZE      = 0x88
+NCM_SET_CRC_MODE               = 0x8a
+
+# Notifications
+NCM_NETWORK_CONNECTION = 0x00
+NCM_SPEED_CHANGE       = 0x2a
+
+# 16 bit NCM transfer blocks
+NTH16 = struct.Struct('<IHHHH')
+NDP16 = struct.Struct('<IHH')
+DPE16 = struct.Struct('<HH')
+NTH16_SIGNATURE = 0x484d434e # NCMH
+NDP16_SIGNATURE = 0x304d434e # NCM0
+NTB_PARAMETERS  = struct.Struct('<HHIHHHHIHHHH')
+NTB_ALIGNMENT   = 4
+
+# TAP interfaces
+TUNSETIFF = 0x400454ca
+IFF_TAP   = 0x0002
+IFF_NO_PI = 0x1000
+
+EP_NOTIFY   = 0x83
+EP_BULK_IN  = 0x81
+EP_BULK_OUT = 0x02
+STRING_MAC  = 4
+ETH_MAX_FRAME = 1514
+
+def _align(offset):
+    return (offset + NTB_ALIGNMENT - 1) & ~(NTB_ALIGNMENT - 1)
+
+def pack_ntb(frames, max_size, sequence=0):
+    """ Pack as many queued frames as fit into one NTB, consuming them
+
+    Datagrams come first with the datagram pointer table after them, so the
+    block is laid out in one pass without knowing the frame count up front.
+    """
+    offsets = []
+    offset  = NTH16.size
+    while frames:
+        start = _align(offset)
+        end   = start + len(frames[0])
+        table = _align(end) + NDP16.size + DPE16.size * (len(offsets) + 2)
+        if table > max_size:
+            break
+        offsets.append((start, frames.popleft()))
+        offset = end
+    if not offsets:
+        return None
+
+    ndp_index = _align(offset)
+    length    = ndp_index + NDP16.size + DPE16.size * (len(offsets) + 1)
+    block     = bytearray(length)
+    NTH16.pack_into(block, 0, NTH16_SIGNATURE, NTH16.size, sequence & 0xffff, length, ndp_index)
+    NDP16.pack_into(block, ndp_index, NDP16_SIGNATURE, length - ndp_index, 0)
+    entry = ndp_index + NDP16.size
+    for start, frame in offsets:
+        block[start:start + len(frame)] = frame
+        DPE16.pack_into(block, entry, start, len(frame))
+        entry += DPE16.size
+    return block
+
+def unpack_ntb(block):
+    """ Generate the datagrams in an NTB as memoryviews into it
+
+    The block comes from the host, so malformed ones (tables outside the
+    block, or tables linking back to each other) raise a RuntimeError.
+    """
+    block = memoryview(block)
+    if len(block) < NTH16.size:
+        raise RuntimeError('Truncated NTB header')
+    signature, _, _, length, ndp_index = NTH16.unpack_from(block, 0)
+    if signature != NTH16_SIGNATURE:
+        raise RuntimeError('Invalid NTB header signature')
+    length  = min(length, len(block))
+    visited = set()
+    while ndp_index:
+        if ndp_index in visited:
+            raise RuntimeError('Cyclic NTB datagram pointer tables')
+        visited.add(ndp_index)
+        if ndp_index + NDP16.size > length:
+            raise RuntimeError('NTB datagram pointer table out of bounds')
+        signature, _, next_index = NDP16.unpack_from(block, ndp_index)
+        if signature & 0x00ffffff != NDP16_SIGNATURE & 0x00ffffff:
+            raise RuntimeError('Invalid NTB datagram pointer signature')
+        entry = ndp_index + NDP16.size
+        while True:
+            if entry + DPE16.size > length:
+                raise RuntimeError('Unterminated NTB datagram pointer table')
+            start, size = DPE16.unpack_from(block, entry)
+            if not start or not size:
+                break
+            if start + size <= length:
+                yield block[start:start + size]
+            entry += DPE16.size
+        ndp_index = next_index
+
+class NcmDevice(VirtualDevice):
+    """ Virtual ethernet adapter
+
+    Frames queued with send() are aggregated into one NTB per bulk IN URB,
+    so under load each URB carries as many frames as the host's NTB size
+    allows. Frames the host sends go to the sink callable, or to the
+    received queue without one. With a tap name the adapter is bridged to a
+    local TAP interface instead.
+    """
+    template = descriptors.Device(
+        bDeviceClass    = 0x02, # Communications
+        bDeviceSubClass = 0x00,
+        bDeviceProtocol = 0x00,
+        idVendor        = 0x0525, # Linux-USB Ethernet Gadget
+        idProduct       = 0xa4a1,
+        bcdDevice       = 0x0100,
+        configurations  = [descriptors.Configuration(
+            bConfigurationValue = 1,
+            bmAttributes        = 0x80,
+            interfaces          = [
+                descriptors.Interface(
+                    bInterfaceNumber   = 0,
+                    bInterfaceClass    = 0x02, # Communications
+                    bInterfaceSubClass = 0x0d, # Network Control Model
+                    bInterfaceProtocol = 0x00,
+                    class_descriptors  = [
+                        b'\x05\x24\x00\x10\x01', # Header, CDC 1.10
+                        b'\x05\x24\x06\x00\x01', # Union, control 0 and data 1
+                        # Ethernet networking, MAC in string 4, 1514 byte segments
+                        struct.pack('<BBBBIHHB', 13, 0x24, 0x0f, STRING_MAC, 0, ETH_MAX_FRAME, 0, 0),
+                        b'\x06\x24\x1a\x00\x01\x00', # NCM 1.0
+                    ],
+                    endpoints          = [descriptors.Endpoint(
+                        bEndpointAddress = EP_NOTIFY,
+                        bmAttributes     = 0x03,
+                        wMaxPacketSize   = 16,
+                        bInterval        = 9)]),
+                # Data interface, which only has endpoints in it's alternate setting
+                descriptors.Interface(
+                    bInterfaceNumber   = 1,
+                    bAlternateSetting  = 0,
+                    bInterfaceClass    = 0x0a, # CDC Data
+                    bInterfaceSubClass = 0x00,
+                    bInterfaceProtocol = 0x01), # NTB
+                descriptors.Interface(
+                    bInterfaceNumber   = 1,
+                    bAlternateSetting  = 1,
+                    bInterfaceClass    = 0x0a,
+                    bInterfaceSubClass = 0x00,
+                    bInterfaceProtocol = 0x01,
+                    endpoints          = [
+                        descriptors.Endpoint(bEndpointAddress=EP_BULK_IN,  bmAttributes=0x02,
+                                             wMaxPacketSize=512),
+                        descriptors.Endpoint(bEndpointAddress=EP_BULK_OUT, bmAttributes=0x02,
+                                             wMaxPacketSize=512),
+                    ]),
+            ])])
+
+    def __init__(self, tap=None, sink=None, mac='02:00:00:00:00:01', ntb_size=16384,
+                 max_queue=4096, speed_bps=1000000000, serial_number=None):
+        #pylint: disable=too-many-arguments
+        self.mac       = mac.replace(':', '').upper()
+        self.ntb_size  = ntb_size
+        self.max_queue = max_queue
+        self.speed_bps = speed_bps
+        self.dropped   = 0
+        self.received  = deque()
+        self.sink      = sink if sink is not None else self.received.append
+
+        # Set up before the base class configures the device
+        self._lock          = threading.Lock()
+        self._frames        = deque()
+        self._parked_in     = deque()
+        self._sequence      = 0
+        self._notifications = deque()
+        self._parked_notify = 0
+        super(NcmDevice, self).__init__(serial_number=serial_number)
+
+        self._tap = None
+        if tap is not None:
+            self._tap = _TapBridge(self, tap)
+
+    def close(self):
+        """ Stop bridging the adapter """
+        if self._tap is not None:
+            self._tap.stop()
+            self._tap = None
+
+    def set_configuration(self, config_value=None):
+        """ Report the link as up whenever the adapter is configured """
+        super(NcmDevice, self).set_configuration(config_value)
+        speed = struct.pack('<II', self.speed_bps, self.speed_bps)
+        self._notify(struct.pack('<BBHHH', 0xa1, NCM_NETWORK_CONNECTION, 1, 0, 0))
+        self._notify(struct.pack('<BBHHH', 0xa1, NCM_SPEED_CHANGE, 0, 0, len(speed)) + speed)
+
+    def send(self, frame):
+        """ Queue an ethernet frame for the host. Returns False if it was dropped """
+        with self._lock:
+            if len(self._frames) >= self.max_queue:
+                self.dropped += 1
+                return False
+            self._frames.append(frame)
+        self._complete_in()
+        return True
+
+    def queued(self):
+        """ Number of frames waiting for the host """
+        return len(self._frames)
+
+    def handle_control(self, packet, data=None):
+        """ Handle the NCM class requests, and the MAC address string """
+        #pylint: disable=too-many-return-statements
+        setup   = packet['setup']
+        request = setup['bRequest']
+        if device_to_host(setup['bmRequestType']) and request == USB_REQ_GET_DESCRIPTOR:
+            return self._string_descriptor(setup['wValue'])
+        if request == NCM_GET_NTB_PARAMETERS:
+            return NTB_PARAMETERS.pack(
+                NTB_PARAMETERS.size, 0x0001, self.ntb_size, NTB_ALIGNMENT, 0, NTB_ALIGNMENT, 0,
+                self.ntb_size, NTB_ALIGNMENT, 0, NTB_ALIGNMENT, 0)
+        if request == NCM_GET_NTB_INPUT_SIZE:
+            return struct.pack('<I', self.ntb_size)
+        if request == NCM_SET_NTB_INPUT_SIZE:
+            if data is not None and len(data) >= 4:
+                self.ntb_size = struct.unpack_from('<I', bytes(data))[0]
+            return None
+        if request == NCM_GET_NTB_FORMAT:
+            return b'\x00\x00'
+        if request == NCM_GET_MAX_DATAGRAM_SIZE:
+            return struct.pack('<H', ETH_MAX_FRAME)
+        if request in (NCM_SET_ETHERNET_PACKET_FILTER, NCM_SET_NTB_FORMAT,
+                       NCM_SET_MAX_DATAGRAM_SIZE, NCM_SET_CRC_MODE):
+            return None
+        return NotImplemented
+
+    def _string_descriptor(self, value):
+        """ Answer string descriptor requests, which only the MAC address needs """
+        if value >> 8 != 0x03:
+            return NotImplemented
+        index = value & 0xff
+        if index == 0:
+            return b'\x04\x03\x09\x04' # English (US)
+        if index == STRING_MAC:
+            encoded = self.mac.encode('utf-16-le')
+            return struct.pack('<BB', 2 + len(encoded), 0x03) + encoded
+        return NotImplemented
+
+    def handle(self, packet, data=None):
+        """ Handle the bulk data and notification endpoints """
+        endpoint = endpoint_address(packet)
+        if endpoint == EP_BULK_IN:
+            size = min(packet['buffer_len'], self.ntb_size)
+            with self._lock:
+                if not self._parked_in:
+                    block = self._next_ntb(size)
+                    if block is not None:
+                        return block
+                self._parked_in.append((packet['seq_num'], size))
+            self._complete_in()
+            return URB_PENDING
+
+        if endpoint == EP_BULK_OUT:
+            if data:
+                for frame in unpack_ntb(data):
+                    self.sink(bytes(frame))
+            return None
+
+        if endpoint == EP_NOTIFY:
+            with self._lock:
+                if self._notifications:
+                    return self._notifications.popleft()
+                self._parked_notify += 1
+            return URB_PENDING
+        raise RuntimeError('Invalid endpoint {:#04x}'.format(endpoint))
+
+    def _next_ntb(self, size):
+        """ Aggregate queued frames into the next NTB. Call with the lock held """
+        block = pack_ntb(self._frames, size, self._sequence)
+        if block is not None:
+            self._sequence += 1
+        return block
+
+    def _complete_in(self):
+        """ Complete parked IN URBs while frames are queued """
+        while True:
+            with self._lock:
+                if not self._parked_in or not self._frames:
+                    return
+                block = self._next_ntb(self._parked_in[0][1])
+                if block is None:
+                    # The frame at the front is bigger than the host's NTBs
+                    self._frames.popleft()
+                    self.dropped += 1
+                    continue
+                self._parked_in.popleft()
+            self.complete(EP_BULK_IN, block)
+
+    def cancel(self, endpoint, packet):
+        """ Forget an unlinked URB, unless it's completion is already on it's way """
+        with self._lock:
+            if endpoint == EP_NOTIFY:
+                if not self._parked_notify:
+                    return False
+                self._parked_notify -= 1
+                return True
+            return cancel_parked(self._parked_in, packet)
+
+    def _notify(self, notification):
+        """ Send a notification, or queue it until the host polls for it """
+        with self._lock:
+            if not self._parked_notify:
+                self._notifications.append(notification)
+                return
+            self._parked_notify -= 1
+        self.complete(EP_NOTIFY, notification)
+
+class _TapBridge(object):
+    """ Moves frames between the adapter and a local TAP interface """
+    def __init__(self, device, name):
+        self.device   = device
+        self.stopping = False
+        self.fd       = os.open('/dev/net/tun', os.O_RDWR)
+        try:
+            request = struct.pack('16sH', name.encode('ascii'), IFF_TAP | IFF_NO_PI)
+            fcntl.ioctl(self.fd, TUNSETIFF, request)
+        except (IOError, OSError):
+            os.close(self.fd)
+            raise
+        LOGGER.info('Network adapter bridged to {}'.format(name))
+        device.sink = self.write
+        self._wake_r, self._wake_w = os.pipe()
+
+        self.thread = threading.Thread(target=self._run, name='virtusb-ncm-tap')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, frame):
+        """ Deliver a frame from the host to the TAP interface """
+        try:
+            os.write(self.fd, frame)
+        except OSError as error:
+            if error.errno not in (errno.EAGAIN, errno.EIO):
+                raise
+
+    def stop(self):
+        """ Stop the bridge thread and close the interface """
+        self.stopping = True
+        os.write(self._wake_w, b'\x00')
+        self.thread.join()
+        for fd in (self._wake_r, self._wake_w, self.fd):
+            os.close(fd)
+
+    def _run(self):
+        """ Bridge thread, reading frames headed for the host """
+        while not self.stopping:
+            readable, _, _ = select.select([self.fd, self._wake_r], [], [])
+            if self.fd in readable:
+                self.device.send(os.read(self.fd, 65536))
@@ -0,0 +1,249 @@
+""" USB HID keyboard, mouse and generic device models """
+#pylint: disable=C0326,R0902,W1202
+import struct
+import threading
+from collections import deque
+from virtusb import descriptors, log
+from virtusb.controller import VirtualDevice, URB_PENDING, endpoint_address, device_to_host
+from virtusb.controller import USB_REQ_GET_DESCRIPTOR
+from virtusb.scheduler import CLOCK, endpoint_period
+
+LOGGER = log.get_logger('hid')
+
+# Class descriptors
+HID_DESCRIPTOR        = 0x2100
+HID_REPORT_DESCRIPTOR = 0x2200
+
+# Class requests
+HID_GET_REPORT   = 0x01
+HID_GET_IDLE     = 0x02
+HID_GET_PROTOCOL = 0x03
+HID_SET_REPORT   = 0x09
+HID_SET_IDLE     = 0x0a
+HID_SET_PROTOCOL = 0x0b
+
+EP_INTERRUPT_IN = 0x81
+
+KEYBOARD_REPORT_DESCRIPTOR = bytes(bytearray([
+    0x05, 0x01, 0x09, 0x06, 0xa1, 0x01,             # Generic desktop, keyboard
+    0x05, 0x07, 0x19, 0xe0, 0x29, 0xe7, 0x15, 0x00, # Modifier keys
+    0x25, 0x01, 0x75, 0x01, 0x95, 0x08, 0x81, 0x02,
+    0x95, 0x01, 0x75, 0x08, 0x81, 0x01,             # Reserved byte
+    0x95, 0x05, 0x75, 0x01, 0x05, 0x08, 0x19, 0x01, # LEDs
+    0x29, 0x05, 0x91, 0x02,
+    0x95, 0x01, 0x75, 0x03, 0x91, 0x01,             # LED padding
+    0x95, 0x06, 0x75, 0x08, 0x15, 0x00, 0x25, 0x65, # Key codes
+    0x05, 0x07, 0x19, 0x00, 0x29, 0x65, 0x81, 0x00,
+    0xc0]))
+
+MOUSE_REPORT_DESCRIPTOR = bytes(bytearray([
+    0x05, 0x01, 0x09, 0x02, 0xa1, 0x01,             # Generic desktop, mouse
+    0x09, 0x01, 0xa1, 0x00,                         # Pointer
+    0x05, 0x09, 0x19, 0x01, 0x29, 0x03, 0x15, 0x00, # Buttons
+    0x25, 0x01, 0x95, 0x03, 0x75, 0x01, 0x81, 0x02,
+    0x95, 0x01, 0x75, 0x05, 0x81, 0x01,             # Button padding
+    0x05, 0x01, 0x09, 0x30, 0x09, 0x31, 0x09, 0x38, # X, Y and wheel
+    0x15, 0x81, 0x25, 0x7f, 0x75, 0x08, 0x95, 0x03,
+    0x81, 0x06,
+    0xc0, 0xc0]))
+
+GENERIC_REPORT_DESCRIPTOR = bytes(bytearray([
+    0x06, 0x00, 0xff, 0x09, 0x01, 0xa1, 0x01,       # Vendor defined
+    0x15, 0x00, 0x26, 0xff, 0x00, 0x75, 0x08,
+    0x95, 0x40, 0x09, 0x01, 0x81, 0x02,             # 64 byte input report
+    0x95, 0x40, 0x09, 0x01, 0x91, 0x02,             # 64 byte output report
+    0xc0]))
+
+def hid_descriptor(report_descriptor):
+    """ Pack the HID class descriptor for a report descriptor """
+    return struct.pack('<BBHBBBH', 9, 0x21, 0x0111, 0, 1, 0x22, len(report_descriptor))
+
+def hid_template(report_descriptor, product_id, subclass=0x00, protocol=0x00,
+                 report_size=8, interval=10):
+    """ Build the device template of a single interface HID device
+
+    Models build it once as a class attribute, so the descriptors of every
+    instance are the same frozen blobs.
+    """
+    #pylint: disable=too-many-arguments
+    return descriptors.Device(
+        bDeviceClass    = 0x00,
+        bDeviceSubClass = 0x00,
+        bDeviceProtocol = 0x00,
+        idVendor        = 0x1d6b, # Linux Foundation
+        idProduct       = product_id,
+        bcdDevice       = 0x0100,
+        configurations  = [descriptors.Configuration(
+            bConfigurationValue = 1,
+            bmAttributes        = 0xa0,
+            interfaces          = [descriptors.Interface(
+                bInterfaceNumber   = 0,
+                bInterfaceClass    = 0x03, # HID
+                bInterfaceSubClass = subclass,
+                bInterfaceProtocol = protocol,
+                class_descriptors  = [hid_descriptor(report_descriptor)],
+                endpoints          = [descriptors.Endpoint(
+                    bEndpointAddress = EP_INTERRUPT_IN,
+                    bmAttributes     = 0x03,
+                    wMaxPacketSize   = report_size,
+                    bInterval        = interval)])])]).freeze()
+
+class HidDevice(VirtualDevice):
+    """ Generic HID device with a vendor defined 64 byte report
+
+    Input reports are queued with send_report(), and handed out at most once
+    per bInterval. Interrupt URBs are parked until there is a report, and a
+    single one-shot timer on the shared scheduler covers the wait for the
+    next interval. An idle device has nothing scheduled and costs nothing.
+    """
+    report_descriptor = GENERIC_REPORT_DESCRIPTOR
+    report_size       = 64
+    template          = hid_template(GENERIC_REPORT_DESCRIPTOR, 0x0104, report_size=64, interval=1)
+
+    def __init__(self, serial_number=None):
+        super(HidDevice, self).__init__(serial_number=serial_number)
+        self.idle          = 0
+        self.protocol      = 1 # Report protocol
+        self.output_report = None
+        self.last_report   = b'\x00' * self.report_size
+
+        self._lock      = threading.Lock()
+        self._reports   = deque()
+        self._parked    = 0
+        self._timer     = None
+        self._next_slot = 0
+        self._period    = endpoint_period(self.find_endpoint(EP_INTERRUPT_IN), self.speed)
+
+    def send_report(self, report):
+        """ Queue an input report for the host """
+        with self._lock:
+            self._reports.append(report)
+            deliver = self._arm()
+        if deliver:
+            self._deliver()
+
+    def on_output_report(self, report):
+        """ Override this method to act on output reports (Keyboard LEDs, ...) """
+
+    def handle_control(self, packet, data=None):
+        """ Handle the report descriptor and HID class requests """
+        #pylint: disable=too-many-return-statements
+        setup   = packet['setup']
+        request = setup['bRequest']
+        if device_to_host(setup['bmRequestType']) and request == USB_REQ_GET_DESCRIPTOR:
+            if setup['wValue'] == HID_REPORT_DESCRIPTOR:
+                return self.report_descriptor
+            if setup['wValue'] == HID_DESCRIPTOR:
+                return self.active_config.interfaces[0].class_descriptors[0]
+            return NotImplemented
+        if request == HID_GET_REPORT:
+            return self.last_report
+        if request == HID_SET_REPORT:
+            self.output_report = bytes(data or b'')
+            self.on_output_report(self.output_report)
+            return None
+        if request == HID_GET_IDLE:
+            return struct.pack('<B', self.idle)
+        if request == HID_SET_IDLE:
+            self.idle = setup['wValue'] >> 8
+            return None
+        if request == HID_GET_PROTOCOL:
+            return struct.pack('<B', self.protocol)
+        if request == HID_SET_PROTOCOL:
+            self.protocol = setup['wValue']
+            return None
+        return NotImplemented
+
+    def handle(self, packet, data=None):
+        """ Handle the interrupt IN endpoint """
+        endpoint = endpoint_address(packet)
+        if endpoint != EP_INTERRUPT_IN:
+            raise RuntimeError('Invalid endpoint {:#04x}'.format(endpoint))
+        with self._lock:
+            if not self._parked and self._reports and CLOCK() >= self._next_slot:
+                return self._take()
+            self._parked += 1
+            deliver = self._arm()
+        if deliver:
+            self._deliver()
+        return URB_PENDING
+
+    def _take(self):
+        """ Take the next report, and push back the next delivery slot. Call with the lock held """
+        report = self._reports.popleft()
+        self.last_report = report
+        self._next_slot  = CLOCK() + self._period
+        return report
+
+    def _arm(self):
+        """ Make sure a parked URB and a queued report will be matched up
+
+        Returns True when it can be done right away. Call with the lock held.
+        """
+        if not self._parked or not self._reports or self._timer is not None:
+            return False
+        delay = self._next_slot - CLOCK()
+        if delay <= 0 or self.scheduler is None:
+            return True
+        self._timer = self.scheduler.call_later(delay, self._deliver)
+        return False
+
+    def _deliver(self):
+        """ Complete a parked URB with the next report """
+        with self._lock:
+            self._timer = None
+            if not self._parked or not self._reports:
+                return
+            self._parked -= 1
+            report = self._take()
+            self._arm()
+        self.complete(EP_INTERRUPT_IN, report)
+
+    def cancel(self, endpoint, packet):
+        """ Forget an unlinked URB, unless every parked one already has a report coming """
+        with self._lock:
+            if not self._parked:
+                return False
+            self._parked -= 1
+            return True
+
+    def stop(self):
+        """ Drop any pending delivery """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+class KeyboardDevice(HidDevice):
+    """ Boot protocol keyboard """
+    report_descriptor = KEYBOARD_REPORT_DESCRIPTOR
+    report_size       = 8
+    template          = hid_template(KEYBOARD_REPORT_DESCRIPTOR, 0x0101, subclass=0x01,
+                                     protocol=0x01, report_size=8, interval=10)
+
+    @property
+    def leds(self):
+        """ LED state the host last set (Num lock is bit 0) """
+        return bytearray(self.output_report or b'\x00')[0]
+
+    def press(self, keys=(), modifiers=0):
+        """ Report the keys (Usage IDs, up to 6) and modifier bits as held """
+        keys = bytes(bytearray(keys[:6])).ljust(6, b'\x00')
+        self.send_report(struct.pack('<BB', modifiers, 0) + keys)
+
+    def release(self):
+        """ Report every key as released """
+        self.send_report(b'\x00' * 8)
+
+class MouseDevice(HidDevice):
+    """ Boot protocol three button mouse with a wheel """
+    report_descriptor = MOUSE_REPORT_DESCRIPTOR
+    report_size       = 4
+    template          = hid_template(MOUSE_REPORT_DESCRIPTOR, 0x0102, subclass=0x01,
+                                     protocol=0x02, report_size=4, interval=10)
+
+    def move(self, x=0, y=0, buttons=0, wheel=0):
+        """ Report relative movement and the buttons held """
+        #pylint: disable=invalid-name
+        clamp = lambda value: max(-127, min(127, value))
+        self.send_report(struct.pack('<Bbbb', buttons, clamp(x), clamp(y), clamp(wheel)))
@@ -0,0 +1,275 @@
+""" USB Mass Storage device (Bulk-Only Transport, SCSI transparent command set) """
+#pylint: disable=C0326,R0902,W1202
+import mmap
+import os
+import struct
+from collections import deque
+from virtusb import descriptors, log
+from virtusb.controller import VirtualDevice, URB_PENDING, FileRegion, endpoint_address
+from virtusb.controller import cancel_parked
+
+LOGGER = log.get_logger('mass_storage')
+
+# Bulk-Only Transport
+CBW = struct.Struct('<IIIBBB16s')
+CSW = struct.Struct('<IIIB')
+CBW_SIGNATURE = 0x43425355
+CSW_SIGNATURE = 0x53425355
+CSW_PASSED = 0x00
+CSW_FAILED = 0x01
+CBW_DATA_IN = 0x80
+
+# Class requests
+BOT_GET_MAX_LUN = 0xfe
+BOT_RESET       = 0xff
+
+# SCSI operation codes
+SCSI_TEST_UNIT_READY            = 0x00
+SCSI_REQUEST_SENSE              = 0x03
+SCSI_INQUIRY                    = 0x12
+SCSI_MODE_SENSE_6               = 0x1a
+SCSI_START_STOP_UNIT            = 0x1b
+SCSI_PREVENT_ALLOW_REMOVAL      = 0x1e
+SCSI_READ_FORMAT_CAPACITIES     = 0x23
+SCSI_READ_CAPACITY_10           = 0x25
+SCSI_READ_10                    = 0x28
+SCSI_WRITE_10                   = 0x2a
+SCSI_VERIFY_10                  = 0x2f
+SCSI_SYNCHRONIZE_CACHE_10       = 0x35
+SCSI_MODE_SENSE_10              = 0x5a
+
+# SCSI sense keys and additional sense codes
+SENSE_NONE             = (0x00, 0x00, 0x00)
+SENSE_INVALID_OPCODE   = (0x05, 0x20, 0x00)
+SENSE_LBA_OUT_OF_RANGE = (0x05, 0x21, 0x00)
+SENSE_INVALID_FIELD    = (0x05, 0x24, 0x00)
+SENSE_WRITE_PROTECTED  = (0x07, 0x27, 0x00)
+
+EP_BULK_IN  = 0x81
+EP_BULK_OUT = 0x02
+
+class MassStorageDevice(VirtualDevice):
+    """ USB flash drive backed by a memory mapped disk image file
+
+    READ(10) is answered with views into the mapping, so block data goes
+    straight from the page cache into the RET_SUBMIT payload.
+    """
+    template = descriptors.Device(
+        bDeviceClass    = 0x00,
+        bDeviceSubClass = 0x00,
+        bDeviceProtocol = 0x00,
+        idVendor        = 0x0525, # Linux-USB File-backed Storage Gadget
+        idProduct       = 0xa4a5,
+        bcdDevice       = 0x0100,
+        configurations  = [descriptors.Configuration(
+            bConfigurationValue = 1,
+            bmAttributes        = 0x80,
+            interfaces          = [descriptors.Interface(
+                bInterfaceNumber   = 0,
+                bInterfaceClass    = 0x08, # Mass Storage
+                bInterfaceSubClass = 0x06, # SCSI transparent command set
+                bInterfaceProtocol = 0x50, # Bulk-Only Transport
+                endpoints          = [
+                    descriptors.Endpoint(bEndpointAddress=EP_BULK_IN,  bmAttributes=0x02),
+                    descriptors.Endpoint(bEndpointAddress=EP_BULK_OUT, bmAttributes=0x02),
+                ])])])
+
+    def __init__(self, image_path, block_size=512, read_only=False,
+                 vendor='virtusb', product='Virtual Disk', revision='0.1', serial_number=None):
+        #pylint: disable=too-many-arguments
+        super(MassStorageDevice, self).__init__(serial_number=serial_number)
+        self.block_size = block_size
+        self.read_only  = read_only
+        self.inquiry    = struct.pack(
+            '>BBBBBBBB8s16s4s', 0x00, 0x80, 0x04, 0x02, 31, 0, 0, 0,
+            vendor.encode('ascii').ljust(8)[:8],
+            product.encode('ascii').ljust(16)[:16],
+            revision.encode('ascii').ljust(4)[:4])
+
+        # Map the whole image
+        self._file = open(image_path, 'rb' if read_only else 'r+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < block_size:
+            raise RuntimeError('Disk image is smaller than a single block')
+        access = mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE
+        self._mmap  = mmap.mmap(self._file.fileno(), size, access=access)
+        self._disk  = memoryview(self._mmap)
+        self.blocks = size // block_size
+
+        # Bulk-Only Transport state
+        self._sense     = SENSE_NONE
+        self._tag       = 0
+        self._residue   = 0
+        self._status    = CSW_PASSED
+        self._data_in   = None
+        self._write_pos = None
+        self._write_end = 0
+        self._csw_ready = False
+        self._parked_in = deque()
+
+    def close(self):
+        """ Release the disk image """
+        self._disk.release()
+        self._mmap.close()
+        self._file.close()
+
+    def reset(self):
+        """ Bulk-Only mass storage reset """
+        self._data_in   = None
+        self._write_pos = None
+        self._csw_ready = False
+
+    def handle_control(self, packet, data=None):
+        """ Handle Bulk-Only class requests """
+        request = packet['setup']['bRequest']
+        if request == BOT_GET_MAX_LUN:
+            return b'\x00'
+        if request == BOT_RESET:
+            self.reset()
+            return None
+        return NotImplemented
+
+    def handle(self, packet, data=None):
+        """ Handle the bulk endpoints """
+        endpoint = endpoint_address(packet)
+        if endpoint == EP_BULK_OUT:
+            self._bulk_out(data or b'')
+            self._complete_parked()
+            return None
+        if endpoint == EP_BULK_IN:
+            chunk = self._next_in(packet['buffer_len'])
+            if chunk is None:
+                self._parked_in.append((packet['seq_num'], packet['buffer_len']))
+                return URB_PENDING
+            return chunk
+        raise RuntimeError('Invalid endpoint {:#04x}'.format(endpoint))
+
+    def cancel(self, endpoint, packet):
+        """ Forget an unlinked IN URB """
+        return cancel_parked(self._parked_in, packet)
+
+    def _complete_parked(self):
+        """ Complete IN URBs that arrived before there was anything to send """
+        while self._parked_in:
+            chunk = self._next_in(self._parked_in[0][1])
+            if chunk is None:
+                break
+            self._parked_in.popleft()
+            self.complete(EP_BULK_IN, chunk)
+
+    def _next_in(self, size):
+        """ Fetch the next chunk of the data-in phase, or the status once it's done """
+        if self._data_in is not None:
+            data, start = self._data_in
+            chunk = data[start:start + size]
+            start += len(chunk)
+            self._data_in = (data, start) if start < len(data) else None
+            return chunk
+        if self._csw_ready:
+            self._csw_ready = False
+            return CSW.pack(CSW_SIGNATURE, self._tag, self._residue, self._status)
+        return None
+
+    def _bulk_out(self, data):
+        """ Handle a command block, or data-out for the current command """
+        # Data-out phase
+        if self._write_pos is not None:
+            size = min(len(data), self._write_end - self._write_pos)
+            if self._status == CSW_PASSED:
+                self._disk[self._write_pos:self._write_pos + size] = data[:size]
+            self._write_pos += size
+            self._residue   -= size
+            if self._write_pos >= self._write_end:
+                self._write_pos = None
+                self._csw_ready = True
+            return
+
+        if len(data) != CBW.size:
+            LOGGER.error('Invalid command block wrapper size ({})'.format(len(data)))
+            return
+        signature, tag, length, flags, _, _, block = CBW.unpack(bytes(data))
+        if signature != CBW_SIGNATURE:
+            LOGGER.error('Invalid command block wrapper signature')
+            return
+
+        self._tag     = tag
+        self._residue = length
+        self._status  = CSW_PASSED
+        result = self.scsi(bytearray(block), length)
+
+        # Data-in phase, the host reads up to the length it asked for
+        if flags & CBW_DATA_IN and length > 0:
+            if result is None:
+                result = b''
+            result = result[:length]
+            self._residue -= len(result)
+            self._data_in = (result, 0)
+        # Data-out phase, which WRITE(10) has already pointed somewhere
+        elif length > 0:
+            if self._write_pos is None:
+                self._write_pos = 0
+                self._write_end = length
+                self._status    = CSW_FAILED
+            return
+        self._csw_ready = True
+
+    def fail(self, sense):
+        """ Fail the current command with the given sense data """
+        self._sense  = sense
+        self._status = CSW_FAILED
+
+    def scsi(self, block, length):
+        """ Run a SCSI command, returning it's data-in if any """
+        #pylint: disable=too-many-return-statements
+        opcode = block[0]
+        LOGGER.debug('SCSI command {:#04x}'.format(opcode))
+
+        if opcode in (SCSI_READ_10, SCSI_WRITE_10, SCSI_VERIFY_10):
+            lba   = struct.unpack_from('>I', block, 2)[0]
+            count = struct.unpack_from('>H', block, 7)[0]
+            if lba + count > self.blocks:
+                self.fail(SENSE_LBA_OUT_OF_RANGE)
+                return None
+            start = lba * self.block_size
+            end   = start + count * self.block_size
+            # Reads are sent straight from the image file by the server
+            if opcode == SCSI_READ_10:
+                return FileRegion(self._file, start, end - start)
+            if opcode == SCSI_WRITE_10:
+                if self.read_only:
+                    self.fail(SENSE_WRITE_PROTECTED)
+                    return None
+                self._write_pos = start
+                self._write_end = start + min(length, end - start)
+            return None
+
+        if opcode == SCSI_TEST_UNIT_READY:
+            return None
+        if opcode == SCSI_REQUEST_SENSE:
+            key, asc, ascq = self._sense
+            self._sense = SENSE_NONE
+            return struct.pack('>BBBIBIBBB3x', 0x70, 0, key, 0, 10, 0, asc, ascq, 0)[:block[4]]
+        if opcode == SCSI_INQUIRY:
+            if block[1] & 0x01:
+                self.fail(SENSE_INVALID_FIELD)
+                return None
+            return self.inquiry[:struct.unpack_from('>H', block, 3)[0]]
+        if opcode == SCSI_READ_CAPACITY_10:
+            return struct.pack('>II', self.blocks - 1, self.block_size)
+        if opcode == SCSI_READ_FORMAT_CAPACITIES:
+            return struct.pack('>3xBIB3s', 8, self.blocks, 0x02,
+                               struct.pack('>I', self.block_size)[1:])
+        if opcode == SCSI_MODE_SENSE_6:
+            return struct.pack('>BBBB', 3, 0, 0x80 if self.read_only else 0x00, 0)
+        if opcode == SCSI_MODE_SENSE_10:
+            return struct.pack('>HBB4x', 6, 0, 0x80 if self.read_only else 0x00)
+        if opcode == SCSI_SYNCHRONIZE_CACHE_10:
+            if not self.read_only:
+                self._mmap.flush()
+            return None
+        if opcode in (SCSI_START_STOP_UNIT, SCSI_PREVENT_ALLOW_REMOVAL):
+            return None
+
+        LOGGER.warning('Unsupported SCSI command {:#04x}'.format(opcode))
+        self.fail(SENSE_INVALID_OPCODE)
+        return None
@@ -0,0 +1,258 @@
+""" Synthetic data sources for IN endpoints
+
+Sources hand out whole URB sized buffers per read. Periodic data (waveforms,
+PRBS patterns, fixed patterns) is computed once and tiled, so a read is a
+slice of a shared buffer. Anything else is generated with NumPy when it's
+installed, or the array module when it isn't.
+"""
+#pylint: disable=C0326,R0205,R0903
+import array
+import math
+import struct
+import sys
+from fractions import Fraction
+from virtusb.controller import VirtualDevice, endpoint_address
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Tiled patterns, shared by every source repeating the same one
+_TILES = {}
+
+# Precomputed periods of the parameterized sources
+_PERIODS = {}
+
+# PRBS generator polynomials (ITU-T O.150) as feedback taps
+PRBS_TAPS = {
+    7:  (7, 6),
+    9:  (9, 5),
+    11: (11, 9),
+    15: (15, 14),
+}
+
+def _tile(pattern, size):
+    """ Fetch the pattern repeated to at least size bytes past any start in it """
+    tiled = _TILES.get(pattern)
+    needed = len(pattern) + size
+    if tiled is None or len(tiled) < needed:
+        # Grow in powers of two, so growing reads don't retile every time
+        length = 1
+        while length < needed:
+            length <<= 1
+        tiled = memoryview(pattern * (length // len(pattern) + 1))
+        _TILES[pattern] = tiled
+    return tiled
+
+def _tobytes(values):
+    """ Fetch the bytes of an array, which Python 2 only has tostring() for """
+    tobytes = getattr(values, 'tobytes', None) or values.tostring
+    return tobytes()
+
+class Source(object):
+    """ Base endpoint data source """
+    align = 1 # Reads are rounded down to a multiple of this
+
+    def read(self, size):
+        """ Generate the next size bytes of data """
+        raise NotImplementedError
+
+class PatternSource(Source):
+    """ Repeats a fixed byte pattern forever """
+    def __init__(self, pattern, align=1):
+        pattern = bytes(bytearray(pattern))
+        if not pattern:
+            raise ValueError('Pattern is empty')
+        self.align   = align
+        self.period  = len(pattern)
+        self._offset = 0
+        self._buf    = _tile(pattern, 0)
+        self._key    = pattern
+
+    def read(self, size):
+        """ Fetch the next size bytes as a view of the tiled pattern """
+        size -= size % self.align
+        if self.period + size > len(self._buf):
+            self._buf = _tile(self._key, size)
+        start = self._offset
+        self._offset = (start + size) % self.period
+        return self._buf[start:start + size]
+
+class CounterSource(Source):
+    """ Little endian counter of width bytes, wrapping around """
+    TYPECODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'} # Arrays only have Q on Python 3
+
+    def __init__(self, width=4, start=0, step=1):
+        if width not in self.TYPECODES:
+            raise ValueError('Invalid counter width {}'.format(width))
+        self.align = width
+        self.width = width
+        self.step  = step
+        self.mask  = (1 << (width * 8)) - 1
+        self.value = start & self.mask
+
+    def read(self, size):
+        """ Generate the next size // width counter values """
+        count = size // self.width
+        start = self.value
+        self.value = (start + count * self.step) & self.mask
+        if numpy is not None:
+            # Negative steps count down as their two's complement, wrapping
+            values = numpy.arange(count, dtype=numpy.uint64) * numpy.uint64(self.step & self.mask)
+            values += numpy.uint64(start)
+            return values.astype('<u{}'.format(self.width)).tobytes()
+
+        values = [(start + idx * self.step) & self.mask for idx in range(count)]
+        if self.width == 8:
+            return struct.pack('<{}Q'.format(count), *values)
+        data = array.array(self.TYPECODES[self.width], values)
+        if sys.byteorder == 'big':
+            data.byteswap()
+        return _tobytes(data)
+
+class WaveformSource(PatternSource):
+    """ Sampled sine, square, sawtooth or triangle wave of signed samples
+
+    The shortest run of samples that holds a whole number of cycles is
+    computed once, and repeated from then on.
+    """
+    SHAPES   = ('sine', 'square', 'sawtooth', 'triangle')
+    DTYPES   = {1: ('<i1', 'b'), 2: ('<i2', 'h'), 4: ('<i4', 'i')}
+
+    def __init__(self, shape='sine', frequency=1000, sample_rate=48000, amplitude=None,
+                 offset=0, width=2, channels=1):
+        #pylint: disable=too-many-arguments
+        if shape not in self.SHAPES:
+            raise ValueError('Invalid waveform shape {}'.format(shape))
+        if width not in self.DTYPES:
+            raise ValueError('Invalid sample width {}'.format(width))
+        if amplitude is None:
+            amplitude = (1 << (width * 8 - 1)) - 1
+        key = ('wave', shape, frequency, sample_rate, amplitude, offset, width, channels)
+        pattern = _PERIODS.get(key)
+        if pattern is None:
+            pattern = _PERIODS[key] = self._compute(
+                shape, frequency, sample_rate, amplitude, offset, width, channels)
+        super(WaveformSource, self).__init__(pattern, align=width * channels)
+
+    @classmethod
+    def _compute(cls, shape, frequency, sample_rate, amplitude, offset, width, channels):
+        """ Sample whole cycles of the wave """
+        #pylint: disable=too-many-arguments
+        ratio   = (Fraction(sample_rate) / Fraction(frequency)).limit_denominator(1000)
+        samples = ratio.numerator
+        cycles  = ratio.denominator
+        limit   = (1 << (width * 8 - 1)) - 1
+        dtype, typecode = cls.DTYPES[width]
+
+        if numpy is not None:
+            phase = numpy.arange(samples, dtype=numpy.float64) * cycles / samples % 1.0
+            if shape == 'sine':
+                wave = numpy.sin(2 * numpy.pi * phase)
+            elif shape == 'square':
+                wave = numpy.where(phase < 0.5, 1.0, -1.0)
+            elif shape == 'sawtooth':
+                wave = 2 * phase - 1
+            else:
+                wave = 1 - 4 * numpy.abs(phase - 0.5)
+            values = numpy.clip(numpy.rint(offset + amplitude * wave), -limit - 1, limit)
+            values = numpy.repeat(values.astype(dtype), channels)
+            return values.tobytes()
+
+        waves = {
+            'sine':     lambda phase: math.sin(2 * math.pi * phase),
+            'square':   lambda phase: 1.0 if phase < 0.5 else -1.0,
+            'sawtooth': lambda phase: 2 * phase - 1,
+            'triangle': lambda phase: 1 - 4 * abs(phase - 0.5),
+        }
+        wave   = waves[shape]
+        values = array.array(typecode)
+        for idx in range(samples):
+            value = int(round(offset + amplitude * wave(float(idx * cycles % samples) / samples)))
+            values.extend([max(-limit - 1, min(limit, value))] * channels)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return _tobytes(values)
+
+class PrbsSource(PatternSource):
+    """ Pseudo random binary sequence test pattern (PRBS7, 9, 11 or 15)
+
+    The bit sequence repeats every 2^order - 1 bits, so that many bytes hold
+    a whole number of periods and are computed once per order.
+    """
+    def __init__(self, order=15):
+        if order not in PRBS_TAPS:
+            raise ValueError('Unsupported PRBS order {}'.format(order))
+        key = ('prbs', order)
+        pattern = _PERIODS.get(key)
+        if pattern is None:
+            pattern = _PERIODS[key] = self._compute(order)
+        super(PrbsSource, self).__init__(pattern)
+
+    @staticmethod
+    def _compute(order):
+        """ Run the LFSR for a whole period, and pack 8 periods of bits MSB first """
+        tap_a, tap_b = PRBS_TAPS[order]
+        period = (1 << order) - 1
+        state  = period # All ones seed
+        bits   = bytearray(period)
+        for idx in range(period):
+            bit   = ((state >> (tap_a - 1)) ^ (state >> (tap_b - 1))) & 1
+            state = ((state << 1) | bit) & period
+            bits[idx] = bit
+
+        if numpy is not None:
+            return numpy.packbits(numpy.tile(numpy.frombuffer(bytes(bits), numpy.uint8), 8)).tobytes()
+        bits   = bits * 8
+        packed = bytearray(period)
+        for idx in range(period):
+            byte = 0
+            for bit in bits[idx * 8:idx * 8 + 8]:
+                byte = (byte << 1) | bit
+            packed[idx] = byte
+        return bytes(packed)
+
+class SourceDevice(VirtualDevice):
+    """ Device streaming synthetic data from it's IN endpoints
+
+    Sources are declared as factories keyed by endpoint address, and every
+    device instance builds it's own from them:
+
+        class Microphone(SourceDevice):
+            template = ...
+            sources  = {0x81: partial(WaveformSource, 'sine', frequency=440)}
+
+    Bulk endpoints fill the whole URB buffer. Interrupt endpoints send one
+    packet per URB.
+    """
+    sources = {}
+
+    def __init__(self, device_descriptor=None, serial_number=None):
+        super(SourceDevice, self).__init__(device_descriptor, serial_number)
+        self.endpoint_sources = {}
+        for address, factory in self.sources.items():
+            if self.find_endpoint(address) is None:
+                raise RuntimeError('Source for missing endpoint {:#04x}'.format(address))
+            self.endpoint_sources[address] = factory()
+
+    def _source(self, address):
+        """ Fetch the source of an endpoint """
+        source = self.endpoint_sources.get(address)
+        if source is None:
+            raise RuntimeError('No source for endpoint {:#04x}'.format(address))
+        return source
+
+    def bulk_in(self, packet, data=None): #pylint: disable=unused-argument
+        """ Fill the whole URB buffer from the endpoint's source """
+        return self._source(endpoint_address(packet)).read(packet['buffer_len'])
+
+    def interrupt_in(self, packet, data=None): #pylint: disable=unused-argument
+        """ Send a single packet from the endpoint's source """
+        address  = endpoint_address(packet)
+        endpoint = self.routes[address][0]
+        return self._source(address).read(min(packet['buffer_len'], endpoint.wMaxPacketSize))
+
+    def handle(self, packet, data=None):
+        """ Endpoints without a source, or that aren't IN endpoints """
+        raise RuntimeError('No source for endpoint {:#04x}'.format(endpoint_address(packet)))
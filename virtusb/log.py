@@ -1,8 +1,7 @@
 """ VirtUSB package """
 #pylint: disable=C0326
 import logging
-import logging.config
-import six
+import sys
 
 DEBUG    = 10
 INFO     = 20
@@ -28,7 +27,7 @@ class ColoredFormatter(logging.Formatter):
             fmt = '%(asctime)s %(name)s %(levelname)s - %(message)s'
 
         # Format the message
-        if six.PY2:
+        if sys.version_info[0] == 2:
             self._fmt = fmt
         else:
             self._style._fmt = fmt #pylint: disable=protected-access
@@ -43,18 +42,20 @@ def gen_name(name=None):
     return name
 
 def get_logger(name=None):
-    """ Get the packages logger """
-    logger = logging.getLogger(gen_name(name))
+    """ Get the packages logger
 
-    # Configure logger handler if it's not already
-    if not logger.hasHandlers():
-        handler = logging.StreamHandler()
-        handler.setFormatter(ColoredFormatter())
-        logger.addHandler(handler)
-
-    return logger
+    Modules fetch their logger at import time, so this doesn't configure
+    anything. The package's handler is only installed by set_level, which
+    the CLI calls, leaving applications importing virtusb to configure
+    logging their own way.
+    """
+    return logging.getLogger(gen_name(name))
 
 def set_level(level):
-    """ Set the default verbosity level of the root logger """
+    """ Set the default verbosity level of the root logger, installing it's handler """
     logger = get_logger()
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(ColoredFormatter())
+        logger.addHandler(handler)
     logger.setLevel(level)
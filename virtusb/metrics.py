@@ -0,0 +1,30 @@
+""" Server metrics """
+#pylint: disable=C0326,R0205
+import threading
+from collections import Counter
+
+class Metrics(object):
+    """ Named counters, which any thread may count with """
+    def __init__(self):
+        self._counters = Counter()
+        self._lock     = threading.Lock()
+
+    def increment(self, name, count=1):
+        """ Add to a counter """
+        with self._lock:
+            self._counters[name] += count
+
+    def get(self, name):
+        """ Fetch a counter's value """
+        with self._lock:
+            return self._counters[name]
+
+    def snapshot(self):
+        """ Copy every counter """
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        """ Zero every counter """
+        with self._lock:
+            self._counters.clear()
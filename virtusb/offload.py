@@ -0,0 +1,365 @@
+""" Run CPU heavy device models in worker processes """
+#pylint: disable=C0326,R0205,W1202
+import atexit
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from virtusb import log, packets
+from virtusb.controller import VirtualDevice, URB_PENDING, FileRegion, endpoint_address
+from virtusb.ring import ByteRing
+from virtusb.scheduler import Scheduler
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+LOGGER = log.get_logger()
+DEFAULT_RING_SIZE = 4 * 1024 * 1024
+RING_POLL_SEC     = 0.0005
+CALL_TIMEOUT_SEC  = 5.0
+
+def _put_payload(ring, conn, data):
+    """ Move a payload through the ring, blocking while it's full
+
+    Returns what to send alongside the control message: True when the payload
+    is in the ring, or the payload itself when it can never fit.
+    """
+    if len(data) + 4 > ring.capacity:
+        return bytes(data)
+    while not ring.write_record(data):
+        if conn.closed:
+            raise EOFError('Worker connection closed')
+        time.sleep(RING_POLL_SEC)
+    return True
+
+def _get_payload(ring, payload):
+    """ Counterpart of _put_payload """
+    if payload is True:
+        return ring.read_record()
+    return payload
+
+def _dispatch(device, packet, data):
+    """ Have a device handle an URB, filling IN URBs into a buffer if it can """
+    buffer_len = packet['buffer_len']
+    if packet['direction'] == 1 and buffer_len > 0:
+        buf   = bytearray(buffer_len)
+        count = device.dispatch_into(packet, memoryview(buf))
+        if count is URB_PENDING:
+            return count
+        if count is not NotImplemented:
+            return buf[:count]
+    return device.dispatch(packet, data)
+
+def _control(device, packet, data):
+    """ Have a device answer a class or vendor request, with errors as the answer """
+    try:
+        result = device.handle_control(packet, data)
+    except Exception as error: #pylint: disable=broad-except
+        LOGGER.exception('Offloaded device failed to handle a control request')
+        return RuntimeError('{}: {}'.format(type(error).__name__, error))
+    if result is URB_PENDING:
+        return RuntimeError('Offloaded devices can\'t park control requests')
+    if isinstance(result, FileRegion):
+        result = result.read()
+    return result
+
+def _worker_main(conn, request_name, reply_name, capacity):
+    """ Worker process, handling URBs for every device it's given """
+    size     = ByteRing.required_size(capacity)
+    req_shm  = shared_memory.SharedMemory(name=request_name)
+    rep_shm  = shared_memory.SharedMemory(name=reply_name)
+    requests = ByteRing(req_shm.buf[:size])
+    replies  = ByteRing(rep_shm.buf[:size])
+    devices  = {}
+    parked   = {} # (key, endpoint) -> sequence numbers of URBs the device parked
+    lock     = threading.Lock()
+
+    # Devices in the worker get a scheduler of their own
+    scheduler = Scheduler()
+    scheduler.start()
+
+    def reply(key, endpoint, data):
+        """ Send a completion back to the proxy """
+        # File regions can't be sent from another process
+        if isinstance(data, FileRegion):
+            data = data.read()
+        with lock:
+            if data is not None:
+                data = _put_payload(replies, conn, data)
+            conn.send(('complete', key, endpoint, data))
+
+    def forward(key, device, endpoint):
+        """ Forward completions of parked URBs made by the device itself """
+        with lock:
+            queue = parked.get((key, endpoint))
+            if queue:
+                queue.popleft()
+        reply(key, endpoint, device.pop_completion(endpoint))
+
+    def fail(key, endpoint, error):
+        """ Fail an URB, which the proxy turns into an error status """
+        with lock:
+            conn.send(('failed', key, endpoint, '{}: {}'.format(type(error).__name__, error)))
+
+    def cancel(key, packet):
+        """ Have a device forget an unlinked URB, if it's still parked """
+        endpoint = endpoint_address(packet)
+        with lock:
+            queue = parked.get((key, endpoint), ())
+            if packet['seq_num'] not in queue:
+                return False
+        if not devices[key].unlink(endpoint, packet):
+            return False
+        with lock:
+            if packet['seq_num'] not in queue:
+                return False
+            queue.remove(packet['seq_num'])
+        return True
+
+    try:
+        while True:
+            message = conn.recv()
+            kind, key = message[0], message[1]
+            if kind == 'exit':
+                for device in devices.values():
+                    device.stop()
+                break
+
+            if kind == 'add':
+                factory, args = message[2], message[3]
+                device = factory(*args)
+                device.scheduler = scheduler
+                device.set_urb_listener(lambda dev, ep, key=key: forward(key, dev, ep))
+                devices[key] = device
+                with lock:
+                    conn.send(('added', key, device.descriptor, device.speed))
+            elif kind == 'urb':
+                packet   = packets.UsbIpCmdSubmit.from_raw(message[2])
+                data     = _get_payload(requests, message[3])
+                endpoint = endpoint_address(packet)
+
+                # Completions may come from the device's own threads as soon
+                #  as it parks the URB, so it's marked parked up front
+                with lock:
+                    queue = parked.setdefault((key, endpoint), deque())
+                    queue.append(packet['seq_num'])
+                try:
+                    result = _dispatch(devices[key], packet, data)
+                except Exception as error: #pylint: disable=broad-except
+                    LOGGER.exception('Offloaded device failed to handle URB')
+                    result = error
+                if result is not URB_PENDING:
+                    with lock:
+                        if packet['seq_num'] in queue:
+                            queue.remove(packet['seq_num'])
+                    if isinstance(result, Exception):
+                        fail(key, endpoint, result)
+                    else:
+                        reply(key, endpoint, result)
+            elif kind == 'cancel':
+                packet = packets.UsbIpCmdSubmit.from_raw(message[2])
+                result = cancel(key, packet)
+                with lock:
+                    conn.send(('answer', key, message[3], result))
+            elif kind == 'control':
+                packet = packets.UsbIpCmdSubmit.from_raw(message[2])
+                data   = _get_payload(requests, message[4])
+                result = _control(devices[key], packet, data)
+                with lock:
+                    conn.send(('answer', key, message[3], result))
+            elif kind == 'start':
+                devices[key].start()
+            elif kind == 'stop':
+                devices[key].stop()
+            elif kind == 'config':
+                devices[key].set_configuration(message[2])
+            elif kind == 'iface':
+                devices[key].set_interface(message[2], message[3])
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        scheduler.stop()
+        requests.release()
+        replies.release()
+        req_shm.close()
+        rep_shm.close()
+
+class _Worker(object):
+    """ Parent side of a single worker process """
+    def __init__(self, context, capacity):
+        size = ByteRing.required_size(capacity)
+        self.req_shm  = shared_memory.SharedMemory(create=True, size=size)
+        self.rep_shm  = shared_memory.SharedMemory(create=True, size=size)
+        self.requests = ByteRing(self.req_shm.buf[:size])
+        self.replies  = ByteRing(self.rep_shm.buf[:size])
+        self.lock     = threading.Lock()
+        self.proxies  = {}
+        self.answers  = {} # Futures of calls waiting on the worker's answer
+        self._calls   = itertools.count()
+
+        self.conn, child = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child, self.req_shm.name, self.rep_shm.name, capacity))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+        self.reader = threading.Thread(target=self._read, name='virtusb-offload')
+        self.reader.daemon = True
+        self.reader.start()
+
+    def send(self, message, data=None):
+        """ Send a control message, moving any payload through the ring """
+        with self.lock:
+            if data is not None:
+                data = _put_payload(self.requests, self.conn, data)
+            self.conn.send(message + (data,))
+
+    def call(self, message, data=None, timeout=CALL_TIMEOUT_SEC):
+        """ Send a control message the worker answers, and wait for the answer """
+        call_id = next(self._calls)
+        future = self.answers[call_id] = Future()
+        self.send(message + (call_id,), data)
+        try:
+            return future.result(timeout)
+        finally:
+            self.answers.pop(call_id, None)
+
+    def _read(self):
+        """ Route worker messages back to their proxies """
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            kind, key = message[0], message[1]
+            proxy = self.proxies[key]
+            if kind == 'added':
+                proxy.ready(message[2], message[3])
+            elif kind == 'complete':
+                data = _get_payload(self.replies, message[3])
+                proxy.complete(message[2], data)
+            elif kind == 'failed':
+                proxy.complete(message[2], RuntimeError(message[3]))
+            elif kind == 'answer':
+                future = self.answers.get(message[2])
+                if future is not None:
+                    future.set_result(message[3])
+
+    def close(self):
+        """ Stop the worker process and free the shared memory """
+        try:
+            self.send(('exit', None))
+        except (EOFError, OSError, ValueError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        self.reader.join(1)
+        for shm, ring in ((self.req_shm, self.requests), (self.rep_shm, self.replies)):
+            ring.release()
+            shm.close()
+            shm.unlink()
+
+class DevicePool(object):
+    """ Pool of worker processes that offloaded devices are spread across
+
+    Request and reply payloads move through shared memory rings, only small
+    control messages are pickled.
+    """
+    def __init__(self, workers=None, ring_size=DEFAULT_RING_SIZE, context=None):
+        if shared_memory is None:
+            raise RuntimeError('Offloading devices requires multiprocessing.shared_memory')
+        self.size     = workers or os.cpu_count() or 1
+        self._context = context or multiprocessing.get_context()
+        self._ring    = ring_size
+        self._workers = []
+        self._keys    = itertools.count()
+        atexit.register(self.close)
+
+    def add(self, factory, *args):
+        """ Create a device in a worker, returning it's local proxy """
+        key = next(self._keys)
+        if len(self._workers) < self.size:
+            self._workers.append(_Worker(self._context, self._ring))
+        worker = self._workers[key % self.size]
+        return ProcessDevice(worker, key, factory, args)
+
+    def close(self):
+        """ Stop all worker processes """
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
+
+class ProcessDevice(VirtualDevice):
+    """ Local stand in for a device running in a worker process
+
+    Standard control requests are answered locally from the descriptors,
+    while class and vendor ones wait on the worker's device to answer them.
+    URBs for any other endpoint are parked, and completed when the worker
+    replies. IN URBs are filled into a buffer in the worker when the device
+    there implements handle_into().
+    """
+    def __init__(self, worker, key, factory, args):
+        #pylint: disable=super-init-not-called
+        # The descriptors only exist once the worker has created the device
+        self._worker = None
+        self._key    = key
+        self._added  = threading.Event()
+        worker.proxies[key] = self
+        worker.send(('add', key, factory, args))
+        if not self._added.wait(30):
+            raise RuntimeError('Worker failed to create the device')
+        self._worker = worker
+
+    def ready(self, descriptor, speed):
+        """ Finish initializing once the worker has created the device """
+        super(ProcessDevice, self).__init__(descriptor)
+        self.speed = speed
+        self._added.set()
+
+    def handle(self, packet, data=None):
+        """ Hand the URB over to the worker """
+        self._worker.send(('urb', self._key, packet.pack()), data)
+        return URB_PENDING
+
+    def handle_control(self, packet, data=None):
+        """ Have the worker's device answer class, vendor and other requests """
+        try:
+            result = self._worker.call(('control', self._key, packet.pack()), data)
+        except FutureTimeout:
+            raise RuntimeError('Worker did not answer control request {}'.format(
+                packet['seq_num']))
+        if isinstance(result, RuntimeError):
+            raise result
+        return result
+
+    def cancel(self, endpoint, packet):
+        """ Have the worker's device forget the URB, unless it's already answered it """
+        try:
+            return self._worker.call(('cancel', self._key, packet.pack()))
+        except FutureTimeout:
+            LOGGER.warning('Worker did not answer unlinking URB {}'.format(packet['seq_num']))
+            return True
+
+    def set_configuration(self, config_value=None):
+        super(ProcessDevice, self).set_configuration(config_value)
+        if self._worker is not None:
+            self._worker.send(('config', self._key, config_value))
+
+    def set_interface(self, iface_value=None, alt_setting=0):
+        super(ProcessDevice, self).set_interface(iface_value, alt_setting)
+        if self._worker is not None:
+            self._worker.send(('iface', self._key, iface_value, alt_setting))
+
+    def start(self):
+        self._worker.send(('start', self._key))
+
+    def stop(self):
+        self._worker.send(('stop', self._key))
@@ -212,12 +212,13 @@ class UsbIpCmdUnlink(packets.BigEndian):
     fields = [
         fields.Padding(),
         fields.Padding(),
-        fields.UInt16('command',   default=USBIP_CMD_UNLINK),
-        fields.UInt32('seq_num',   default=0),
-        fields.UInt32('dev_id',    default=0),
-        fields.UInt32('direction', default=0x00000000),
-        fields.UInt32('endpoint',  default=0x00000000),
-        fields.UInt32('seq_num',   default=0)
+        fields.UInt16('command',        default=USBIP_CMD_UNLINK),
+        fields.UInt32('seq_num',        default=0),
+        fields.UInt32('dev_id',         default=0),
+        fields.UInt32('direction',      default=0x00000000),
+        fields.UInt32('endpoint',       default=0x00000000),
+        fields.UInt32('unlink_seq_num', default=0),
+        fields.Raw('reserved',          default=b'', size=24)
     ]
 
 class UsbIpRetUnlink(packets.BigEndian):
@@ -230,5 +231,6 @@ class UsbIpRetUnlink(packets.BigEndian):
         fields.UInt32('dev_id',    default=0),
         fields.UInt32('direction', default=0x00000000),
         fields.UInt32('endpoint',  default=0x00000000),
-        fields.UInt32('status',    default=0)
+        fields.UInt32('status',    default=0),
+        fields.Raw('reserved',     default=b'', size=24)
     ]
@@ -0,0 +1,90 @@
+""" Sampling profiler for the server's threads
+
+Every interval, the stacks of the threads named virtusb-* (the server,
+connection, scheduler and device threads) are sampled and counted. The
+counts are written in the collapsed stack format flamegraph.pl and
+speedscope read, a line per distinct stack:
+
+    virtusb-connection;handle (virtusb/server.py:356);... 42
+
+Sampling only reads the interpreter's frames, so a running server can be
+profiled without being restarted or slowed down much, unlike cProfile.
+"""
+#pylint: disable=C0326,R0205
+import os
+import sys
+import threading
+from collections import Counter
+from virtusb import log
+
+LOGGER = log.get_logger()
+INTERVAL_SEC = 0.01
+THREAD_NAME  = 'virtusb-profiler'
+
+class SamplingProfiler(object):
+    """ Samples the stacks of threads whose name starts with prefix """
+    def __init__(self, interval=INTERVAL_SEC, prefix='virtusb-'):
+        self.interval = interval
+        self.prefix   = prefix
+        self.stacks   = Counter()
+        self.samples  = 0
+        self._stop    = threading.Event()
+        self._thread  = None
+
+    def start(self):
+        """ Start sampling in the background """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=THREAD_NAME)
+        self._thread.daemon = True
+        self._thread.start()
+        LOGGER.info('Profiling threads every {:.1f}ms'.format(self.interval * 1000))
+
+    def stop(self):
+        """ Stop sampling, keeping what was sampled so far """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        LOGGER.info('Profiled {} samples'.format(self.samples))
+
+    @property
+    def running(self):
+        """ Check if the profiler is sampling """
+        return self._thread is not None
+
+    def _run(self):
+        """ Sample until stopped """
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """ Count the current stack of every profiled thread """
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate()
+                     if thread.name.startswith(self.prefix) and thread.name != THREAD_NAME)
+        frames = sys._current_frames() #pylint: disable=protected-access
+        for ident, name in names.items():
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(name)
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def collapsed(self):
+        """ Sampled stacks in the collapsed format, most frequent first """
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in self.stacks.most_common())
+
+    def dump(self, path):
+        """ Write the sampled stacks to a file in the collapsed format """
+        with open(path, 'w') as handle:
+            handle.write(self.collapsed())
+        LOGGER.warning('Wrote {} profiled stacks to {}'.format(
+            len(self.stacks), os.path.abspath(path)))
@@ -0,0 +1,123 @@
+""" Single producer, single consumer byte ring buffers """
+#pylint: disable=C0326,R0205
+import struct
+
+# Running totals of bytes written (head) and read (tail), stored in the buffer
+#  itself so rings can live in shared memory
+HEADER = struct.Struct('<QQ')
+RECORD = struct.Struct('<I')
+
+class ByteRing(object):
+    """ Lock-free byte ring over a writable buffer
+
+    One thread (or process) may write while another reads. Each side only
+    ever moves it's own counter, and only after the data has been copied.
+    """
+    def __init__(self, buf):
+        self._buf      = memoryview(buf)
+        self._data     = self._buf[HEADER.size:]
+        self.capacity  = len(self._data)
+        if self.capacity <= 0:
+            raise ValueError('Ring buffer has no room for data')
+
+    @classmethod
+    def allocate(cls, capacity):
+        """ Create a ring backed by private memory """
+        return cls(bytearray(HEADER.size + capacity))
+
+    @staticmethod
+    def required_size(capacity):
+        """ Size of the buffer needed to hold a ring of the given capacity """
+        return HEADER.size + capacity
+
+    def release(self):
+        """ Release the views of the underlying buffer (Required for shared memory) """
+        self._data.release()
+        self._buf.release()
+
+    def _head(self):
+        return struct.unpack_from('<Q', self._buf, 0)[0]
+
+    def _tail(self):
+        return struct.unpack_from('<Q', self._buf, 8)[0]
+
+    def __len__(self):
+        """ Number of bytes waiting to be read """
+        return self._head() - self._tail()
+
+    def free(self):
+        """ Number of bytes that can be written """
+        return self.capacity - len(self)
+
+    def _put(self, head, view):
+        """ Copy the view in at the head, without publishing it """
+        size  = len(view)
+        start = head % self.capacity
+        first = min(size, self.capacity - start)
+        self._data[start:start + first] = view[:first]
+        self._data[:size - first]       = view[first:]
+        return head + size
+
+    def _get(self, tail, view):
+        """ Copy out from the tail into the view, without publishing it """
+        size  = len(view)
+        start = tail % self.capacity
+        first = min(size, self.capacity - start)
+        view[:first] = self._data[start:start + first]
+        view[first:] = self._data[:size - first]
+        return tail + size
+
+    @staticmethod
+    def _bytes_view(data):
+        """ View any buffer as raw bytes """
+        view = memoryview(data)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        return view
+
+    def write(self, data):
+        """ Write as much of the data as fits, returning the byte count """
+        view = self._bytes_view(data)
+        head = self._head()
+        size = min(len(view), self.capacity - (head - self._tail()))
+        head = self._put(head, view[:size])
+        struct.pack_into('<Q', self._buf, 0, head)
+        return size
+
+    def readinto(self, buf):
+        """ Read as much as is available into the buffer, returning the byte count """
+        view = self._bytes_view(buf)
+        tail = self._tail()
+        size = min(len(view), self._head() - tail)
+        tail = self._get(tail, view[:size])
+        struct.pack_into('<Q', self._buf, 8, tail)
+        return size
+
+    def read(self, size=-1):
+        """ Read up to size bytes, or everything available """
+        available = len(self)
+        if size < 0 or size > available:
+            size = available
+        out = bytearray(size)
+        self.readinto(out)
+        return bytes(out)
+
+    def write_record(self, data):
+        """ Write a length prefixed record, all or nothing. Returns success """
+        view = self._bytes_view(data)
+        head = self._head()
+        if RECORD.size + len(view) > self.capacity - (head - self._tail()):
+            return False
+        head = self._put(head, memoryview(RECORD.pack(len(view))))
+        head = self._put(head, view)
+        struct.pack_into('<Q', self._buf, 0, head)
+        return True
+
+    def read_record(self):
+        """ Read a length prefixed record written with write_record """
+        prefix = bytearray(RECORD.size)
+        tail = self._get(self._tail(), memoryview(prefix))
+        out = bytearray(RECORD.unpack(bytes(prefix))[0])
+        tail = self._get(tail, memoryview(out))
+        struct.pack_into('<Q', self._buf, 8, tail)
+        return bytes(out)
@@ -0,0 +1,157 @@
+""" Shared timer scheduler for device simulations """
+#pylint: disable=C0326,R0205
+import heapq
+import itertools
+import threading
+import time
+from virtusb import log
+
+LOGGER = log.get_logger()
+CLOCK  = getattr(time, 'monotonic', time.time)
+
+# USBIP device speeds (Matches the kernels usb_device_speed)
+USB_SPEED_LOW   = 1
+USB_SPEED_FULL  = 2
+USB_SPEED_HIGH  = 3
+USB_SPEED_SUPER = 5
+
+def endpoint_period(endpoint, speed):
+    """ Calculate the polling period of an endpoint descriptor in seconds """
+    interval = max(endpoint.bInterval, 1)
+    transfer = endpoint.bmAttributes & 0x03
+
+    # High speed and faster count in 125us micro frames, exponentially
+    if speed >= USB_SPEED_HIGH:
+        return (2 ** (min(interval, 16) - 1)) * 0.000125
+
+    # Low and full speed isochronous endpoints are exponential in 1ms frames,
+    #  whereas interrupt endpoints are linear
+    if transfer == 0x01:
+        return (2 ** (min(interval, 16) - 1)) * 0.001
+    return interval * 0.001
+
+class Timer(object):
+    """ Handle to a scheduled callback """
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline  = deadline
+        self.interval  = interval
+        self.callback  = callback
+        self.args      = args
+        self.cancelled = False
+
+    def cancel(self):
+        """ Prevent the callback from running again """
+        self.cancelled = True
+
+class Scheduler(object):
+    """ Single thread running one-shot and periodic callbacks for every device
+
+    Periodic callbacks are re-armed from their previous deadline rather than
+    the time they ran at, so they don't drift. Ticks missed while the thread
+    was busy are skipped instead of being run in a burst.
+    """
+    def __init__(self):
+        self._heap    = []
+        self._counter = itertools.count()
+        self._cond    = threading.Condition()
+        self._thread  = None
+        self._running = False
+
+    def start(self):
+        """ Start running callbacks """
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='virtusb-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop running callbacks, dropping all scheduled timers
+
+        Callbacks may stop the scheduler too, which then exits once they return.
+        """
+        with self._cond:
+            self._running = False
+            self._heap    = []
+            self._cond.notify()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def call_later(self, delay, callback, *args):
+        """ Run the callback once after the delay in seconds """
+        timer = Timer(CLOCK() + delay, None, callback, args)
+        self._push(timer)
+        return timer
+
+    def call_every(self, interval, callback, *args):
+        """ Run the callback every interval seconds, starting one interval from now """
+        if interval <= 0:
+            raise ValueError('Interval must be positive')
+        timer = Timer(CLOCK() + interval, interval, callback, args)
+        self._push(timer)
+        return timer
+
+    def _push(self, timer):
+        """ Schedule the timer, waking the thread when it's the new earliest """
+        with self._cond:
+            self._schedule(timer)
+
+    def _rearm(self, timer):
+        """ Schedule a periodic timer again, unless the scheduler was stopped """
+        with self._cond:
+            if self._running:
+                self._schedule(timer)
+
+    def _schedule(self, timer):
+        """ Push the timer onto the heap, the condition must be held """
+        entry = (timer.deadline, next(self._counter), timer)
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._cond.notify()
+
+    def _pop_due(self):
+        """ Wait for and pop all timers that are due """
+        with self._cond:
+            while self._running:
+                # Drop cancelled timers as they come up
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                now  = CLOCK()
+                wait = self._heap[0][0] - now
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[2])
+                return now, due
+        return None, []
+
+    def _run(self):
+        """ Scheduler thread """
+        while True:
+            now, due = self._pop_due()
+            if now is None:
+                break
+
+            for timer in due:
+                if timer.cancelled or not self._running:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except Exception: #pylint: disable=broad-except
+                    LOGGER.exception('Scheduled callback failed')
+
+                # Re-arm periodic timers on their next deadline in the future
+                if timer.interval is not None and not timer.cancelled:
+                    missed = int((now - timer.deadline) // timer.interval)
+                    timer.deadline += timer.interval * (missed + 1)
+                    self._rearm(timer)
@@ -2,25 +2,158 @@
 #pylint: disable=C0326,W1202,R0205
 from __future__ import print_function
 import copy
+import errno
+import os
+import select
 import socket
 import signal
 import struct
 import threading
-from subprocess import Popen, PIPE
+try:
+    import selectors
+except ImportError:
+    import selectors2 as selectors # Python 2 backport
+from collections import deque
+from functools import partial
 from six.moves.socketserver import TCPServer, BaseRequestHandler
 from virtusb import log, packets
+from virtusb.buffers import BufferPool
+from virtusb.controller import URB_PENDING, FileRegion, endpoint_address
+from virtusb.metrics import Metrics
+from virtusb.profiler import SamplingProfiler, INTERVAL_SEC
+from virtusb.scheduler import Scheduler, CLOCK
 
 LOGGER = log.get_logger()
-RECV_TIMEOUT_SEC = 5
+DRAIN_TIMEOUT_SEC = 1.0
+THROTTLE_POLL_SEC = 0.05    # How often a throttled connection checks for more packets
+DISCARD_CHUNK     = 1 << 16 # Refused OUT data is read and dropped this much at a time
+CLAIM_TIMEOUT_SEC = 1.0     # How long an import waits for the device's previous connection to end
+
+# OP_REP_IMPORT status for a device another connection imported
+ST_DEV_BUSY = 0x02
+
+MAX_BUFFER_LEN       = 1 << 24 # Largest URB accepted
+MAX_IN_FLIGHT        = 1024    # Parked URBs per connection
+MAX_DEVICE_IN_FLIGHT = 256     # Parked URBs per device
+MAX_QUEUED           = 1 << 22 # Completion bytes a device may queue per endpoint
+
+# Returned in place of a handler's result when the watchdog already failed it's URB
+URB_FAILED = object()
+
+class Waker(object):
+    """ Socket pair that turns readable for good once set
+
+    Every thread waiting in select with the reader is woken at once, and
+    nothing wakes up until then.
+    """
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.event = threading.Event()
+
+    def set(self):
+        """ Wake every waiter, now and in the future """
+        if not self.event.is_set():
+            self.event.set()
+            self.writer.send(b'\x00')
+
+    def is_set(self):
+        """ Check if the waker has been set """
+        return self.event.is_set()
+
+    def close(self):
+        """ Close the socket pair """
+        self.reader.close()
+        self.writer.close()
+
+class Limits(object): #pylint: disable=too-few-public-methods
+    """ Bounds on what clients and devices can have the server hold on to
+
+    URBs bigger than max_buffer_len are failed with EMSGSIZE, without
+    buffering their OUT data. URBs arriving while their connection has
+    max_in_flight URBs parked, or their device max_device_in_flight, are held
+    back until one completes or is unlinked. Up to max_in_flight URBs are
+    held, so unlinks sent after them are still read, after which the
+    connection stops reading, leaving the client to TCP flow control.
+    Devices can queue max_queued bytes of completions per endpoint ahead of
+    their URBs, after which complete() refuses more.
+    """
+    def __init__(self, max_buffer_len=MAX_BUFFER_LEN, max_in_flight=MAX_IN_FLIGHT,
+                 max_queued=MAX_QUEUED, max_device_in_flight=MAX_DEVICE_IN_FLIGHT):
+        self.max_buffer_len       = max_buffer_len
+        self.max_in_flight        = max_in_flight
+        self.max_queued           = max_queued
+        self.max_device_in_flight = max_device_in_flight
 
 class UsbIpServer(object):
-    """ USBIP TCP Server """
-    def __init__(self, controller):
-        self.controller  = controller
-        self.should_stop = threading.Event()
-        self.server      = None
-        self.thread      = None
-        self.ports       = {}
+    """ USBIP TCP Server
+
+    Connections sleep in select until the client sends something, or the
+    server's waker is set when it stops. URBs still parked on a device when
+    it stops get drain_timeout seconds to complete before they're failed.
+    """
+    server_class  = TCPServer
+    handler_class = None # UsbIpHandler, once it's defined
+
+    def __init__(self, controller, drain_timeout=DRAIN_TIMEOUT_SEC, limits=None):
+        self.controller     = controller
+        self.scheduler      = Scheduler()
+        self.buffers        = BufferPool()
+        self.metrics        = Metrics()
+        self.limits         = limits or Limits()
+        self.should_stop    = threading.Event()
+        self.drain_timeout  = drain_timeout
+        self.drain_deadline = None
+        self.waker          = None
+        self.server         = None
+        self.address        = None
+        self.thread         = None
+        self.ports          = {}
+        self.claims         = {} # Device ids, and the connection that imported them
+        self.claims_changed = threading.Condition()
+        self.on_stop        = [] # Called once the server has stopped, to free what it used
+        self.tracer         = None
+        self.watchdog       = None
+        self.profiler       = None
+        self.profile_path   = 'virtusb-{}.folded'.format(os.getpid())
+        self.usbip          = self # Handlers served directly use this as their socket server
+
+    def set_tracer(self, tracer):
+        """ Trace the stages of URBs with a virtusb.trace.Tracer, or stop with None """
+        self.tracer = tracer
+        self.controller.tracer = tracer
+
+    def set_watchdog(self, watchdog):
+        """ Watch device calls with a virtusb.watchdog.Watchdog, or stop with None """
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        self.watchdog = watchdog
+        if watchdog is not None:
+            watchdog.metrics = self.metrics
+            if self.waker is not None and not self.waker.is_set():
+                watchdog.start()
+
+    def start_profiler(self, interval=INTERVAL_SEC):
+        """ Start sampling the stacks of the server's threads """
+        if self.profiler is None or not self.profiler.running:
+            self.profiler = SamplingProfiler(interval)
+            self.profiler.start()
+        return self.profiler
+
+    def stop_profiler(self, path=None):
+        """ Stop sampling, writing the collapsed stacks to path if given """
+        if self.profiler is None:
+            return None
+        self.profiler.stop()
+        if path is not None:
+            self.profiler.dump(path)
+        return self.profiler
+
+    def _profile_handler(self, *args): #pylint: disable=unused-argument
+        """ Toggle the profiler on SIGUSR1, writing it's stacks to profile_path when stopped """
+        if self.profiler is not None and self.profiler.running:
+            self.stop_profiler(self.profile_path)
+        else:
+            self.start_profiler()
 
     def _interrupt_handler(self, *args): #pylint: disable=unused-argument
         """ Handle interrupt signals """
@@ -28,26 +161,48 @@ class UsbIpServer(object):
         self.stop()
 
     def _serve(self):
-        """ Serve forever, but doesn't ignore timeouts """
-        while not self.should_stop.is_set():
-            self.server.handle_request()
+        """ Accept connections until woken up to stop """
+        selector = selectors.DefaultSelector()
+        selector.register(self.server.socket, selectors.EVENT_READ)
+        selector.register(self.waker.reader, selectors.EVENT_READ)
+        try:
+            while not self.waker.is_set():
+                selector.select()
+                if not self.waker.is_set():
+                    self.server.handle_request()
+        finally:
+            selector.close()
+
+    def drain_remaining(self):
+        """ Seconds left for in-flight URBs to complete while stopping """
+        if self.drain_deadline is None:
+            return self.drain_timeout
+        return self.drain_deadline - CLOCK()
 
     def start(self, bind_ip='0.0.0.0', bind_port=3240):
-        """ Start the server """
+        """ Start the server. Binding port 0 picks a free port, found in address """
         LOGGER.info('Starting USBIP server on {}:{}'.format(bind_ip, bind_port))
 
         # Configure the socket server
-        TCPServer.allow_reuse_address = True
-        TCPServer.timeout = RECV_TIMEOUT_SEC
-        self.server = TCPServer((bind_ip, bind_port), UsbIpHandler)
+        self.server_class.allow_reuse_address = True
+        self.server_class.timeout = None
+        self.server = self.server_class((bind_ip, bind_port), self.handler_class)
+        self.address = self.server.server_address
         self.server.controller = self.controller
-        self.server.keep_alive = threading.Event()
-        self.server.keep_alive.set()
+        self.server.scheduler  = self.scheduler
+        self.server.usbip      = self
+        self.waker = Waker()
+        self.drain_deadline = None
+        self.scheduler.start()
+        if self.watchdog is not None:
+            self.watchdog.start()
 
         # Start the server in it's own thread
         signal.signal(signal.SIGINT, self._interrupt_handler)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._profile_handler)
         self.should_stop.clear()
-        self.thread = threading.Thread(target=self._serve)
+        self.thread = threading.Thread(target=self._serve, name='virtusb-server')
         self.thread.start()
 
     def stop(self):
@@ -58,17 +213,36 @@ class UsbIpServer(object):
         self.detach_all()
         LOGGER.debug('All devices detached')
 
-        # Shutdown the server
+        # Wake everything up to stop, giving in-flight URBs until the deadline
+        self.drain_deadline = CLOCK() + self.drain_timeout
         self.should_stop.set()
-        self.server.keep_alive.clear()
-        self.server.server_close()
-        LOGGER.debug('TCP Socket closed')
+        self.waker.set()
 
         # Wait for the thread to finish
         self.thread.join()
         self.thread = None
         LOGGER.debug('Server thread joined')
 
+        self.server.server_close()
+        LOGGER.debug('TCP Socket closed')
+
+        # Drop every devices timers
+        self.scheduler.stop()
+        self.waker.close()
+        LOGGER.debug('Scheduler stopped')
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        self.stop_profiler()
+        for callback in self.on_stop:
+            callback()
+
+    def serve_connection(self, connection, address=None):
+        """ Serve an already connected client until it disconnects """
+        try:
+            UsbIpHandler(connection, address, self)
+        finally:
+            connection.close()
+
     def attach(self, device_id):
         """ Attach a single device with USBIP by device id """
         LOGGER.debug('Attaching device {}'.format(device_id))
@@ -82,6 +256,7 @@ class UsbIpServer(object):
         # Attach the device. Failing to attach a valid device should be treated
         #  as a fatal error since the end user may have to manually configure
         #  their environment back to a clean state
+        from subprocess import Popen, PIPE #pylint: disable=import-outside-toplevel
         args = ['sudo', 'usbip', 'attach', '-r', '127.0.0.1', '-b', device_id]
         process = Popen(args, stdout=PIPE, stderr=PIPE)
         out, err = process.communicate()
@@ -100,6 +275,7 @@ class UsbIpServer(object):
 
         # Detach the port. There are normal reasons why a device may fail to
         #  detach, but for safety, warn the user when it occurs.
+        from subprocess import Popen, PIPE #pylint: disable=import-outside-toplevel
         args = ['sudo', 'usbip', 'detach', '-p', str(port)]
         process = Popen(args, stdout=PIPE, stderr=PIPE)
         out, err = process.communicate()
@@ -114,9 +290,41 @@ class UsbIpServer(object):
             dev_no = int(parts[1])
             device_id =  (bus_no << 16) | dev_no
             device = self.controller.get_device(device_id)
-            device.stop()
+            self.watched(device, 'stop', self.ports[port])
             del self.ports[port]
 
+    def claim(self, device_id, owner):
+        """ Claim a device for a connection, giving any previous one a moment to let go
+
+        Devices complete URBs for a single connection, so only one may import
+        them at a time. Returns False if the device is still in use.
+        """
+        deadline = CLOCK() + CLAIM_TIMEOUT_SEC
+        with self.claims_changed:
+            while self.claims.get(device_id, owner) is not owner:
+                remaining = deadline - CLOCK()
+                if remaining <= 0:
+                    return False
+                self.claims_changed.wait(remaining)
+            self.claims[device_id] = owner
+        return True
+
+    def release(self, owner):
+        """ Release every device a connection claimed """
+        with self.claims_changed:
+            for device_id, claimant in list(self.claims.items()):
+                if claimant is owner:
+                    del self.claims[device_id]
+            self.claims_changed.notify_all()
+
+    def watched(self, device, label, bus_id):
+        """ Call a device's start or stop method, under the watchdog if there is one """
+        method = getattr(device, label)
+        if self.watchdog is None:
+            return method()
+        with self.watchdog.watch(label, bus_id):
+            return method()
+
     def attach_all(self):
         """ Attach all devices with USBIP """
         for idx in range(len(self.controller.devices)):
@@ -131,21 +339,177 @@ class UsbIpServer(object):
         for port in ports:
             self.detach(port)
 
+def sendall_parts(sock, header, data):
+    """ Send a header and payload without joining them, so payload views aren't copied """
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(header + bytes(data))
+        return
+
+    parts = [memoryview(header), memoryview(data)]
+    while parts:
+        sent = sock.sendmsg(parts)
+        while parts and sent >= parts[0].nbytes:
+            sent -= parts[0].nbytes
+            parts.pop(0)
+        if parts and sent:
+            parts[0] = parts[0][sent:]
+
+def sendall_file(sock, header, region):
+    """ Send a header, then a file region straight from the page cache """
+    # Hold the header back to go out with the start of the payload
+    sock.sendall(header, getattr(socket, 'MSG_MORE', 0))
+    offset    = region.offset
+    remaining = region.length
+    if hasattr(os, 'sendfile'):
+        fileno = region.file.fileno()
+        while remaining > 0:
+            sent = os.sendfile(sock.fileno(), fileno, offset, remaining)
+            if not sent:
+                break
+            offset    += sent
+            remaining -= sent
+    else:
+        data = region.read()
+        sock.sendall(data)
+        remaining -= len(data)
+
+    # The file shrunk under the region, so pad it out to keep the stream in sync
+    if remaining > 0:
+        LOGGER.error('File region ended {} bytes early'.format(remaining))
+        sock.sendall(b'\x00' * remaining)
+
+def format_bus_id(device_id):
+    """ Format a device id as it's bus id """
+    return '{}-{}'.format(device_id >> 16, device_id & 0xffff)
+
+def error_status(code):
+    """ Convert an errno code into a USBIP status (negative errno as unsigned) """
+    return (-code) & 0xffffffff
+
 class UsbIpHandler(BaseRequestHandler):
     """ Request handler for the USBIP server """
-    def handle(self):
-        """ Handle packets """
-        # Keep the connection open for as long as the client is connected
-        self.request.settimeout(RECV_TIMEOUT_SEC)
-        while self.server.keep_alive.is_set():
+    def setup(self):
+        """ Prepare the per connection URB state """
+        self.lock      = threading.RLock()
+        self.drained   = threading.Condition(self.lock)
+        self.parked    = {}
+        self.in_flight = 0 # URBs parked on every device
+        self.listening = {}
+        self.usbip     = self.server.usbip
+        self.unlinking = {}    # Unlink responses waiting on their URB's completion
+        self.answered  = set() # Parked URBs the watchdog already failed, by sequence number
+        self.held      = deque() # URBs held back by the in-flight limits, with OUT data and trace
+        self.span      = None  # Trace of the URB being handled, when it's sampled
+        self.spans     = {}   # Traces of parked URBs by sequence number
+
+        # Sleep until the client sends something or the server stops
+        self.request.settimeout(None)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.request, selectors.EVENT_READ)
+        self.selector.register(self.usbip.waker.reader, selectors.EVENT_READ)
+
+    def finish(self):
+        """ Stop listening for completions once the client is gone """
+        self.selector.close()
+        for device in self.listening.values():
+            device.set_urb_listener(None)
+        self.usbip.release(self)
+        self.listening = {}
+        self.parked    = {}
+        self.in_flight = 0
+        self.unlinking = {}
+        self.answered  = set()
+        self.held      = deque()
+        self.spans     = {}
+
+    def send(self, response, data=None, span=None):
+        """ Send a response packet with optional return data """
+        out_raw = response.pack()
+        if span is not None:
+            span.mark('pack')
+        with self.lock:
+            if isinstance(data, FileRegion) and len(data):
+                sendall_file(self.request, out_raw, data)
+            elif data:
+                sendall_parts(self.request, out_raw, data)
+            else:
+                self.request.sendall(out_raw)
+        if span is not None:
+            span.mark('send')
+            span.finish()
+        LOGGER.debug('Sent response ({} Bytes)'.format(len(out_raw)))
+
+    def wait_readable(self, idle):
+        """ Sleep until the client sends more data
+
+        Returns False when it shouldn't be waited for, as the server is
+        stopping. An idle connection stops right away, whereas the rest of a
+        packet already arriving is waited for until the drain deadline.
+        """
+        if not self.usbip.waker.is_set():
+            self.selector.select()
+            if not self.usbip.waker.is_set():
+                return True
+        if idle:
+            return False
+        timeout = self.usbip.drain_remaining()
+        if timeout <= 0:
+            return False
+        readable, _, _ = select.select([self.request], [], [], timeout)
+        return bool(readable)
+
+    def recv_exact(self, size, idle=False):
+        """ Receive exactly size bytes, or less only if the client disconnects
+
+        Data already on the line is read without waiting, so only an empty
+        socket costs a trip through select.
+        """
+        buf  = bytearray(size)
+        view = memoryview(buf)
+        got  = 0
+        while got < size:
             try:
-                raw = self.request.recv(4)
-            # A timeout just means there are no pending packets. restart the
-            #  loop, allowing the keep alive check to take place again
-            except socket.timeout:
+                count = self.request.recv_into(view[got:], size - got, socket.MSG_DONTWAIT)
+            except socket.error as error:
+                if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                if not self.wait_readable(idle and not got):
+                    break
                 continue
-            # No data on the line indicates the client has disconnected
-            if not raw:
+            if not count:
+                break
+            got += count
+        if got < size:
+            return bytes(buf[:got])
+        return buf
+
+    def handle(self):
+        """ Handle packets, until the client disconnects or the server stops """
+        try:
+            self.handle_packets()
+        # Clients may hang up with responses still on their way
+        except socket.error as error:
+            if error.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+            LOGGER.debug('Client disconnected ({})'.format(error))
+            return
+        self.drain()
+
+    def handle_packets(self):
+        """ Handle packets """
+        # Keep the connection open until the client disconnects or the server stops
+        while not self.usbip.waker.is_set():
+            # URBs held back by the in-flight limits go first, once there's room for them
+            if self.held:
+                held, readable = self.throttle()
+                if held is not None:
+                    self.submit_held(*held)
+                    continue
+                if not readable:
+                    continue
+            raw = bytes(self.recv_exact(4, idle=True))
+            # Missing data on the line indicates the client has disconnected
+            if len(raw) < 4:
                 break
 
             # OP_REQ packets contain a non-zero value in the first 2 bytes,
@@ -154,19 +518,28 @@ class UsbIpHandler(BaseRequestHandler):
             op_req = (header[0] > 0)
             command = header[1]
             if op_req and command == packets.OP_REQ_DEVLIST:
-                raw += self.request.recv(4)
+                raw += self.recv_exact(4)
                 packet = packets.OpReqDevlist.from_raw(raw)
                 response, data = self.pkt_op_req_devlist(packet)
             elif op_req and command == packets.OP_REQ_IMPORT:
-                raw += self.request.recv(36)
+                raw += self.recv_exact(36)
                 packet = packets.OpReqImport.from_raw(raw)
                 response, data = self.pkt_op_req_import(packet)
             elif not op_req and command == packets.USBIP_CMD_SUBMIT:
-                raw += self.request.recv(44)
+                span = self.begin_trace()
+                raw += self.recv_exact(44)
+                if span is not None:
+                    span.mark('recv')
                 packet = packets.UsbIpCmdSubmit.from_raw(raw)
-                response, data = self.pkt_usbip_cmd_submit(packet)
+                if span is not None:
+                    span.packet = packet
+                    span.mark('parse')
+                if self.held or not self.has_room(packet['dev_id']):
+                    response, data = self.hold(packet)
+                else:
+                    response, data = self.pkt_usbip_cmd_submit(packet)
             elif not op_req and command == packets.USBIP_CMD_UNLINK:
-                raw += self.request.recv(4)
+                raw += self.recv_exact(44)
                 packet = packets.UsbIpCmdUnlink.from_raw(raw)
                 response, data = self.pkt_usbip_cmd_unlink(packet)
 
@@ -176,22 +549,157 @@ class UsbIpHandler(BaseRequestHandler):
                 LOGGER.error(msg)
                 raise RuntimeError(msg)
 
-            # Send the response packet with optional return data
-            out_raw = response.pack()
-            if data:
-                out_raw += data
-            self.request.sendall(out_raw)
-            LOGGER.debug('Sent response ({} Bytes)'.format(len(raw)))
+            # Parked URBs are responded to once their device completes them
+            if response is None:
+                self.span = None
+                continue
+            self.send(response, data, self.span)
+            self.span = None
+
+    def has_room(self, device_id):
+        """ Check if an URB for the device fits in the in-flight limits """
+        limits = self.usbip.limits
+        if self.in_flight >= limits.max_in_flight:
+            return False
+        with self.lock:
+            parked = sum(len(urbs) for key, urbs in self.parked.items() if key[0] == device_id)
+        return parked < limits.max_device_in_flight
+
+    def hold(self, packet):
+        """ Hold an URB back until there's room for it, receiving it's OUT data """
+        buffer_len = packet['buffer_len']
+        if buffer_len > self.usbip.limits.max_buffer_len:
+            return self.pkt_usbip_cmd_submit(packet)
+        in_data = None
+        if packet['direction'] == 0 and buffer_len > 0:
+            in_data = self.recv_exact(buffer_len)
+            if self.span is not None:
+                self.span.mark('recv')
+        if not self.held:
+            LOGGER.debug('{} URBs in flight, holding back the client'.format(self.in_flight))
+            self.usbip.metrics.increment('limits.in_flight')
+        self.held.append((packet, in_data, self.span))
+        return None, None
+
+    def throttle(self):
+        """ Wait for room for a held URB, or for the client to send more
+
+        Returns the held URB there's room for, or None, and whether there's
+        more to read. That's read ahead while fewer than max_in_flight URBs
+        are held, so the unlinks which would make room aren't stuck behind
+        them. Past that, only unlinks are read.
+        """
+        read_ahead = len(self.held) < self.usbip.limits.max_in_flight
+        with self.lock:
+            held = self.next_held()
+            if held is None:
+                if select.select([self.request], [], [], 0)[0] and \
+                        (read_ahead or self.unlink_next()):
+                    return None, True
+                self.drained.wait(THROTTLE_POLL_SEC)
+                held = self.next_held()
+        return held, False
+
+    def unlink_next(self):
+        """ Check if the next packet the client sent is an unlink, or if it hung up """
+        try:
+            raw = self.request.recv(4, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except socket.error:
+            return False
+        if not raw:
+            return True
+        return len(raw) == 4 and struct.unpack('>HH', raw) == (0, packets.USBIP_CMD_UNLINK)
+
+    def next_held(self):
+        """ Take the first held URB there's room for, keeping each device's URBs in order """
+        blocked = set()
+        for index, held in enumerate(self.held):
+            device_id = held[0]['dev_id']
+            if device_id in blocked:
+                continue
+            if self.has_room(device_id):
+                del self.held[index]
+                return held
+            if self.in_flight >= self.usbip.limits.max_in_flight:
+                break
+            blocked.add(device_id)
+        return None
+
+    def submit_held(self, packet, in_data, span):
+        """ Handle an URB that was held back, now that there's room for it """
+        self.span = span
+        if span is not None:
+            span.mark('held')
+        response, data = self.pkt_usbip_cmd_submit(packet, in_data)
+        if response is not None:
+            self.send(response, data, span)
+        self.span = None
+
+    def discard(self, size):
+        """ Read and drop data the client sent, a chunk at a time """
+        while size > 0:
+            count = len(self.recv_exact(min(size, DISCARD_CHUNK)))
+            if not count:
+                return
+            size -= count
+
+    def begin_trace(self):
+        """ Start tracing the URB about to be received, if the server traces this one """
+        tracer = self.usbip.tracer
+        self.span = tracer.begin() if tracer is not None else None
+        return self.span
+
+    def drain(self):
+        """ Give parked URBs until the drain deadline to complete, then fail the rest """
+        if not self.usbip.waker.is_set():
+            return
+        with self.lock:
+            while self.held:
+                packet = self.held.popleft()[0]
+                LOGGER.debug('Failing held URB {} on shutdown'.format(packet['seq_num']))
+                response = packets.UsbIpRetSubmit(
+                    seq_num=packet['seq_num'], dev_id=packet['dev_id'],
+                    status=error_status(errno.ESHUTDOWN))
+                try:
+                    self.send(response)
+                except socket.error:
+                    return
+
+            while any(self.parked.values()):
+                timeout = self.usbip.drain_remaining()
+                if timeout <= 0:
+                    break
+                self.drained.wait(timeout)
+
+            for (device_id, _), parked in self.parked.items():
+                while parked:
+                    packet = parked.popleft()
+                    self.in_flight -= 1
+                    self.spans.pop(packet['seq_num'], None)
+                    if packet['seq_num'] in self.answered:
+                        continue
+                    LOGGER.debug('Failing URB {} on shutdown'.format(packet['seq_num']))
+                    response = packets.UsbIpRetSubmit(
+                        seq_num=packet['seq_num'], dev_id=device_id,
+                        status=error_status(errno.ESHUTDOWN))
+                    try:
+                        self.send(response)
+                        self.respond_unlinked(packet)
+                    except socket.error:
+                        return
 
     def pkt_op_req_devlist(self, packet):
         """ Handle OP_REQ_DEVLIST packets """
         LOGGER.debug('Received OP_REQ_DEVLIST')
+        return self.build_devlist(self.server.controller, packet), None
 
+    @staticmethod
+    def build_devlist(controller, packet):
+        """ Build the OP_REP_DEVLIST response describing every device on the controller """
         # Prepare an empty response packet
         response = packets.OpRepDevlist(version=packet['version'])
 
         # Create a list of devices in the controller, including their interfaces
-        controller = self.server.controller
         dev_list = []
         for idx, device in enumerate(controller.devices):
             iface_list = []
@@ -222,7 +730,7 @@ class UsbIpHandler(BaseRequestHandler):
 
         # Add the device list to the response
         response['devices'] = dev_list
-        return response, None
+        return response
 
     def pkt_op_req_import(self, packet):
         """ Handle OP_REQ_IMPORT packets """
@@ -247,8 +755,17 @@ class UsbIpHandler(BaseRequestHandler):
             response['status'] = 1
             return response, None
 
+        # Only one connection at a time gets a device's completions
+        if not self.usbip.claim(device_id, self):
+            LOGGER.error('Requested to import busy device ({})'.format(bus_id))
+            response['status'] = ST_DEV_BUSY
+            return response, None
+
         # Request the device to begin it's simulation
-        device.start()
+        device.scheduler  = self.server.scheduler
+        device.metrics    = self.usbip.metrics
+        device.max_queued = self.usbip.limits.max_queued
+        self.usbip.watched(device, 'start', bus_id)
 
         # Fill out response with the devices data
         response['full_path']       = controller.path + bus_id
@@ -267,38 +784,221 @@ class UsbIpHandler(BaseRequestHandler):
         response['iface_count']     = device.active_config.bNumInterfaces
         return response, None
 
-    def pkt_usbip_cmd_submit(self, packet):
-        """ Handle USBIP_CMD_SUBMIT packets """
+    def pkt_usbip_cmd_submit(self, packet, in_data=None):
+        """ Handle USBIP_CMD_SUBMIT packets, with their OUT data if it was held """
         LOGGER.debug('Received USBIP_CMD_SUBMIT')
 
         # Prepare an empty response packet
         response = packets.UsbIpRetSubmit(
             seq_num=packet['seq_num'], dev_id=packet['dev_id'])
 
-        # Fetch any additional data that came with the request
+        # Oversized URBs are refused, and their data dropped as it arrives
         buffer_len = packet['buffer_len']
-        if packet['direction'] == 0 and buffer_len > 0:
-            in_data = self.request.recv(buffer_len)
-        else:
-            in_data = None
+        if buffer_len > self.usbip.limits.max_buffer_len:
+            LOGGER.error('Refusing URB {} of {} bytes'.format(packet['seq_num'], buffer_len))
+            self.usbip.metrics.increment('limits.buffer_len')
+            if packet['direction'] == 0:
+                self.discard(buffer_len)
+            response['status'] = error_status(errno.EMSGSIZE)
+            return response, None
+
+        # Fetch any additional data that came with the request
+        if packet['direction'] == 0 and buffer_len > 0 and in_data is None:
+            in_data = self.recv_exact(buffer_len)
+            if self.span is not None:
+                self.span.mark('recv')
+
+        # Devices that can fill IN URBs into a pooled buffer skip allocating one
+        if packet['direction'] == 1 and packet['endpoint'] != 0 and buffer_len > 0:
+            if self.handle_into(packet, response):
+                return None, None
 
         # Send the request to the controller to handle
         try:
-            out_data = self.server.controller.handle(packet, in_data)
+            out_data = self.handle_watched(self.server.controller.handle, response, packet, in_data)
         except RuntimeError as error:
             LOGGER.error('Error handling USB_CMD_SUBMIT: {}'.format(str(error)))
             response['status'] = 1
             return response, None
+        if out_data is URB_FAILED:
+            return None, None
+        if self.span is not None:
+            self.span.mark('device' if packet['endpoint'] else 'controller')
+
+        # The device has nothing to send yet, hold on to the URB until it does
+        if out_data is URB_PENDING:
+            self.park(packet)
+            return None, None
+
+        return self.fill_ret_submit(response, packet, out_data)
+
+    def handle_into(self, packet, response):
+        """ Let the device fill an IN URB into a pooled buffer, and respond with it
+
+        Returns False if the device doesn't fill buffers, for handle() to take
+        the URB instead. URBs the device parks are parked here too.
+        """
+        buffers    = self.usbip.buffers
+        buffer_len = packet['buffer_len']
+        buf = buffers.acquire(buffer_len)
+        try:
+            try:
+                count = self.handle_watched(self.server.controller.handle_into, response,
+                                            packet, memoryview(buf)[:buffer_len])
+            except RuntimeError as error:
+                LOGGER.error('Error handling USB_CMD_SUBMIT: {}'.format(str(error)))
+                response['status'] = 1
+                self.send(response, span=self.span)
+                return True
+            if count is NotImplemented:
+                return False
+            if count is URB_FAILED:
+                return True
+            if self.span is not None:
+                self.span.mark('device')
+            if count is URB_PENDING:
+                self.park(packet)
+                return True
+            response['actual_len'] = count
+            self.send(response, memoryview(buf)[:count], self.span)
+            return True
+        finally:
+            buffers.release(buf)
+
+    def handle_watched(self, method, response, packet, data):
+        """ Have the controller handle an URB, failing it if the watchdog finds it too slow
+
+        Returns URB_FAILED once the watchdog has responded to the URB instead.
+        """
+        watchdog = self.usbip.watchdog
+        if watchdog is None:
+            return method(packet, data)
+        call = watchdog.begin(method.__name__, format_bus_id(packet['dev_id']),
+                              partial(self.fail_slow, response))
+        result = error = None
+        try:
+            result = method(packet, data)
+        except RuntimeError as caught:
+            error = caught
+        finally:
+            answered = not watchdog.end(call)
+        if answered:
+            if result is URB_PENDING:
+                self.cancel_answered(packet)
+            return URB_FAILED
+        if error is not None:
+            raise error
+        return result
+
+    def cancel_answered(self, packet):
+        """ Cancel an URB the device parked after the watchdog failed it
+
+        If the device can't take it back, the URB is parked anyway, so it's
+        completion is dropped rather than going to the next URB.
+        """
+        device = self.server.controller.get_device(packet['dev_id'])
+        if device.unlink(endpoint_address(packet), packet):
+            return
+        with self.lock:
+            self.answered.add(packet['seq_num'])
+        self.park(packet)
 
-        # Send the response with optional data, truncated to fit in the buffer
+    def fail_slow(self, response):
+        """ Fail an URB that's taking too long to handle """
+        LOGGER.error('Failing URB {}, it\'s handler is too slow'.format(response['seq_num']))
+        response['status'] = error_status(errno.ETIMEDOUT)
+        try:
+            self.send(response)
+        except socket.error as error:
+            LOGGER.debug('Client disconnected ({})'.format(error))
+
+    @staticmethod
+    def fill_ret_submit(response, packet, out_data):
+        """ Fill in a USBIP_RET_SUBMIT with optional data, truncated to fit in the buffer """
         if out_data is not None:
             buffer_len = packet['buffer_len']
-            out_data   = out_data[:buffer_len]
+            if isinstance(out_data, FileRegion):
+                out_data = out_data[:buffer_len]
+            elif len(out_data) > buffer_len:
+                out_data = memoryview(out_data)[:buffer_len]
             response['actual_len'] = len(out_data)
         else:
             response['actual_len'] = packet['buffer_len']
         return response, out_data
 
+    def park(self, packet):
+        """ Park an URB until it's device completes it """
+        device_id = packet['dev_id']
+        endpoint  = endpoint_address(packet)
+        LOGGER.debug('Parking URB {} on endpoint {:#04x}'.format(packet['seq_num'], endpoint))
+
+        with self.lock:
+            key = (device_id, endpoint)
+            if key not in self.parked:
+                self.parked[key] = deque()
+            self.parked[key].append(packet)
+            self.in_flight += 1
+            if self.span is not None:
+                self.spans[packet['seq_num']] = self.span
+
+            # Listen to the device for completions of it's parked URBs
+            if device_id not in self.listening:
+                device = self.server.controller.get_device(device_id)
+                device.set_urb_listener(partial(self.complete_parked, device_id))
+                self.listening[device_id] = device
+            device = self.listening[device_id]
+
+        # The device may have queued data before the URB arrived
+        self.complete_parked(device_id, device, endpoint)
+
+    def complete_parked(self, device_id, device, endpoint):
+        """ Respond to parked URBs for as long as the device has data queued for them """
+        with self.lock:
+            parked = self.parked.get((device_id, endpoint))
+            while parked:
+                try:
+                    out_data = device.pop_completion(endpoint)
+                except IndexError:
+                    break
+                packet = parked.popleft()
+                self.in_flight -= 1
+                span = self.spans.pop(packet['seq_num'], None) if self.spans else None
+                if self.answered and packet['seq_num'] in self.answered:
+                    self.answered.discard(packet['seq_num'])
+                    continue
+                if span is not None:
+                    span.mark('parked')
+                response = packets.UsbIpRetSubmit(
+                    seq_num=packet['seq_num'], dev_id=device_id)
+                if isinstance(out_data, RuntimeError):
+                    LOGGER.error('Error completing USB_CMD_SUBMIT: {}'.format(str(out_data)))
+                    response['status'] = 1
+                    out_data = None
+                else:
+                    response, out_data = self.fill_ret_submit(response, packet, out_data)
+                self.send(response, out_data, span)
+                self.respond_unlinked(packet)
+            self.drained.notify_all()
+
+    def respond_unlinked(self, packet):
+        """ Answer an unlink that waited for it's URB to complete. Call with the lock held """
+        if self.unlinking:
+            response = self.unlinking.pop(packet['seq_num'], None)
+            if response is not None:
+                self.send(response)
+
+    def unpark(self, key, packet):
+        """ Drop a parked URB without responding to it. Call with the lock held """
+        parked = self.parked.get(key)
+        for index, urb in enumerate(parked or ()):
+            if urb is packet:
+                del parked[index]
+                self.in_flight -= 1
+                self.spans.pop(packet['seq_num'], None)
+                self.drained.notify_all()
+                return True
+        return False
+
     def pkt_usbip_cmd_unlink(self, packet):
         """ Handle USBIP_CMD_UNLINK packets """
         LOGGER.debug('Received USBIP_CMD_UNLINK')
@@ -308,8 +1008,34 @@ class UsbIpHandler(BaseRequestHandler):
         response = packets.UsbIpRetUnlink(
             seq_num=packet['seq_num'], dev_id=dev_id)
 
-        # Request the device to stop it's simulation
-        device = self.server.controller.get_device(dev_id)
-        device.stop()
+        # Held URBs never reached their device
+        unlink_seq_num = packet['unlink_seq_num']
+        for index, held in enumerate(self.held):
+            if held[0]['seq_num'] == unlink_seq_num and held[0]['dev_id'] == dev_id:
+                del self.held[index]
+                response['status'] = error_status(errno.ECONNRESET)
+                return response, None
 
-        return response
+        # Completed URBs have already been responded to, which the status reflects
+        with self.lock:
+            found = [(key, urb) for key, parked in self.parked.items() if key[0] == dev_id
+                     for urb in parked if urb['seq_num'] == unlink_seq_num]
+            if not found:
+                return response, None
+            key, urb = found[0]
+            device = self.listening[dev_id]
+
+        # The device is told outside the lock, as it may be completing the URB right now
+        cancelled = device.unlink(key[1], urb)
+        with self.lock:
+            if cancelled and self.unpark(key, urb):
+                response['status'] = error_status(errno.ECONNRESET)
+                return response, None
+            if not any(parked is urb for parked in self.parked.get(key, ())):
+                return response, None
+
+            # The device is completing it, so answer once it's RET_SUBMIT is sent
+            self.unlinking[unlink_seq_num] = response
+        return None, None
+
+UsbIpServer.handler_class = UsbIpHandler
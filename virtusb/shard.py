@@ -0,0 +1,198 @@
+""" Multi-process USBIP server, sharding devices across worker processes """
+#pylint: disable=C0326,R0205,W1202
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+try:
+    import selectors
+except ImportError:
+    import selectors2 as selectors # Python 2 backport
+try:
+    from multiprocessing.reduction import sendfds, recvfds
+except ImportError:
+    sendfds = recvfds = None # Python 2 can't pass descriptors this way
+from six.moves.socketserver import ThreadingTCPServer, BaseRequestHandler
+from virtusb import log, packets
+from virtusb.scheduler import CLOCK
+from virtusb.server import UsbIpServer, UsbIpHandler, Waker, DRAIN_TIMEOUT_SEC
+
+LOGGER = log.get_logger()
+PEEK_RETRY_SEC = 0.001
+JOIN_GRACE_SEC = 1.0 # On top of the drain timeout, before workers are terminated
+
+def _shard_main(server, channel, front):
+    """ Worker process, serving the connections the front hands over """
+    # The supervisor handles interrupts and tells the workers when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Drop the inherited front ends of the channels, or closing them in the
+    #  supervisor would never be noticed
+    front.close()
+    for other in server.channels:
+        other.close()
+    server.waker = Waker()
+    server.profile_path = 'virtusb-{}.folded'.format(os.getpid())
+    server.scheduler.start()
+    if server.watchdog is not None:
+        server.watchdog.start()
+
+    threads = []
+    while True:
+        try:
+            fds = recvfds(channel, 1)
+        except (EOFError, OSError, RuntimeError):
+            break
+        connection = socket.socket(fileno=fds[0])
+        thread = threading.Thread(target=server.serve_connection, args=(connection,),
+                                  name='virtusb-connection')
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    # Let the connections drain their in-flight URBs before exiting
+    server.drain_deadline = CLOCK() + server.drain_timeout
+    server.waker.set()
+    for thread in threads:
+        thread.join()
+    server.scheduler.stop()
+    if server.watchdog is not None:
+        server.watchdog.stop()
+    server.waker.close()
+    channel.close()
+
+class _FrontServer(ThreadingTCPServer):
+    """ Threaded front server that leaves handed over connections open """
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        ThreadingTCPServer.__init__(self, *args, **kwargs)
+        self.handed_over = set()
+
+    def shutdown_request(self, request):
+        """ Only close our copy of connections a worker has taken over """
+        if request in self.handed_over:
+            self.handed_over.discard(request)
+            self.close_request(request)
+        else:
+            ThreadingTCPServer.shutdown_request(self, request)
+
+class _RoutingHandler(BaseRequestHandler):
+    """ Front acceptor handler. Answers device lists and routes imports """
+    def handle(self):
+        """ Handle OP_REQ packets until an import hands the connection over """
+        self.request.settimeout(None)
+        sharded  = self.server.usbip
+        selector = selectors.DefaultSelector()
+        selector.register(self.request, selectors.EVENT_READ)
+        selector.register(sharded.waker.reader, selectors.EVENT_READ)
+        try:
+            self.route(sharded, selector)
+        finally:
+            selector.close()
+
+    def route(self, sharded, selector):
+        """ Answer device lists, sleeping in between, until an import is routed """
+        while not sharded.waker.is_set():
+            selector.select()
+            if sharded.waker.is_set():
+                break
+            header = self.peek(8)
+            if len(header) < 8:
+                break
+
+            _, command, _ = struct.unpack('>HHI', header)
+            if command == packets.OP_REQ_DEVLIST:
+                packet = packets.OpReqDevlist.from_raw(self.request.recv(8))
+                response = UsbIpHandler.build_devlist(sharded.controller, packet)
+                self.request.sendall(response.pack())
+            elif command == packets.OP_REQ_IMPORT:
+                packet = packets.OpReqImport.from_raw(self.peek(40))
+                sharded.route(packet['bus_id'], self.request)
+                self.server.handed_over.add(self.request)
+                break
+            else:
+                LOGGER.error('Unexpected packet before importing a device')
+                break
+
+    def peek(self, size):
+        """ Wait for size bytes to arrive without consuming them """
+        raw = self.request.recv(size, socket.MSG_PEEK)
+        waker = self.server.usbip.waker
+        while raw and len(raw) < size and not waker.is_set():
+            time.sleep(PEEK_RETRY_SEC)
+            raw = self.request.recv(size, socket.MSG_PEEK)
+        return raw
+
+class ShardedServer(UsbIpServer):
+    """ USBIP server spreading it's devices across worker processes
+
+    Each worker is a fork owning every Nth device, and serves the connections
+    importing them. The front process lists all devices itself, and passes
+    import connections to the owning worker over a unix socket.
+    """
+    server_class  = _FrontServer
+    handler_class = _RoutingHandler
+
+    def __init__(self, controller, workers=None, drain_timeout=DRAIN_TIMEOUT_SEC, limits=None):
+        if sendfds is None:
+            raise RuntimeError('Sharding requires Python 3')
+        super(ShardedServer, self).__init__(controller, drain_timeout, limits)
+        self.workers   = workers or os.cpu_count() or 1
+        self.processes = []
+        self.channels  = []
+        self.locks     = []
+
+    def owner(self, bus_id):
+        """ Fetch the index of the worker that owns the bus id's device """
+        try:
+            device_no = int(bus_id.split('-')[1])
+        except (ValueError, IndexError):
+            # Any worker can respond to invalid bus ids
+            return 0
+        return (device_no - 1) % self.workers
+
+    def route(self, bus_id, connection):
+        """ Hand the connection over to the worker that owns the device """
+        idx = self.owner(bus_id)
+        LOGGER.debug('Routing import of {} to worker {}'.format(bus_id, idx))
+        with self.locks[idx]:
+            sendfds(self.channels[idx], [connection.fileno()])
+
+    def start(self, bind_ip='0.0.0.0', bind_port=3240):
+        """ Fork the workers, then start the front acceptor """
+        LOGGER.info('Starting {} USBIP server workers'.format(self.workers))
+
+        # Workers must be forked before any threads are started
+        context = multiprocessing.get_context('fork')
+        for _ in range(self.workers):
+            channel, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            process = context.Process(target=_shard_main, args=(self, child, channel))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.processes.append(process)
+            self.channels.append(channel)
+            self.locks.append(threading.Lock())
+
+        super(ShardedServer, self).start(bind_ip, bind_port)
+
+    def stop(self):
+        """ Stop the front acceptor and all workers """
+        super(ShardedServer, self).stop()
+
+        # Closing a channel tells it's worker to stop
+        for channel in self.channels:
+            channel.close()
+        for process in self.processes:
+            process.join(self.drain_timeout + JOIN_GRACE_SEC)
+            if process.is_alive():
+                LOGGER.warning('Worker {} did not stop, terminating'.format(process.pid))
+                process.terminate()
+        self.processes = []
+        self.channels  = []
+        self.locks     = []
+        LOGGER.debug('Server workers joined')
@@ -0,0 +1,231 @@
+""" Declarative device specs, compiled into shared descriptor templates
+
+A spec is a JSON (or YAML, with PyYAML installed) document describing a
+device's descriptors:
+
+    {
+        "name": "sensor",
+        "model": "virtusb.controller:VirtualDevice",
+        "count": 1000,
+        "idVendor": "0xdead", "idProduct": "0xbeef",
+        "configurations": [{
+            "bConfigurationValue": 1,
+            "interfaces": [{
+                "bInterfaceClass": "0xff",
+                "class_descriptors": ["05 24 00 10 01"],
+                "endpoints": [{"bEndpointAddress": "0x81", "bmAttributes": 2}]
+            }]
+        }]
+    }
+
+Loading validates it, builds the frozen template with every count and
+length filled in, and packs each descriptor blob. The compiled result is
+cached on disk by the hash of the spec, so loading it again is a single
+unpickle.
+"""
+#pylint: disable=C0326,R0205,W1202
+import binascii
+import hashlib
+import importlib
+import os
+import pickle
+import six
+from virtusb import descriptors, log
+from virtusb.controller import VirtualController, VirtualDevice
+
+LOGGER = log.get_logger()
+SPEC_VERSION = 1 # Bump when compiled specs change, to invalidate old caches
+DEFAULT_MODEL = 'virtusb.controller:VirtualDevice'
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'virtusb', 'specs')
+
+# Descriptor fields each level may set, with their size in bits
+DEVICE_FIELDS = {
+    'bDeviceClass': 8, 'bDeviceSubClass': 8, 'bDeviceProtocol': 8,
+    'idVendor': 16, 'idProduct': 16, 'bcdDevice': 16,
+}
+CONFIG_FIELDS = {
+    'bConfigurationValue': 8, 'bmAttributes': 8,
+}
+IFACE_FIELDS = {
+    'bInterfaceNumber': 8, 'bAlternateSetting': 8, 'bInterfaceClass': 8,
+    'bInterfaceSubClass': 8, 'bInterfaceProtocol': 8, 'iInterface': 8,
+}
+ENDPOINT_FIELDS = {
+    'bEndpointAddress': 8, 'bmAttributes': 8, 'wMaxPacketSize': 16, 'bInterval': 8,
+}
+SPEC_FIELDS = ('name', 'model', 'count', 'configurations')
+
+class DeviceSpec(object):
+    """ Compiled device spec. Calling it builds a device """
+    def __init__(self, name, descriptor, model=DEFAULT_MODEL, count=1, digest=None):
+        #pylint: disable=too-many-arguments
+        self.name       = name
+        self.descriptor = descriptor
+        self.model_path = model
+        self.count      = count
+        self.digest     = digest
+        self._model     = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_model'] = None
+        return state
+
+    @property
+    def model(self):
+        """ The device class, imported on first use """
+        if self._model is None:
+            module, _, name = self.model_path.partition(':')
+            self._model = getattr(importlib.import_module(module), name)
+        return self._model
+
+    def __call__(self, serial_number=None):
+        return self.model(device_descriptor=self.descriptor, serial_number=serial_number)
+
+def _number(value, bits, where):
+    """ Validate an integer field, given as a number or a hex/decimal string """
+    if isinstance(value, six.string_types):
+        try:
+            value = int(value, 0)
+        except ValueError:
+            raise RuntimeError('{}: invalid number {!r}'.format(where, value))
+    if isinstance(value, bool) or not isinstance(value, six.integer_types) \
+            or not 0 <= value < (1 << bits):
+        raise RuntimeError('{}: expected a {} bit unsigned number, got {!r}'.format(
+            where, bits, value))
+    return value
+
+def _fields(data, allowed, extra, where):
+    """ Validate a level of the spec, returning it's descriptor field values """
+    if not isinstance(data, dict):
+        raise RuntimeError('{}: expected an object'.format(where))
+    unknown = set(data) - set(allowed) - set(extra)
+    if unknown:
+        raise RuntimeError('{}: unknown fields {}'.format(where, ', '.join(sorted(unknown))))
+    return dict((name, _number(data[name], bits, '{}.{}'.format(where, name)))
+                for name, bits in allowed.items() if name in data)
+
+def _list(data, name, where):
+    """ Validate a list of sub levels """
+    items = data.get(name, [])
+    if not isinstance(items, list):
+        raise RuntimeError('{}.{}: expected a list'.format(where, name))
+    return [(item, '{}.{}[{}]'.format(where, name, idx)) for idx, item in enumerate(items)]
+
+def _class_descriptor(value, where):
+    """ Validate a class specific descriptor, given as a hex string """
+    try:
+        raw = binascii.unhexlify(value.replace(' ', ''))
+    except (AttributeError, TypeError, ValueError, binascii.Error):
+        raise RuntimeError('{}: expected a hex string'.format(where))
+    if len(raw) < 2 or bytearray(raw)[0] != len(raw):
+        raise RuntimeError('{}: bLength does not match the descriptor length'.format(where))
+    return raw
+
+def build_descriptor(data):
+    """ Validate a parsed spec, and build it's frozen device template """
+    fields = _fields(data, DEVICE_FIELDS, SPEC_FIELDS, 'spec')
+    configs = []
+    for config_data, config_where in _list(data, 'configurations', 'spec'):
+        config_fields = _fields(config_data, CONFIG_FIELDS, ('interfaces',), config_where)
+        interfaces = []
+        for iface_data, iface_where in _list(config_data, 'interfaces', config_where):
+            iface_fields = _fields(iface_data, IFACE_FIELDS,
+                                   ('class_descriptors', 'endpoints'), iface_where)
+            iface_fields['class_descriptors'] = [
+                _class_descriptor(value, where)
+                for value, where in _list(iface_data, 'class_descriptors', iface_where)]
+            iface_fields['endpoints'] = [
+                descriptors.Endpoint(**_fields(ep_data, ENDPOINT_FIELDS, (), ep_where))
+                for ep_data, ep_where in _list(iface_data, 'endpoints', iface_where)]
+            interfaces.append(descriptors.Interface(**iface_fields))
+        config_fields['interfaces'] = interfaces
+        configs.append(descriptors.Configuration(**config_fields))
+    if not configs:
+        raise RuntimeError('spec: at least one configuration is required')
+    fields['configurations'] = configs
+    return descriptors.Device(**fields).freeze()
+
+def compile_spec(data, digest=None):
+    """ Compile a parsed spec, packing every descriptor blob up front """
+    descriptor = build_descriptor(data)
+    count = data.get('count', 1)
+    if isinstance(count, bool) or not isinstance(count, six.integer_types) or count < 1:
+        raise RuntimeError('spec.count: expected a positive number')
+    spec = DeviceSpec(data.get('name', 'device'), descriptor,
+                      data.get('model', DEFAULT_MODEL), count, digest)
+
+    # The blobs are cached on the frozen descriptors, which every device shares
+    device = VirtualDevice(descriptor)
+    VirtualController.pack_device_descriptor(device)
+    for config in descriptor.configurations:
+        device.set_configuration(config.bConfigurationValue)
+        VirtualController.pack_config_descriptor(device)
+    return spec
+
+def parse_spec(raw, path=''):
+    """ Parse a spec document, YAML by extension or JSON otherwise """
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml #pylint: disable=import-outside-toplevel
+        except ImportError:
+            raise RuntimeError('PyYAML is required for YAML specs')
+        return yaml.safe_load(raw)
+    import json #pylint: disable=import-outside-toplevel
+    return json.loads(raw.decode('utf-8'))
+
+def load_spec(path, cache_dir=CACHE_DIR):
+    """ Load a spec file, from the compiled cache when it hasn't changed
+
+    Pass cache_dir=None to always compile it.
+    """
+    with open(path, 'rb') as spec_file:
+        raw = spec_file.read()
+    digest = hashlib.sha256(str(SPEC_VERSION).encode('ascii') + b'\x00' + raw).hexdigest()
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, digest + '.pickle')
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                spec = pickle.load(cache_file)
+            if isinstance(spec, DeviceSpec) and spec.digest == digest:
+                LOGGER.debug('Loaded compiled spec {} from {}'.format(path, cache_path))
+                return spec
+        except (IOError, OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            pass
+
+    spec = compile_spec(parse_spec(raw, path), digest)
+    if cache_path is not None:
+        _write_cache(cache_path, spec)
+    return spec
+
+def _write_cache(cache_path, spec):
+    """ Atomically write a compiled spec, warning rather than failing """
+    import tempfile #pylint: disable=import-outside-toplevel
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        handle, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as cache_file:
+            pickle.dump(spec, cache_file, protocol=2)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError) as error:
+        LOGGER.warning('Unable to cache the compiled spec: {}'.format(error))
+
+def main(path, *args):
+    """ Serve the devices of a spec file until interrupted """
+    from virtusb import cli #pylint: disable=import-outside-toplevel
+    args    = list(args)
+    options = cli.Parser().parse(args)
+    spec    = load_spec(path)
+    given   = any(arg in ('-n', '--count') or arg.startswith('--count=') for arg in args)
+    count   = options.count if given else spec.count
+
+    server = cli.server_factory(spec, count, options.workers)
+    server.start()
+    while not server.should_stop.wait(1):
+        pass
@@ -0,0 +1,80 @@
+""" In-process harness for testing and benchmarking devices over USBIP
+
+A LoopbackServer serves each connection over a socket pair instead of a
+listening socket, so any number of them can run side by side without
+fighting over port 3240:
+
+    controller = VirtualController()
+    controller.devices = [MyDevice()]
+    with loopback(controller) as (server, client):
+        client.attach('1-1')
+
+Pass tcp=True to go through a real TCP server on a free port instead.
+"""
+#pylint: disable=C0326,R0205
+import socket
+import threading
+from contextlib import contextmanager
+from virtusb.client import UsbIpClient
+from virtusb.scheduler import CLOCK
+from virtusb.server import UsbIpServer, Waker, DRAIN_TIMEOUT_SEC
+
+class LoopbackServer(UsbIpServer):
+    """ USBIP server without a listening socket, connected to with connect() """
+    def __init__(self, controller, drain_timeout=DRAIN_TIMEOUT_SEC, limits=None):
+        super(LoopbackServer, self).__init__(controller, drain_timeout, limits)
+        self.threads = []
+
+    def start(self, bind_ip=None, bind_port=None):
+        """ Start serving connections. The bind address is ignored """
+        self.waker = Waker()
+        self.drain_deadline = None
+        self.should_stop.clear()
+        self.scheduler.start()
+        if self.watchdog is not None:
+            self.watchdog.start()
+
+    def connect(self):
+        """ Open a new connection to the server, returning the client's socket """
+        if self.waker is None or self.waker.is_set():
+            raise RuntimeError('Loopback server is not running')
+        client_socket, server_socket = socket.socketpair()
+        thread = threading.Thread(target=self.serve_connection, args=(server_socket,),
+                                  name='virtusb-connection')
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        return client_socket
+
+    def stop(self):
+        """ Stop every connection and the scheduler """
+        self.drain_deadline = CLOCK() + self.drain_timeout
+        self.should_stop.set()
+        self.waker.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.scheduler.stop()
+        self.waker.close()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        self.stop_profiler()
+        for callback in self.on_stop:
+            callback()
+
+@contextmanager
+def loopback(controller, tcp=False, **kwargs):
+    """ Serve the controller for the duration of the block, yielding the server and a client """
+    if tcp:
+        server = UsbIpServer(controller, **kwargs)
+        server.start('127.0.0.1', 0)
+        client = UsbIpClient(*server.address)
+    else:
+        server = LoopbackServer(controller, **kwargs)
+        server.start()
+        client = UsbIpClient(connect=server.connect)
+    try:
+        yield server, client
+    finally:
+        client.close()
+        server.stop()
@@ -0,0 +1,198 @@
+""" Per URB stage tracing
+
+A Tracer timestamps each stage of the URBs a server handles, and keeps a
+latency histogram per device, endpoint and stage:
+
+    tracer = Tracer(sample_every=10)
+    server.set_tracer(tracer)
+    ...
+    print(tracer.summary())
+    tracer.dump('urbs.json', fmt='chrome')
+
+The stages, in order, are
+    recv        Receiving the rest of the header, and any OUT data
+    parse       Parsing the header
+    held        Waiting for the in-flight limits to make room, for URBs held back
+    controller  Preparing the response, and the controller routing the URB or
+                handling a control request
+    device      The device handling the URB
+    parked      Waiting for the device to complete a parked URB
+    pack        Packing the response header
+    send        Sending the response
+
+Only every sample_every'th URB is traced, and servers without a tracer don't
+take any timestamps at all.
+"""
+#pylint: disable=C0326,R0205
+from __future__ import division
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from virtusb.controller import endpoint_address
+
+MAX_EVENTS = 10000 # Traced URBs kept for dumping events
+BUCKETS    = 64    # Histogram buckets, in powers of two nanoseconds
+
+if hasattr(time, 'perf_counter_ns'):
+    CLOCK_NS = time.perf_counter_ns
+else:
+    CLOCK_NS = lambda: int(time.time() * 1e9)
+
+class Histogram(object):
+    """ Durations in nanoseconds, bucketed by powers of two """
+    __slots__ = ('count', 'total', 'minimum', 'maximum', 'buckets')
+
+    def __init__(self):
+        self.count   = 0
+        self.total   = 0
+        self.minimum = None
+        self.maximum = 0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, value):
+        """ Count a duration """
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        self.buckets[min(value.bit_length(), BUCKETS - 1)] += 1
+
+    def mean(self):
+        """ Average duration """
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, fraction):
+        """ Upper bound of the bucket the given fraction of durations fall under """
+        target = fraction * self.count
+        seen   = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min(1 << index, self.maximum)
+        return self.maximum
+
+class Span(object):
+    """ Stage timestamps of a single URB """
+    __slots__ = ('tracer', 'packet', 'start', 'last', 'stages')
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.packet = None # Set once the header is parsed
+        self.start  = self.last = CLOCK_NS()
+        self.stages = []
+
+    def mark(self, stage):
+        """ End a stage, which started when the last one ended """
+        now = CLOCK_NS()
+        self.stages.append((stage, self.last, now))
+        self.last = now
+
+    def finish(self):
+        """ Hand the URB's stages to the tracer, once it's been responded to """
+        if self.packet is not None:
+            self.tracer.record(self)
+
+class Tracer(object):
+    """ Collects stage timings of sampled URBs """
+    def __init__(self, sample_every=1, max_events=MAX_EVENTS):
+        if sample_every < 1:
+            raise ValueError('Sampling rate must be at least 1')
+        self.sample_every = sample_every
+        self.histograms   = {} # (dev_id, endpoint, stage) -> Histogram
+        self.events       = deque(maxlen=max_events)
+        self._count       = itertools.count()
+        self._local       = threading.local()
+        self._lock        = threading.Lock()
+
+    def begin(self):
+        """ Start tracing the URB arriving on this thread, or None if it isn't sampled """
+        span = None
+        if not next(self._count) % self.sample_every:
+            span = Span(self)
+        self._local.span = span
+        return span
+
+    def mark(self, stage):
+        """ End a stage of the URB being handled on this thread, if it's traced """
+        span = getattr(self._local, 'span', None)
+        if span is not None:
+            span.mark(stage)
+
+    def record(self, span):
+        """ Count a finished URB's stages """
+        packet   = span.packet
+        dev_id   = packet['dev_id']
+        endpoint = endpoint_address(packet)
+        with self._lock:
+            for stage, start, end in span.stages:
+                key = (dev_id, endpoint, stage)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.add(end - start)
+            self.events.append((dev_id, endpoint, packet['seq_num'], span.start, span.stages))
+
+    def reset(self):
+        """ Forget everything traced so far """
+        with self._lock:
+            self.histograms = {}
+            self.events.clear()
+
+    def summary(self):
+        """ Table of stage latencies in microseconds, per device and endpoint """
+        lines = ['{:<8} {:<6} {:<10} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+            'device', 'ep', 'stage', 'count', 'mean', 'p50', 'p99', 'max')]
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+        for (dev_id, endpoint, stage), histogram in histograms:
+            lines.append('{:<8} {:<6} {:<10} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                '{}-{}'.format(dev_id >> 16, dev_id & 0xffff), '{:#04x}'.format(endpoint),
+                stage, histogram.count, histogram.mean() / 1000,
+                histogram.percentile(0.5) / 1000, histogram.percentile(0.99) / 1000,
+                histogram.maximum / 1000))
+        return '\n'.join(lines)
+
+    def json_events(self):
+        """ Traced URBs, each with it's stage durations in nanoseconds """
+        with self._lock:
+            events = list(self.events)
+        return [{
+            'dev_id':   dev_id,
+            'endpoint': endpoint,
+            'seq_num':  seq_num,
+            'start':    start,
+            'stages':   [[stage, end - begin] for stage, begin, end in stages],
+        } for dev_id, endpoint, seq_num, start, stages in events]
+
+    def chrome_events(self):
+        """ Traced URBs in the Chrome trace event format, a thread per endpoint """
+        with self._lock:
+            events = list(self.events)
+        trace = []
+        for dev_id, endpoint, seq_num, start, stages in events:
+            args = {'seq_num': seq_num}
+            trace.append({
+                'name': 'urb', 'cat': 'urb', 'ph': 'X', 'pid': dev_id, 'tid': endpoint,
+                'ts': start / 1000, 'dur': (stages[-1][2] - start) / 1000, 'args': args})
+            for stage, begin, end in stages:
+                trace.append({
+                    'name': stage, 'cat': 'stage', 'ph': 'X', 'pid': dev_id, 'tid': endpoint,
+                    'ts': begin / 1000, 'dur': (end - begin) / 1000, 'args': args})
+        return trace
+
+    def dump(self, path, fmt='summary'):
+        """ Write the summary, or the traced URBs as 'json' or 'chrome' trace events """
+        if fmt == 'summary':
+            output = self.summary() + '\n'
+        elif fmt == 'json':
+            output = json.dumps(self.json_events())
+        elif fmt == 'chrome':
+            output = json.dumps({'traceEvents': self.chrome_events()})
+        else:
+            raise ValueError('Unknown trace format: {}'.format(fmt))
+        with open(path, 'w') as handle:
+            handle.write(output)
@@ -0,0 +1,122 @@
+""" Watchdog for device calls that take too long
+
+The server registers its calls into devices (handling URBs, starting and
+stopping) with a watchdog, which checks on them from its own thread. A call
+running past the threshold has it's stack logged and kept in events, and is
+counted in the metrics as watchdog.slow_calls.
+
+With fail_urbs set, the URB of a slow handler is failed with ETIMEDOUT right
+away, so the client isn't left waiting on it. Whatever the handler returns
+once it's done is dropped, and it still holds up it's connection until then.
+Should it park the URB, the device is asked to cancel it, and anything it
+completes the URB with anyway is dropped too.
+"""
+#pylint: disable=C0326,R0205
+import sys
+import threading
+import traceback
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from virtusb import log
+from virtusb.metrics import Metrics
+from virtusb.scheduler import CLOCK
+
+LOGGER = log.get_logger()
+THRESHOLD_SEC = 0.25
+MAX_EVENTS    = 100 # Slow calls kept for inspection
+
+SlowCall = namedtuple('SlowCall', ['label', 'device', 'duration', 'stack'])
+
+class Call(object):
+    """ A call into a device being watched """
+    __slots__ = ('label', 'device', 'thread', 'start', 'on_expire', 'reported', 'expired')
+
+    def __init__(self, label, device, on_expire):
+        self.label     = label
+        self.device    = device
+        self.thread    = threading.current_thread().ident
+        self.start     = CLOCK()
+        self.on_expire = on_expire
+        self.reported  = False
+        self.expired   = False
+
+class Watchdog(object):
+    """ Reports calls running longer than threshold seconds """
+    def __init__(self, threshold=THRESHOLD_SEC, fail_urbs=False, metrics=None):
+        self.threshold = threshold
+        self.fail_urbs = fail_urbs
+        self.metrics   = metrics or Metrics()
+        self.events    = deque(maxlen=MAX_EVENTS)
+        self._calls    = set()
+        self._lock     = threading.Lock()
+        self._stop     = threading.Event()
+        self._thread   = None
+
+    def start(self):
+        """ Start checking on calls """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='virtusb-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop checking on calls """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def begin(self, label, device, on_expire=None):
+        """ Watch a call on this thread, which on_expire fails if it's too slow """
+        call = Call(label, device, on_expire)
+        with self._lock:
+            self._calls.add(call)
+        return call
+
+    def end(self, call):
+        """ Stop watching a call, returning False if it was failed for being too slow """
+        with self._lock:
+            self._calls.discard(call)
+        return not call.expired
+
+    @contextmanager
+    def watch(self, label, device):
+        """ Watch the calls made in the block """
+        call = self.begin(label, device)
+        try:
+            yield call
+        finally:
+            self.end(call)
+
+    def _run(self):
+        """ Check on calls a few times per threshold """
+        while not self._stop.wait(max(self.threshold / 4, 0.001)):
+            self.check()
+
+    def check(self):
+        """ Report the calls that just went over the threshold """
+        now = CLOCK()
+        with self._lock:
+            overdue = [call for call in self._calls
+                       if not call.reported and now - call.start > self.threshold]
+            for call in overdue:
+                call.reported = True
+                if self.fail_urbs and call.on_expire is not None:
+                    call.expired = True
+                    self._calls.discard(call)
+
+        frames = sys._current_frames() #pylint: disable=protected-access
+        for call in overdue:
+            frame = frames.get(call.thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            duration = now - call.start
+            self.events.append(SlowCall(call.label, call.device, duration, stack))
+            self.metrics.increment('watchdog.slow_calls')
+            LOGGER.warning('Device {} has been in {} for {:.3f}s\n{}'.format(
+                call.device, call.label, duration, stack))
+            if call.expired:
+                self.metrics.increment('watchdog.failed_urbs')
+                call.on_expire()